@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""Measure the start-up time of inference with a saved model.
+
+Every measurement runs in a fresh Python process that imports PyTorch and
+the model code, loads the model and scores a single string pair. Scoring
+the first pair includes the TorchScript compilation of the dynamic
+programming, so it is measured both with an empty and with a filled
+TorchScript cache (see torchscript_cache.py). Models exported with
+export_torchscript.py are loaded with --scripted, without importing the
+code of this repository. The reported times are medians over the runs of
+the time from the process start until the end of each phase.
+
+The script and the TorchScript cache were only run with PyTorch 2.2, not
+with the pinned PyTorch 1.6, where the cache may behave differently.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+MEASUREMENT_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import torch
+times = {"import torch": time.perf_counter() - start}
+if not SCRIPTED:
+    import models
+times["import models"] = time.perf_counter() - start
+if SCRIPTED:
+    model = torch.jit.load(MODEL_PATH, map_location="cpu")
+    src_sent, tgt_sent = torch.tensor([[0, 0]]), torch.tensor([[0, 0]])
+else:
+    model = torch.load(MODEL_PATH, map_location="cpu").eval()
+    model.device = torch.device("cpu")
+    src_sent = torch.tensor([[model.src_bos, model.src_eos]])
+    tgt_sent = torch.tensor([[model.tgt_bos, model.tgt_eos]])
+times["load model"] = time.perf_counter() - start
+with torch.no_grad():
+    model.alpha(src_sent, tgt_sent)
+times["score first pair"] = time.perf_counter() - start
+print(json.dumps(times))
+"""
+
+
+def measure(model_path, scripted, cache_dir):
+    """Cumulative times of the start-up phases in a new process."""
+    code = MEASUREMENT_CODE.replace(
+        "SCRIPTED", repr(scripted)).replace("MODEL_PATH", repr(model_path))
+    environment = dict(os.environ, NSED_TORCHSCRIPT_CACHE=cache_dir)
+    environment["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__))] +
+        ([environment["PYTHONPATH"]] if "PYTHONPATH" in environment else []))
+    output = subprocess.run(
+        [sys.executable, "-c", code], env=environment, check=True,
+        stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode("utf-8").strip().split("\n")[-1])
+
+
+def report(name, runs):
+    print(name)
+    for phase in runs[0]:
+        median = statistics.median(run[phase] for run in runs)
+        print(f"  {phase:<20} {median:.3f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("model", type=str, help="Saved model.")
+    parser.add_argument(
+        "--scripted", default=False, action="store_true",
+        help="The model is a TorchScript module exported by "
+             "export_torchscript.py.")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    model_path = os.path.abspath(args.model)
+    if args.scripted:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            report("Scripted model", [
+                measure(model_path, True, cache_dir)
+                for _ in range(args.runs)])
+        return
+
+    cold_runs = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold_runs.append(measure(model_path, False, cache_dir))
+    report("Empty TorchScript cache", cold_runs)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        measure(model_path, False, cache_dir)
+        report("Filled TorchScript cache", [
+            measure(model_path, False, cache_dir) for _ in range(args.runs)])
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,16 @@
 import torch
 from torch import nn
 from torch.functional import F
-from transformers.modeling_bert import BertSelfAttention
 
-from rnn import AttConfig
+from transformer import MultiHeadAttention, embed_positions
 
 
 class CNNEncoder(nn.Module):
     """CNN/Embeddings sequence encoder.
 
     With zero layers, only uses the input symbol embeddings with learned
-    position embeddings.
+    position embeddings. Sequences longer than the 512 learned position
+    embeddings get sinusoidal embeddings for the remaining positions.
     """
     def __init__(self, vocab, hidden_size, embedding_size, layers=0,
                  window=3, dropout=0.1):
@@ -43,7 +43,8 @@ class CNNEncoder(nn.Module):
             input_ids.size(1)).unsqueeze(0).to(input_ids.device)
 
         output = (
-            self.embeddings(input_ids) + self.pos_embeddings(input_range))
+            self.embeddings(input_ids) +
+            embed_positions(self.pos_embeddings, input_range))
         output = self.embedd_norm(self.dropout(output))
 
         # Backward compatibility of saved models
@@ -102,8 +103,8 @@ class CNNDecoder(nn.Module):
                 self.cnn_norms.append(nn.LayerNorm(hidden_size))
 
                 if use_attention:
-                    self.atts.append(BertSelfAttention(
-                        AttConfig(hidden_size, attention_heads, True, dropout)))
+                    self.atts.append(MultiHeadAttention(
+                        hidden_size, attention_heads, dropout))
                     self.att_norms.append(nn.LayerNorm(hidden_size))
 
     def forward(self, input_ids, attention_mask,
@@ -112,7 +113,8 @@ class CNNDecoder(nn.Module):
             input_ids.size(1)).unsqueeze(0).to(input_ids.device)
 
         output = (
-            self.embeddings(input_ids) + self.pos_embeddings(input_range))
+            self.embeddings(input_ids) +
+            embed_positions(self.pos_embeddings, input_range))
         output = self.embedd_norm(self.dropout(output))
 
         attentions = []
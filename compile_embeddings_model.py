@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+"""Compile a neural edit distance model of the embeddings type into tables.
+
+The encoders of the embeddings models (CNN with zero layers) only depend on
+the symbol and its position, so they get precomputed up to the maximum
+length. The compiled model is used in the same way as the original one, in
+evaluation mode it only gathers from the tables instead of running the
+encoders. Longer inputs are processed by the encoders as before.
+"""
+
+import argparse
+import logging
+
+import torch
+
+from models import LOOKUP_TABLES
+
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("model", type=argparse.FileType("rb"))
+    parser.add_argument("output", type=str, help="Compiled model.")
+    parser.add_argument(
+        "--max-length", type=int, default=128,
+        help="Maximum length of the input strings including the boundary "
+             "symbols.")
+    args = parser.parse_args()
+
+    model = torch.load(args.model)
+    logging.info("Model loaded.")
+    model.compile_lookup_tables(args.max_length)
+    logging.info(
+        "Lookup tables compiled: %dk values.",
+        sum(getattr(model, name).numel() for name in LOOKUP_TABLES) / 1000)
+    torch.save(model, args.output)
+    logging.info("Compiled model saved to %s.", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Running independent encoders concurrently.
+
+PyTorch operators release the GIL, so independent encoders (e.g., source and
+target encoders without encoder-decoder attention) can run in threads at
+the same time. This helps mostly on multi-core CPUs with small models where
+a single encoder does not keep all cores busy. It is only used for
+inference, training runs the encoders one after another.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+EXECUTOR = None
+
+
+def _in_context(function, grad_enabled, cuda_device, cuda_stream):
+    # gradient mode and the current CUDA device and stream are thread-local,
+    # so they must be passed to the workers
+    def wrapped():
+        with torch.set_grad_enabled(grad_enabled):
+            if cuda_stream is None:
+                return function()
+            with torch.cuda.device(cuda_device), torch.cuda.stream(cuda_stream):
+                return function()
+    return wrapped
+
+
+def run_concurrently(*functions):
+    """Call functions without arguments in threads and return their results.
+
+    The last function is called in the current thread, so a single function
+    is called directly without any overhead. The workers use the gradient
+    mode and the CUDA device and stream of the calling thread, so on GPU, the
+    kernels of all functions are queued to the same stream.
+    """
+    global EXECUTOR  # pylint: disable=global-statement
+    if len(functions) == 1:
+        return [functions[0]()]
+    if EXECUTOR is None:
+        EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+    grad_enabled = torch.is_grad_enabled()
+    cuda_device, cuda_stream = None, None
+    # do not initialize CUDA if it has not been used
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        cuda_device = torch.cuda.current_device()
+        cuda_stream = torch.cuda.current_stream()
+    futures = [
+        EXECUTOR.submit(_in_context(
+            function, grad_enabled, cuda_device, cuda_stream))
+        for function in functions[:-1]]
+    last_result = functions[-1]()
+    return [future.result() for future in futures] + [last_result]
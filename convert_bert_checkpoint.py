@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""Convert a saved neural model to the native Transformer implementation.
+
+Models saved before the Transformer was implemented in this repository
+contain BertModel and BertSelfAttention modules from Transformers (which
+thus need to be installed to run this script). They are replaced by the
+equivalent modules from transformer.py. Pre-trained BERT models (that use
+GELU) are kept.
+"""
+
+import argparse
+import logging
+
+import torch
+from transformers import BertModel
+from transformers.modeling_bert import BertSelfAttention
+
+from transformer import MultiHeadAttention, Transformer
+
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+def convert_module(module, converted):
+    """Recursively replace Transformers modules, keep sharing of modules."""
+    # pylint: disable=protected-access
+    for name, child in list(module._modules.items()):
+        if child is None:
+            continue
+        if id(child) not in converted:
+            if isinstance(child, BertSelfAttention):
+                new_child = MultiHeadAttention(
+                    child.all_head_size, child.num_attention_heads,
+                    child.dropout.p)
+                new_child.load_state_dict(child.state_dict())
+                new_child.train(child.training)
+            elif (isinstance(child, BertModel) and
+                  child.config.hidden_act == "relu"):
+                new_child = Transformer.from_bert(child)
+                new_child.train(child.training)
+            else:
+                new_child = child
+                convert_module(child, converted)
+            converted[id(child)] = new_child
+        setattr(module, name, converted[id(child)])
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("model", type=argparse.FileType("rb"))
+    parser.add_argument("output", type=str, help="Converted model.")
+    args = parser.parse_args()
+
+    model = torch.load(args.model, map_location="cpu")
+    logging.info("Model loaded.")
+    convert_module(model, {})
+    torch.save(model, args.output)
+    logging.info("Converted model saved to %s.", args.output)
+
+
+if __name__ == "__main__":
+    main()
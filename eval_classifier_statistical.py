@@ -6,6 +6,7 @@ import logging
 import os
 
 import torch
+from torch import nn
 from torchtext import data
 
 from experiment import experiment_logging, get_timestamp, save_vocab
@@ -33,6 +34,20 @@ def str_to_vec(stoi, string, tokenized):
     return torch.tensor([[stoi[s] for s in tok]])
 
 
+def score_pairs(model, src_vecs, tgt_vecs, src_pad, tgt_pad, batch_size=256):
+    """Viterbi scores of string pairs computed in padded batches."""
+    scores = []
+    for i in range(0, len(src_vecs), batch_size):
+        src_batch = nn.utils.rnn.pad_sequence(
+            [vec[0] for vec in src_vecs[i:i + batch_size]],
+            batch_first=True, padding_value=src_pad)
+        tgt_batch = nn.utils.rnn.pad_sequence(
+            [vec[0] for vec in tgt_vecs[i:i + batch_size]],
+            batch_first=True, padding_value=tgt_pad)
+        scores.extend(model.viterbi(src_batch, tgt_batch).tolist())
+    return scores
+
+
 def main():
     parser = argparse.ArgumentParser(__doc__)
     parser.add_argument("model", type=argparse.FileType("rb"))
@@ -55,12 +70,16 @@ def main():
     neg_scores = []
 
     logging.info("Estimate threshold on validation data.")
-    for i, line in enumerate(args.eval_data):
+    src_vecs, tgt_vecs, classes = [], [], []
+    for line in args.eval_data:
         src, tgt, clazz = line.strip().split("\t")
-        src_idx = str_to_vec(src_stoi, src, args.src_tokenized)
-        tgt_idx = str_to_vec(tgt_stoi, tgt, args.tgt_tokenized)
+        src_vecs.append(str_to_vec(src_stoi, src, args.src_tokenized))
+        tgt_vecs.append(str_to_vec(tgt_stoi, tgt, args.tgt_tokenized))
+        classes.append(clazz)
+    scores = score_pairs(
+        model, src_vecs, tgt_vecs, src_stoi["<pad>"], tgt_stoi["<pad>"])
 
-        score = model.viterbi(src_idx, tgt_idx)
+    for score, clazz in zip(scores, classes):
         if clazz == "0":
             neg_scores.append(score)
         if clazz == "1":
@@ -96,13 +115,16 @@ def main():
     real_positives = 0
     all_positives = 0
     all_count = 0
-    for i, line in enumerate(args.test_data):
+    src_vecs, tgt_vecs, classes = [], [], []
+    for line in args.test_data:
         src, tgt, clazz = line.strip().split("\t")
-        src_idx = str_to_vec(src_stoi, src, args.src_tokenized)
-        tgt_idx = str_to_vec(tgt_stoi, tgt, args.tgt_tokenized)
-
-        score = model.viterbi(src_idx, tgt_idx)
+        src_vecs.append(str_to_vec(src_stoi, src, args.src_tokenized))
+        tgt_vecs.append(str_to_vec(tgt_stoi, tgt, args.tgt_tokenized))
+        classes.append(clazz)
+    scores = score_pairs(
+        model, src_vecs, tgt_vecs, src_stoi["<pad>"], tgt_stoi["<pad>"])
 
+    for score, clazz in zip(scores, classes):
         if score > threshold:
             all_positives += 1
             if clazz == "1":
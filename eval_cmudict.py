@@ -27,10 +27,17 @@ def main():
         choices=["greedy", "beam_search", "operations", "operations_beam"])
     parser.add_argument("--beam-size", type=int, default=3)
     parser.add_argument("--len-norm", type=float, default=1.6)
+    parser.add_argument(
+        "--quantize", default=False, action="store_true",
+        help="Run a dynamically quantized (int8) model on CPU.")
     args = parser.parse_args()
 
-    model = torch.load(args.model)
+    model = torch.load(
+        args.model, map_location="cpu" if args.quantize else None)
     logging.info("Model loaded.")
+    if args.quantize:
+        model = model.quantize()
+        logging.info("Model quantized.")
     src_vocab, src_stoi = load_vocab(args.src_vocab)
     tgt_vocab, tgt_stoi = load_vocab(args.tgt_vocab)
     logging.info("Vocabularies loaded.")
@@ -54,7 +61,7 @@ def main():
         src_tok = ["<s>"] + list(src) + ["</s>"]
 
         src_idx = torch.tensor(
-            [[src_stoi[s] for s in src_tok]]).cuda()
+            [[src_stoi[s] for s in src_tok]]).to(model.device)
 
         if args.decoding == "greedy":
             output = model.decode(src_idx)
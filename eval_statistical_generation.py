@@ -6,6 +6,7 @@ import logging
 import os
 
 import torch
+from torch import nn
 from torchtext import data
 
 from experiment import experiment_logging, get_timestamp, save_vocab
@@ -35,6 +36,14 @@ def main():
     parser.add_argument("data", type=argparse.FileType("r"))
     parser.add_argument("--src-tokenized", default=False, action="store_true")
     parser.add_argument("--tgt-tokenized", default=False, action="store_true")
+    parser.add_argument(
+        "--decoding", default="sampling", choices=["sampling", "beam_search"],
+        help="Best of sampled outputs or deterministic beam search.")
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--beam-size", type=int, default=10)
+    parser.add_argument("--len-norm", type=float, default=1.0,
+                        help="Length normalization factor.")
+    parser.add_argument("--batch-size", type=int, default=64)
     args = parser.parse_args()
 
     model = torch.load(args.model)
@@ -49,30 +58,35 @@ def main():
     references = []
     hypotheses = []
 
-    for i, line in enumerate(args.data):
-        total += 1
-        src, tgt = line.strip().split("\t")
-        src_tok = (
-            ["<s>"] +
-            (src.split() if args.src_tokenized else list(src)) +
-            ["</s>"])
-        tgt_tok = (
-            ["<s>"] +
-            (tgt.split() if args.tgt_tokenized else list(tgt)) +
-            ["</s>"])
-
-        src_idx = torch.tensor([[src_stoi[s] for s in src_tok]])
-        tgt_idx = torch.tensor([[tgt_stoi[s] for s in tgt_tok]])
-
-        hyp = [tgt_vocab[idx] for idx in model.decode(src_idx)]
-        hyp_str = " ".join(hyp) if args.tgt_tokenized else "".join(hyp)
-        correct += hyp_str == tgt
-
-        references.append(tgt)
-        hypotheses.append(hyp_str)
-
-        if i < 10:
-            logging.info("'%s' -> '%s' (%s)", src, hyp_str, tgt)
+    pairs = [line.strip().split("\t") for line in args.data]
+    for start in range(0, len(pairs), args.batch_size):
+        batch = pairs[start:start + args.batch_size]
+        src_idx = nn.utils.rnn.pad_sequence([
+            torch.tensor([src_stoi[s] for s in (
+                ["<s>"] +
+                (src.split() if args.src_tokenized else list(src)) +
+                ["</s>"])])
+            for src, _ in batch], batch_first=True,
+            padding_value=src_stoi["<pad>"])
+
+        if args.decoding == "beam_search":
+            decoded = model.beam_search(
+                src_idx, beam_size=args.beam_size, len_norm=args.len_norm)
+        else:
+            decoded = model.decode(src_idx, samples=args.samples)
+
+        for i, ((src, tgt), hyp_idx) in enumerate(
+                zip(batch, decoded), start=start):
+            total += 1
+            hyp = [tgt_vocab[idx] for idx in hyp_idx]
+            hyp_str = " ".join(hyp) if args.tgt_tokenized else "".join(hyp)
+            correct += hyp_str == tgt
+
+            references.append(tgt)
+            hypotheses.append(hyp_str)
+
+            if i < 10:
+                logging.info("'%s' -> '%s' (%s)", src, hyp_str, tgt)
 
     wer = 1 - correct / total
     logging.info("WER: %.3f", wer)
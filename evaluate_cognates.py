@@ -12,7 +12,6 @@ import argparse
 from collections import defaultdict
 import csv
 import logging
-import multiprocessing
 
 import bcubed
 import infomap
@@ -23,7 +22,7 @@ import torch.nn as nn
 from torch.functional import F
 from transformers import BertForSequenceClassification
 
-from models import EditDistStatModel
+from statistical_model import EditDistStatModel
 
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
@@ -95,19 +94,13 @@ def main():
 
     def score_batch():
         if isinstance(model, EditDistStatModel):
-            def run_batch(batch):
-                out_scores = []
-                for _, _, w1, w2 in batch:
-                    out_scores.append(model.viterbi(w1, w2).numpy().tolist())
-                return out_scores
-
-            ps = len(batch) // 2
-            batched_data = [batch[i * ps:(i + 1) * ps] for i in range(2)]
-            batch_scores = parmap(run_batch, batched_data, 2)
-            scores = []
-            for b in batch_scores:
-                for s in b:
-                    scores.append(s)
+            src_padded = nn.utils.rnn.pad_sequence(
+                [x[2][0] for x in batch], batch_first=True,
+                padding_value=src_vocab_stoi["<pad>"])
+            tgt_padded = nn.utils.rnn.pad_sequence(
+                [x[3][0] for x in batch], batch_first=True,
+                padding_value=tgt_vocab_stoi["<pad>"])
+            scores = model.viterbi(src_padded, tgt_padded).numpy().tolist()
         elif isinstance(model, BertForSequenceClassification):
             padded = nn.utils.rnn.pad_sequence(
                 [torch.cat((x[2][0], x[3][0]), dim=0) for x in batch], batch_first=True)
@@ -164,41 +157,5 @@ def main():
         logging.info("")
 
 
-
-# SOME STUFF COPIED FROM STACKOVERFLOW TO BE ABLE TO MAP WITH CLOSURE FUNCTION
-# https://stackoverflow.com/questions/3288595/multiprocessing-how-to-use-pool-map-on-a-function-defined-in-a-class
-def fun(f, q_in, q_out, total_size):
-    while True:
-        i, x = q_in.get()
-        if i is None:
-            break
-        q_out.put((i, f(x)))
-        #print(f"Progress: {q_out.qsize()} / {total_size} "
-        #      f"({100 * q_out.qsize() / total_size:.0f}%)",
-        #      end="\r", file=sys.stderr)
-
-
-def parmap(f, X, nprocs, keep_order=True):
-    q_in = multiprocessing.Queue(1)
-    q_out = multiprocessing.Queue()
-
-    proc = [multiprocessing.Process(target=fun, args=(f, q_in, q_out, len(X)))
-            for _ in range(nprocs)]
-    for p in proc:
-        p.daemon = True
-        p.start()
-
-    sent = [q_in.put((i, x)) for i, x in enumerate(X)]
-    [q_in.put((None, None)) for _ in range(nprocs)]
-    res = [q_out.get() for _ in range(len(sent))]
-
-    [p.join() for p in proc]
-
-    if keep_order:
-        return [x for i, x in sorted(res)]
-    return [x for i, x in res]
-# END OF STACKOVERFLOW COPY-PASTE
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""Compare a quantized neural edit distance model with the float model.
+
+Both models are run on CPU on held-out tab-separated string pairs. The
+report contains the model sizes, the difference of the log-probabilities
+of the pairs and the scoring throughput. For generation models, the greedy
+decoding accuracy and character error rate with respect to the target
+strings and the decoding throughput are reported as well.
+"""
+
+import argparse
+import io
+import logging
+import time
+
+import torch
+from torch import nn
+
+from models import EditDistNeuralModelProgressive
+from transliteration_utils import load_vocab, decode_ids, char_error_rate
+
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+def serialized_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def to_batches(pairs, src_stoi, tgt_stoi, batch_size, src_tokenized,
+               tgt_tokenized):
+    def to_tensor(string, stoi, tokenized):
+        tokens = string.split() if tokenized else list(string)
+        return torch.tensor(
+            [stoi["<s>"]] + [stoi[tok] for tok in tokens] + [stoi["</s>"]])
+
+    batches = []
+    for i in range(0, len(pairs), batch_size):
+        batch = pairs[i:i + batch_size]
+        batches.append((
+            nn.utils.rnn.pad_sequence(
+                [to_tensor(src, src_stoi, src_tokenized) for src, _ in batch],
+                batch_first=True, padding_value=src_stoi["<pad>"]),
+            nn.utils.rnn.pad_sequence(
+                [to_tensor(tgt, tgt_stoi, tgt_tokenized) for _, tgt in batch],
+                batch_first=True, padding_value=tgt_stoi["<pad>"])))
+    return batches
+
+
+@torch.no_grad()
+def log_probabilities(model, batches):
+    """Log-probabilities of all pairs and the time it took."""
+    start = time.time()
+    log_probs = []
+    for src_sent, tgt_sent in batches:
+        alpha = model.alpha(src_sent, tgt_sent)
+        src_lengths = (src_sent != model.src_pad).sum(1) - 1
+        tgt_lengths = (tgt_sent != model.tgt_pad).sum(1) - 1
+        log_probs.append(
+            alpha[torch.arange(alpha.size(0)), src_lengths, tgt_lengths])
+    return torch.cat(log_probs), time.time() - start
+
+
+@torch.no_grad()
+def greedy_outputs(model, batches, tgt_vocab, tgt_tokenized):
+    """Greedily decoded strings and the time it took."""
+    start = time.time()
+    outputs = []
+    for src_sent, _ in batches:
+        for output in model.decode(src_sent):
+            outputs.append(decode_ids(output.tolist(), tgt_vocab, tgt_tokenized))
+    return outputs, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("model", type=argparse.FileType("rb"))
+    parser.add_argument("src_vocab", type=argparse.FileType("r"))
+    parser.add_argument("tgt_vocab", type=argparse.FileType("r"))
+    parser.add_argument(
+        "data", type=argparse.FileType("r"),
+        help="Held-out tab-separated string pairs.")
+    parser.add_argument("--src-tokenized", default=False, action="store_true")
+    parser.add_argument("--tgt-tokenized", default=False, action="store_true")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    float_model = torch.load(args.model, map_location="cpu").eval()
+    float_model.device = torch.device("cpu")
+    quantized_model = float_model.quantize()
+    logging.info("Model loaded and quantized.")
+    _, src_stoi = load_vocab(args.src_vocab)
+    tgt_vocab, tgt_stoi = load_vocab(args.tgt_vocab)
+    logging.info("Vocabularies loaded.")
+
+    pairs = [line.rstrip("\n").split("\t")[:2] for line in args.data]
+    args.data.close()
+    batches = to_batches(
+        pairs, src_stoi, tgt_stoi, args.batch_size,
+        args.src_tokenized, args.tgt_tokenized)
+    logging.info("Loaded %d string pairs.", len(pairs))
+
+    float_size = serialized_size(float_model)
+    quantized_size = serialized_size(quantized_model)
+    print(f"Model size: float {float_size / 1e6:.2f} MB, "
+          f"quantized {quantized_size / 1e6:.2f} MB "
+          f"({float_size / quantized_size:.2f}x smaller)")
+
+    float_log_probs, float_time = log_probabilities(float_model, batches)
+    quantized_log_probs, quantized_time = log_probabilities(
+        quantized_model, batches)
+    differences = (float_log_probs - quantized_log_probs).abs()
+    print(f"Log-probability difference: mean {differences.mean():.4f}, "
+          f"max {differences.max():.4f}")
+    print(f"Scoring: float {len(pairs) / float_time:.1f} pairs/s, "
+          f"quantized {len(pairs) / quantized_time:.1f} pairs/s "
+          f"({float_time / quantized_time:.2f}x faster)")
+
+    if isinstance(float_model, EditDistNeuralModelProgressive):
+        targets = [tgt for _, tgt in pairs]
+        for name, model in [
+                ("float", float_model), ("quantized", quantized_model)]:
+            outputs, decoding_time = greedy_outputs(
+                model, batches, tgt_vocab, args.tgt_tokenized)
+            accuracy = sum(
+                hyp == ref for hyp, ref in zip(outputs, targets)) / len(pairs)
+            cer = char_error_rate(outputs, targets, args.tgt_tokenized)
+            print(f"Greedy decoding, {name}: accuracy {accuracy:.4f}, "
+                  f"CER {cer:.4f}, {len(pairs) / decoding_time:.1f} strings/s")
+            if name == "float":
+                float_outputs = outputs
+        agreement = sum(
+            hyp_1 == hyp_2
+            for hyp_1, hyp_2 in zip(float_outputs, outputs)) / len(pairs)
+        print(f"Identical greedy outputs: {agreement:.4f}")
+
+
+if __name__ == "__main__":
+    main()
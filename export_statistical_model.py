@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+"""Export a trained statistical model for the NumPy scorer."""
+
+import argparse
+import logging
+
+import torch
+
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("model", type=argparse.FileType("rb"))
+    parser.add_argument("output", type=str, help="Output .npz file.")
+    args = parser.parse_args()
+
+    model = torch.load(args.model, map_location="cpu")
+    logging.info("Model loaded.")
+    model.export_npz(args.output)
+    logging.info("Model exported to %s.", args.output)
+
+
+if __name__ == "__main__":
+    main()
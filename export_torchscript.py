@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""Export a trained neural model as a TorchScript inference module.
+
+The exported file can be loaded using `torch.jit.load` without the code of
+this repository (see scripted_inference.py for the available methods) and
+it can be used by the inference scripts with the --scripted option.
+"""
+
+import argparse
+import logging
+
+import torch
+
+from scripted_inference import script_model
+
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("model", type=argparse.FileType("rb"))
+    parser.add_argument("output", type=str, help="Output TorchScript file.")
+    args = parser.parse_args()
+
+    model = torch.load(args.model, map_location="cpu")
+    logging.info("Model loaded.")
+    scripted_model = script_model(model)
+    logging.info("Model compiled.")
+    torch.jit.save(scripted_model, args.output)
+    logging.info("Model exported to %s.", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""Build a prefix trie of allowed target strings for constrained decoding.
+
+The trie is stored sparsely in the compressed sparse row format: the children
+of node n are at positions offsets[n] to offsets[n + 1] of the `symbols` and
+`children` arrays, sorted by the symbol. The decoder builds the masks of
+allowed continuations only for the trie nodes of the current hypotheses and
+finds the child nodes by a binary search that is vectorized over all
+hypotheses. Node 0 is a dead node without any continuations, node 1 is the
+root (i.e., the state after the start symbol).
+"""
+
+import argparse
+import logging
+
+import torch
+
+from transliteration_utils import load_vocab
+
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+DEAD_NODE = 0
+ROOT_NODE = 1
+
+
+class LexiconTrie:
+    """Prefix trie over target vocabulary indices.
+
+    Args:
+        offsets: Int32 tensor of shape (node_count + 1,) with the positions
+            of the children of every node in the edge arrays.
+        symbols: Int32 tensor with the symbols of the edges, sorted for
+            every node.
+        children: Int32 tensor with the target nodes of the edges.
+        vocab_size: Size of the target vocabulary.
+    """
+    def __init__(self, offsets, symbols, children, vocab_size):
+        self.offsets = offsets
+        self.symbols = symbols
+        self.children = children
+        self.vocab_size = vocab_size
+        # number of binary search steps needed for the node with most children
+        self.search_steps = int(
+            (offsets[1:] - offsets[:-1]).max()).bit_length()
+
+    @classmethod
+    def from_sequences(cls, sequences, vocab_size, end_id):
+        """Build the trie from sequences of target vocabulary indices.
+
+        Args:
+            sequences: Iterable of lists of target symbol indices, without
+                the start and end symbols.
+            vocab_size: Size of the target vocabulary.
+            end_id: Index of the end symbol that terminates every sequence.
+        """
+        children = [{}, {}]
+        for sequence in sequences:
+            node = ROOT_NODE
+            for symbol in list(sequence) + [end_id]:
+                if symbol not in children[node]:
+                    children[node][symbol] = len(children)
+                    children.append({})
+                node = children[node][symbol]
+
+        offsets = torch.zeros(len(children) + 1, dtype=torch.int32)
+        offsets[1:] = torch.tensor(
+            [len(node_children) for node_children in children],
+            dtype=torch.int32).cumsum(0)
+        edges = [
+            edge for node_children in children
+            for edge in sorted(node_children.items())]
+        symbols = torch.tensor(
+            [symbol for symbol, _ in edges], dtype=torch.int32)
+        child_nodes = torch.tensor(
+            [child for _, child in edges], dtype=torch.int32)
+        return cls(offsets, symbols, child_nodes, vocab_size)
+
+    @classmethod
+    def from_strings(cls, strings, vocab_stoi, vocab_size,
+                     tokenized=False, end_symbol="</s>"):
+        """Build the trie from target strings.
+
+        Strings containing symbols that are not in the vocabulary can never
+        be generated, so they are skipped.
+        """
+        sequences = []
+        skipped = 0
+        for string in strings:
+            symbols = string.split() if tokenized else list(string)
+            if not symbols or any(s not in vocab_stoi for s in symbols):
+                skipped += 1
+                continue
+            sequences.append([vocab_stoi[s] for s in symbols])
+        if skipped:
+            logging.warning(
+                "Skipped %d strings with out-of-vocabulary symbols.", skipped)
+        return cls.from_sequences(
+            sequences, vocab_size, vocab_stoi[end_symbol])
+
+    @property
+    def node_count(self):
+        return self.offsets.size(0) - 1
+
+    def to(self, device):
+        self.offsets = self.offsets.to(device)
+        self.symbols = self.symbols.to(device)
+        self.children = self.children.to(device)
+        return self
+
+    def root_nodes(self, batch_size):
+        return torch.full(
+            (batch_size,), ROOT_NODE, dtype=torch.long,
+            device=self.offsets.device)
+
+    def _edges(self, nodes):
+        """Positions in the edge arrays of all children of the nodes.
+
+        Returns:
+            Tuple of the indices into `nodes` and the edge positions.
+        """
+        starts = self.offsets[nodes].long()
+        counts = self.offsets[nodes + 1].long() - starts
+        rows = torch.repeat_interleave(
+            torch.arange(nodes.size(0), device=nodes.device), counts)
+        row_starts = counts.cumsum(0) - counts
+        positions = (
+            torch.arange(rows.size(0), device=nodes.device) -
+            row_starts[rows] + starts[rows])
+        return rows, positions
+
+    def allowed_mask(self, nodes):
+        """Log-domain mask of allowed next symbols for given trie nodes."""
+        mask = torch.full(
+            (nodes.size(0), self.vocab_size), float("-inf"),
+            device=nodes.device)
+        rows, positions = self._edges(nodes)
+        mask[rows, self.symbols[positions].long()] = 0.
+        return mask
+
+    def advance(self, nodes, symbols):
+        """Move to child nodes. Symbols not in the trie lead to dead node."""
+        starts = self.offsets[nodes].long()
+        ends = self.offsets[nodes + 1].long()
+        if self.symbols.size(0) == 0:
+            return torch.full_like(nodes, DEAD_NODE)
+        last_edge = self.symbols.size(0) - 1
+
+        # lower bound of the symbol among the sorted children of each node
+        low, high = starts, ends
+        for _ in range(self.search_steps):
+            middle = (low + high) // 2
+            active = low < high
+            smaller = self.symbols[middle.clamp(max=last_edge)] < symbols
+            low = torch.where(active & smaller, middle + 1, low)
+            high = torch.where(active & ~smaller, middle, high)
+
+        position = low.clamp(max=last_edge)
+        found = (low < ends) & (self.symbols[position] == symbols)
+        return torch.where(
+            found, self.children[position].long(),
+            torch.full_like(nodes, DEAD_NODE))
+
+    def is_dead(self, nodes):
+        return nodes == DEAD_NODE
+
+    def save(self, path):
+        torch.save({
+            "offsets": self.offsets.cpu(),
+            "symbols": self.symbols.cpu(),
+            "children": self.children.cpu(),
+            "vocab_size": self.vocab_size}, path)
+
+    @classmethod
+    def load(cls, path, device=None):
+        state = torch.load(path, map_location=device)
+        return cls(state["offsets"], state["symbols"], state["children"],
+                   state["vocab_size"])
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("tgt_vocab", type=argparse.FileType("r"))
+    parser.add_argument("lexicon", type=argparse.FileType("r"),
+                        help="File with one allowed target string per line.")
+    parser.add_argument("output", type=str,
+                        help="Path where the trie gets saved.")
+    parser.add_argument("--tgt-tokenized", default=False, action="store_true")
+    args = parser.parse_args()
+
+    tgt_vocab, tgt_stoi = load_vocab(args.tgt_vocab)
+    logging.info("Vocabulary loaded.")
+
+    trie = LexiconTrie.from_strings(
+        (line.strip() for line in args.lexicon), tgt_stoi, len(tgt_vocab),
+        tokenized=args.tgt_tokenized)
+    args.lexicon.close()
+    logging.info("Trie built, it has %d nodes.", trie.node_count)
+
+    trie.save(args.output)
+    logging.info("Trie saved to %s.", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,27 +2,28 @@
 
 from typing import List, Tuple
 
+import copy
+import functools
 import heapq
-from collections import namedtuple
+import time
 
 import torch
 from torch import nn
 from torch.functional import F
 from torch import Tensor
 
-from transformers import BertConfig, BertModel
-from transformers.modeling_bert import BertSelfAttention
-
 from rnn import RNNEncoder, RNNDecoder
 from cnn import CNNEncoder, CNNDecoder
+from concurrency import run_concurrently
+from transformer import (
+    MultiHeadAttention, Transformer, extended_position_embeddings)
+from torchscript_cache import lazy_script
 
 MINF = torch.log(torch.tensor(0.))
 
-
-AttConfig = namedtuple(
-    "AttConfig",
-    ["hidden_size", "num_attention_heads", "output_attentions",
-     "attention_probs_dropout_prob"])
+LOOKUP_TABLES = [
+    "src_state_table", "tgt_state_table",
+    "src_feature_table", "tgt_feature_table"]
 
 
 class EditDistBase(nn.Module):
@@ -88,7 +89,8 @@ class EditDistBase(nn.Module):
         if self.table_type == "full":
             subs_id = (self.src_symbol_count + self.tgt_symbol_count +
                        self.tgt_symbol_count * src_char + tgt_char)
-            assert subs_id < self.n_target_classes
+            assert torch.all(
+                torch.as_tensor(subs_id) < self.n_target_classes)
             return subs_id
         if self.table_type == "tiny":
             return torch.full_like(src_char, 2)
@@ -97,22 +99,22 @@ class EditDistBase(nn.Module):
         raise RuntimeError("Unknown table type.")
 
 
-def get_distortion_mask(max_size=512):
+@functools.lru_cache(maxsize=256)
+def get_distortion_mask(src_len, tgt_len, device=None):
     """Mask to be applied on alpha during training.
 
     The purpose of the distrotion maks is to dicourage the model from making
     states far from diagonal too probable. In other words, discourage the model
     from considering: delete everything and then insert everything to be a good
     output.
-    """
 
-    mask = []
-    for i in range(max_size):
-        row = []
-        for j in range(max_size):
-            row.append(max(0, abs(i - j) - 1))
-        mask.append(row)
-    return torch.tensor(mask).float().unsqueeze(0)
+    The masks are cached for every shape and device, so they must not be
+    modified.
+    """
+    src_positions = torch.arange(src_len, device=device).unsqueeze(1)
+    tgt_positions = torch.arange(tgt_len, device=device).unsqueeze(0)
+    distances = (src_positions - tgt_positions).abs()
+    return (distances - 1).clamp(min=0).float().unsqueeze(0)
 
 
 class NeuralEditDistBase(EditDistBase):
@@ -127,7 +129,7 @@ class NeuralEditDistBase(EditDistBase):
                  table_type="vocab", extra_classes=0,
                  window=3,
                  hidden_dim=32, hidden_layers=2, attention_heads=4,
-                 model_type="transformer",
+                 model_type="transformer", packed_token_budget=None,
                  start_symbol="<s>", end_symbol="</s>", pad_symbol="<pad>"):
         super().__init__(
             src_vocab, tgt_vocab, start_symbol, end_symbol, pad_symbol,
@@ -142,6 +144,7 @@ class NeuralEditDistBase(EditDistBase):
                     "When sharing encoders, vocabularies must be the same.")
 
         self.model_type = model_type
+        self.packed_token_budget = packed_token_budget
         self.device = device
         self.directed = directed
         self.hidden_dim = hidden_dim
@@ -169,8 +172,7 @@ class NeuralEditDistBase(EditDistBase):
         proj_source = 4 * self.hidden_dim if self.directed else self.hidden_dim
 
         if self.directed:
-            self.attention = BertSelfAttention(AttConfig(
-                self.hidden_dim, 4, True, 0.1))
+            self.attention = MultiHeadAttention(self.hidden_dim, 4, 0.1)
 
         self.deletion_logit_proj = nn.Linear(
             proj_source, self.deletion_classes)
@@ -180,14 +182,15 @@ class NeuralEditDistBase(EditDistBase):
             proj_source, self.subs_classes)
         self.extra_proj = nn.Linear(proj_source, self.extra_classes)
 
-        self.distortion_mask = get_distortion_mask().to(device)
-
     def _encoder_for_vocab(self, vocab, directed=False):
         if self.model_type == "transformer":
             return self._transformer_for_vocab(vocab, directed)
         if self.model_type == "rnn":
             return self._rnn_for_vocab(vocab, directed)
         if self.model_type == "bert":
+            # Transformers take long to import, only needed for this model
+            # pylint: disable=import-outside-toplevel
+            from transformers import BertModel
             return BertModel.from_pretrained("bert-base-cased")
         if self.model_type == "embeddings":
             return self._cnn_for_vocab(vocab, directed, hidden=False)
@@ -196,18 +199,11 @@ class NeuralEditDistBase(EditDistBase):
         raise ValueError(f"Uknown model type {self.model_type}.")
 
     def _transformer_for_vocab(self, vocab, directed=False):
-        config = BertConfig(
-            vocab_size=len(vocab),
-            is_decoder=directed,
-            hidden_size=self.hidden_dim,
-            num_hidden_layers=self.hidden_layers,
-            num_attention_heads=self.attention_heads,
-            intermediate_size=2 * self.hidden_dim,
-            hidden_act='relu',
-            hidden_dropout_prob=0.1,
-            attention_probs_dropout_prob=0.1)
-
-        return BertModel(config)
+        return Transformer(
+            len(vocab), self.hidden_dim, self.hidden_layers,
+            self.attention_heads, intermediate_size=2 * self.hidden_dim,
+            is_decoder=directed, dropout=0.1,
+            packed_token_budget=self.packed_token_budget)
 
     def _rnn_for_vocab(self, vocab, directed=False):
         if not directed:
@@ -247,6 +243,132 @@ class NeuralEditDistBase(EditDistBase):
         return self.tgt_encoder(
             inputs, attention_mask=mask)[0]
 
+    def _encode_shared(self, src_sent, tgt_sent):
+        """Encode both sides in a single pass of the shared encoder.
+
+        Every distinct sequence in the source and target batch is encoded
+        only once and the states are then copied to the positions of the
+        string pairs.
+        """
+        src_len, tgt_len = src_sent.size(1), tgt_sent.size(1)
+        max_len = max(src_len, tgt_len)
+        all_sequences = torch.cat((
+            F.pad(src_sent, (0, max_len - src_len), value=self.src_pad),
+            F.pad(tgt_sent, (0, max_len - tgt_len), value=self.tgt_pad)))
+        unique_sequences, inverse = torch.unique(
+            all_sequences, dim=0, return_inverse=True)
+        unique_vectors = self._encode_src(
+            unique_sequences, unique_sequences != self.src_pad)
+
+        src_vectors = unique_vectors[inverse[:src_sent.size(0)], :src_len]
+        tgt_vectors = unique_vectors[inverse[src_sent.size(0):], :tgt_len]
+        return src_vectors, tgt_vectors
+
+    @torch.no_grad()
+    def compile_lookup_tables(self, max_length=128):
+        """Precompute the encoders of an embeddings model into tables.
+
+        With zero CNN layers, the encoder state at a position only depends on
+        the symbol and the position. The states and their projections by
+        the source and target part of the first projection layer are thus
+        precomputed for all symbols and positions up to the maximum length.
+        In evaluation mode, the encoders are then replaced by gathers from
+        the tables. The tables are only used for inference, they are not
+        updated during training, so switching the model into the training
+        mode drops them.
+        """
+        for encoder in [self.src_encoder, self.tgt_encoder]:
+            if (not isinstance(encoder, (CNNEncoder, CNNDecoder)) or
+                    getattr(encoder, "layers", None) != 0):
+                raise ValueError(
+                    "Lookup tables can only be compiled for embeddings "
+                    "models.")
+
+        def state_table(encoder, vocab_size):
+            input_ids = torch.arange(
+                vocab_size, device=self.device).unsqueeze(1).repeat(
+                    1, max_length)
+            return encoder(
+                input_ids, attention_mask=torch.ones_like(input_ids))[0]
+
+        was_training = self.training
+        self.eval()
+        src_states = state_table(self.src_encoder, self.src_symbol_count)
+        tgt_states = state_table(self.tgt_encoder, self.tgt_symbol_count)
+        self.train(was_training)
+        linear = self.projection[1]
+        self.register_buffer("src_state_table", src_states)
+        self.register_buffer("tgt_state_table", tgt_states)
+        self.register_buffer(
+            "src_feature_table",
+            F.linear(src_states, linear.weight[:, :self.hidden_dim]))
+        self.register_buffer(
+            "tgt_feature_table",
+            F.linear(tgt_states, linear.weight[:, self.hidden_dim:],
+                     linear.bias))
+
+    def train(self, mode=True):
+        """Set the training mode, training drops the lookup tables.
+
+        The tables are computed from the parameters at the time of the
+        compilation, further training would make them stale.
+        """
+        if mode:
+            for name in LOOKUP_TABLES:
+                if getattr(self, name, None) is not None:
+                    delattr(self, name)
+        return super().train(mode)
+
+    def extend_position_embeddings(self, size):
+        """Extend the learned position embeddings of the encoders.
+
+        Without extension, positions beyond the learned embedding tables get
+        fixed sinusoidal embeddings. The extended tables are initialized
+        with them, so the model computes the same, but the new positions can
+        be fine-tuned on longer sequences.
+        """
+        for module in self.modules():
+            if isinstance(module, Transformer):
+                module.position_embeddings = extended_position_embeddings(
+                    module.position_embeddings, size)
+            if isinstance(module, (CNNEncoder, CNNDecoder)):
+                module.pos_embeddings = extended_position_embeddings(
+                    module.pos_embeddings, size)
+
+    def quantize(self):
+        """Dynamically quantized copy of the model for CPU inference.
+
+        Weights of all linear layers (the feature projection, the output
+        heads and the projections in the encoders) are stored in int8, the
+        activations are quantized on the fly. Quantized models only run on
+        CPU and cannot be trained.
+        """
+        model = torch.quantization.quantize_dynamic(
+            copy.deepcopy(self).cpu().eval(), {nn.Linear}, dtype=torch.qint8,
+            inplace=True)
+        model.device = torch.device("cpu")
+        return model
+
+    def _lookup_tables_usable(self, max_len):
+        return (not self.training and
+                getattr(self, "src_feature_table", None) is not None and
+                max_len <= self.src_feature_table.size(1))
+
+    def _lookup_features(self, src_sent, tgt_sent):
+        """Encoder states and the feature table from the lookup tables."""
+        src_positions = torch.arange(
+            src_sent.size(1), device=src_sent.device).unsqueeze(0)
+        tgt_positions = torch.arange(
+            tgt_sent.size(1), device=tgt_sent.device).unsqueeze(0)
+        src_features = self.src_feature_table[src_sent, src_positions]
+        tgt_features = self.tgt_feature_table[tgt_sent, tgt_positions]
+        # the rest of the projection after the linear layer: ReLU, LayerNorm
+        feature_table = self.projection[-1](F.relu(
+            src_features.unsqueeze(2) + tgt_features.unsqueeze(1)))
+        return (self.src_state_table[src_sent, src_positions],
+                self.tgt_state_table[tgt_sent, tgt_positions],
+                feature_table)
+
     def _target_class_ids(
             self, src_sent: Tensor, tgt_sent: Tensor):
         """Output classes for input string pair.
@@ -270,13 +392,53 @@ class NeuralEditDistBase(EditDistBase):
         src_len, tgt_len = src_sent.size(1), tgt_sent.size(1)
         src_mask = src_sent != self.src_pad
         tgt_mask = tgt_sent != self.tgt_pad
-        src_vectors = self._encode_src(src_sent, src_mask)
-        tgt_vectors = self._encode_tgt(tgt_sent, tgt_mask, src_vectors, src_mask)
+        feature_table = None
+        if self._lookup_tables_usable(max(src_len, tgt_len)):
+            src_vectors, tgt_vectors, feature_table = self._lookup_features(
+                src_sent, tgt_sent)
+        elif (self.src_encoder is self.tgt_encoder and
+                self.src_pad == self.tgt_pad):
+            # a shared encoder is never a decoder, so the target states do
+            # not depend on the source
+            src_vectors, tgt_vectors = self._encode_shared(
+                src_sent, tgt_sent)
+        elif not self.encoder_decoder_attention and not self.training:
+            # without encoder-decoder attention, the encoders are independent
+            # (in training, the thread hand-off would only slow down the steps)
+            src_vectors, tgt_vectors = run_concurrently(
+                lambda: self._encode_src(src_sent, src_mask),
+                lambda: self._encode_tgt(tgt_sent, tgt_mask, None, None))
+        else:
+            src_vectors = self._encode_src(src_sent, src_mask)
+            tgt_vectors = self._encode_tgt(
+                tgt_sent, tgt_mask, src_vectors, src_mask)
+
+        feature_table = self._pair_features(
+            src_vectors, tgt_vectors, src_mask, feature_table)
+        (action_scores, valid_insertion_logits,
+         valid_subs_logits) = self._action_scores_from_features(feature_table)
 
-        # TODO: do the sort of residual connection I had in Munich
-        feature_table = self.projection(torch.cat((
-            src_vectors.unsqueeze(2).repeat(1, 1, tgt_len, 1),
-            tgt_vectors.unsqueeze(1).repeat(1, src_len, 1, 1)), dim=3))
+        assert action_scores.size(1) == src_len
+        assert action_scores.size(2) == tgt_len
+        assert action_scores.size(3) == self.n_target_classes
+
+        return (src_len, tgt_len, feature_table, action_scores,
+                valid_insertion_logits,
+                valid_subs_logits)
+
+    def _pair_features(self, src_vectors, tgt_vectors, src_mask,
+                       feature_table=None):
+        """Representations of all pairs of source and target positions.
+
+        If the feature table is given (from the lookup tables), only the
+        directed attention features are added to it.
+        """
+        src_len, tgt_len = src_vectors.size(1), tgt_vectors.size(1)
+        if feature_table is None:
+            # TODO: do the sort of residual connection I had in Munich
+            feature_table = self.projection(torch.cat((
+                src_vectors.unsqueeze(2).repeat(1, 1, tgt_len, 1),
+                tgt_vectors.unsqueeze(1).repeat(1, src_len, 1, 1)), dim=3))
 
         if self.directed:
             unsq_enc_att_mask = (
@@ -291,7 +453,15 @@ class NeuralEditDistBase(EditDistBase):
                  tgt_vectors.unsqueeze(1).repeat(1, src_len, 1, 1),
                  att_output.unsqueeze(1).repeat(1, src_len, 1, 1)),
                 dim=3)
+        return feature_table
+
+    def _action_scores_from_features(self, feature_table):
+        """Log-probabilities of the edit actions from the feature table.
 
+        Returns:
+            The action scores and the insertion and subsitution logits for
+            the positions where the actions are possible.
+        """
         # DELETION <<<
         valid_deletion_logits = self.deletion_logit_proj(feature_table[:, :-1])
         deletion_padding = torch.full_like(valid_deletion_logits[:, :1], MINF)
@@ -329,14 +499,7 @@ class NeuralEditDistBase(EditDistBase):
 
         action_scores = F.log_softmax(torch.cat(
             actions_to_concat, dim=3), dim=3)
-
-        assert action_scores.size(1) == src_len
-        assert action_scores.size(2) == tgt_len
-        assert action_scores.size(3) == self.n_target_classes
-
-        return (src_len, tgt_len, feature_table, action_scores,
-                valid_insertion_logits,
-                valid_subs_logits)
+        return action_scores, valid_insertion_logits, valid_subs_logits
 
     def _forward_evaluation(
             self,
@@ -387,7 +550,7 @@ class NeuralEditDistBase(EditDistBase):
 
     def _alpha_distortion_penalty(self, src_len, tgt_len, alpha_table):
         """Penalty for the alphas being too high outside from the diagonal."""
-        penalties = self.distortion_mask[:, :src_len, :tgt_len]
+        penalties = get_distortion_mask(src_len, tgt_len, alpha_table.device)
         return alpha_table.exp() * penalties
 
     @torch.no_grad()
@@ -481,7 +644,7 @@ class EditDistNeuralModelConcurrent(NeuralEditDistBase):
     def __init__(self, src_vocab, tgt_vocab, device, directed=False,
                  hidden_dim=32, hidden_layers=2, attention_heads=4,
                  share_encoders=False,
-                 model_type="transformer",
+                 model_type="transformer", packed_token_budget=None,
                  start_symbol="<s>", end_symbol="</s>", pad_symbol="<pad>"):
         super().__init__(
             src_vocab, tgt_vocab, device, directed,
@@ -491,7 +654,8 @@ class EditDistNeuralModelConcurrent(NeuralEditDistBase):
             attention_heads=attention_heads,
             table_type="tiny", extra_classes=1,
             start_symbol=start_symbol, end_symbol=end_symbol,
-            pad_symbol=pad_symbol, model_type=model_type)
+            pad_symbol=pad_symbol, model_type=model_type,
+            packed_token_budget=packed_token_budget)
 
     def forward(self, src_sent, tgt_sent):
         batch_size = src_sent.size(0)
@@ -542,6 +706,7 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
                  hidden_dim=32, hidden_layers=2, attention_heads=4,
                  window=3,
                  encoder_decoder_attention=True, model_type="transformer",
+                 packed_token_budget=None,
                  start_symbol="<s>", end_symbol="</s>", pad_symbol="<pad>"):
         super().__init__(
             src_vocab, tgt_vocab, device, directed, table_type="vocab",
@@ -549,6 +714,7 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             encoder_decoder_attention=encoder_decoder_attention,
             hidden_dim=hidden_dim, hidden_layers=hidden_layers,
             attention_heads=attention_heads, window=window,
+            packed_token_budget=packed_token_budget,
             start_symbol=start_symbol, end_symbol=end_symbol,
             pad_symbol=pad_symbol)
 
@@ -594,7 +760,8 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
 
     @torch.no_grad()
     def _scores_for_next_step(
-            self, b_range, v, feature_table, log_src_mask, alpha):
+            self, b_range, v, feature_table, log_src_mask, alpha,
+            shortlist=None):
         """Predict scores of next symbol, given the decoding history.
 
         The decoding history is already in the feature table that contains also
@@ -606,10 +773,16 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             feature_table: Representation of symbol pairs.
             log_src_mask: Position maks for the input in the log domain.
             alpha: Table with state probabilties.
+            shortlist: Optional tuple of target symbol indices and their
+                log-domain mask for each batch element. If provided, only
+                these symbols are scored and the others get -inf.
 
         Returns:
             Logits for the next symbols.
         """
+        if shortlist is not None:
+            return self._shortlisted_scores_for_next_step(
+                b_range, v, feature_table, log_src_mask, alpha, shortlist)
 
         insertion_scores = (
             F.log_softmax(
@@ -630,6 +803,42 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
 
         return next_symb_scores
 
+    @torch.no_grad()
+    def _shortlisted_scores_for_next_step(
+            self, b_range, v, feature_table, log_src_mask, alpha, shortlist):
+        """Same as `_scores_for_next_step`, but only for shortlisted symbols.
+
+        The log-probabilities are normalized over the whole target
+        vocabulary, so the shortlisted symbols get the same scores as without
+        the shortlist and the shortlist only restricts the search.
+        """
+        shortlist_ids, shortlist_mask = shortlist
+        features = feature_table[b_range, :, v - 1]
+
+        def shortlist_log_probs(projection, states):
+            log_probs = F.log_softmax(projection(states), dim=-1)
+            return (
+                log_probs.gather(2, shortlist_ids.unsqueeze(1).expand(
+                    -1, states.size(1), -1))
+                + shortlist_mask.unsqueeze(1))
+
+        insertion_scores = (
+            shortlist_log_probs(self.insertion_proj, features)
+            + log_src_mask.unsqueeze(2)
+            + alpha[:, :, v - 1].unsqueeze(2))
+        subs_scores = (
+            shortlist_log_probs(self.substitution_proj, features[:, 1:])
+            + log_src_mask[:, 1:].unsqueeze(2)
+            + alpha[:, 1:, v - 1].unsqueeze(2))
+        shortlist_scores = torch.cat(
+            (insertion_scores, subs_scores), dim=1).logsumexp(1)
+
+        next_symb_scores = torch.full(
+            (shortlist_ids.size(0), self.tgt_symbol_count), MINF,
+            device=shortlist_scores.device)
+        next_symb_scores.scatter_(1, shortlist_ids, shortlist_scores)
+        return next_symb_scores.unsqueeze(1)
+
     @torch.no_grad()
     def _update_alpha_with_new_row(
             self, batch_size, b_range, v, alpha, action_scores, src_sent,
@@ -681,7 +890,49 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
         return alpha
 
     @torch.no_grad()
-    def decode(self, src_sent):
+    def _initial_alpha(
+            self, batch_size, b_range, action_scores, src_sent, src_len,
+            log_src_mask):
+        """Alpha table for the target prefix consisting of the start symbol.
+
+        Args:
+            batch_size: Number of sequences in the batch.
+            b_range: Technical thing: tensor 0..batch_size
+            action_scores: Table with scores for particular edit actions.
+            src_sent: Source sequence.
+            src_len: Max lenght of the source sequences.
+            log_src_mask: Position maks for the input in the log domain.
+
+        Returns:
+            Alpha table with a single column.
+        """
+        alpha = torch.full((batch_size, src_len, 1), MINF).to(self.device)
+        for t, src_char in enumerate(src_sent.transpose(0, 1)):
+            if t == 0:
+                alpha[:, :, 0] = log_src_mask
+                continue
+            deletion_id = self._deletion_id(src_char)
+            alpha[:, t, 0] = (
+                action_scores[b_range, t, 0, deletion_id] + alpha[:, t - 1, 0])
+        return alpha
+
+    @torch.no_grad()
+    def decode(self, src_sent, time_budget=None):
+        """Greedy decoding.
+
+        Args:
+            src_sent: Source sequence.
+            time_budget: Optional time limit in seconds. The clock is checked
+                between decoding steps and if the limit is exceeded, the
+                decoding stops with partially decoded sequences.
+
+        Returns:
+            Decoded target sequences. If a time budget is given, also a
+            boolean tensor saying which sequences were truncated.
+        """
+        deadline = None
+        if time_budget is not None:
+            deadline = time.monotonic() + time_budget
         batch_size = src_sent.size(0)
         b_range = torch.arange(batch_size)
 
@@ -694,14 +945,9 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             torch.zeros_like(src_sent, dtype=torch.float))
 
         # special case, v = 0
-        alpha = torch.full((batch_size, src_len, 1), MINF).to(self.device)
-        for t, src_char in enumerate(src_sent.transpose(0, 1)):
-            if t == 0:
-                alpha[:, :, 0] = log_src_mask
-                continue
-            deletion_id = self._deletion_id(src_char)
-            alpha[:, t, 0] = (
-                action_scores[b_range, t, 0, deletion_id] + alpha[:, t - 1, 0])
+        alpha = self._initial_alpha(
+            batch_size, b_range, action_scores, src_sent, src_len,
+            log_src_mask)
 
         finished = torch.full(
             [batch_size], False, dtype=torch.bool).to(self.device)
@@ -730,11 +976,169 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             # expand the target sequence
             if torch.all(finished):
                 break
+            if deadline is not None and time.monotonic() > deadline:
+                return tgt_sent, finished.logical_not()
 
+        if deadline is not None:
+            return tgt_sent, torch.zeros_like(finished)
         return tgt_sent
 
     @torch.no_grad()
-    def beam_search(self, src_sent, beam_size=10, len_norm=1.0):
+    def speculative_decode(self, src_sent, draft_model, draft_steps=4):
+        """Greedy decoding with a cheap draft model proposing symbols.
+
+        The draft model (the statistical model) greedily proposes several
+        symbols ahead. All of them are scored by a single pass of the neural
+        model and the longest prefix on which the neural model agrees is
+        accepted, followed by the neural model's own next symbol. Because the
+        target encoder is causal, the output is the same as with `decode`.
+
+        Args:
+            src_sent: Source sequence.
+            draft_model: Trained EditDistStatModel with the same kind of
+                vocabularies (symbols are mapped by their strings).
+            draft_steps: Number of symbols proposed at once.
+
+        Returns:
+            Decoded target sequences.
+        """
+        if not self.directed:
+            raise ValueError(
+                "Speculative decoding requires a directed target encoder.")
+        if draft_steps < 1:
+            raise ValueError("At least one draft step is needed.")
+
+        batch_size = src_sent.size(0)
+        b_range = torch.arange(batch_size)
+        max_len = 2 * src_sent.size(1)
+
+        # map symbols between the neural and the statistical vocabularies
+        draft_device = draft_model.weights.device
+        src_to_draft = torch.tensor(
+            [draft_model.src_vocab[s] for s in self.src_vocab.itos],
+            device=draft_device)
+        tgt_to_draft = torch.tensor(
+            [draft_model.tgt_vocab[s] for s in self.tgt_vocab.itos],
+            device=draft_device)
+        tgt_from_draft = torch.tensor(
+            [self.tgt_vocab[s] for s in draft_model.tgt_vocab.itos],
+            device=self.device)
+        draft_src = src_to_draft[src_sent.to(draft_device)]
+
+        tgt_sent = torch.tensor([[self.tgt_bos]] * batch_size).to(self.device)
+        (src_len, _, feature_table,
+         action_scores, _, _) = self._action_scores(src_sent, tgt_sent)
+        log_src_mask = torch.where(
+            src_sent == self.src_pad,
+            torch.full_like(src_sent, MINF, dtype=torch.float),
+            torch.zeros_like(src_sent, dtype=torch.float))
+        alpha = self._initial_alpha(
+            batch_size, b_range, action_scores, src_sent, src_len,
+            log_src_mask)
+        draft_alpha = draft_model.alpha_first_column(draft_src)
+
+        finished = torch.full(
+            [batch_size], False, dtype=torch.bool).to(self.device)
+        while tgt_sent.size(1) < max_len and not torch.all(finished):
+            # PROPOSE: draft symbols by the statistical model
+            draft_symbols = []
+            draft_alphas = []
+            draft_finished = finished
+            next_draft_alpha = draft_alpha
+            for _ in range(min(draft_steps, max_len - tgt_sent.size(1) - 1)):
+                draft_symbol = draft_model.next_symbol_scores(
+                    draft_src, next_draft_alpha).argmax(1)
+                next_draft_alpha = draft_model.alpha_next_column(
+                    draft_src, next_draft_alpha, draft_symbol)
+                symbol = torch.where(
+                    draft_finished,
+                    torch.full_like(finished, self.tgt_pad, dtype=torch.long),
+                    tgt_from_draft[draft_symbol.to(self.device)])
+                draft_finished = draft_finished + (symbol == self.tgt_eos)
+                draft_symbols.append(symbol)
+                draft_alphas.append(next_draft_alpha)
+                if torch.all(draft_finished):
+                    break
+
+            # VERIFY: one pass of the neural model over all proposals
+            candidate = torch.cat(
+                [tgt_sent] + [s.unsqueeze(1) for s in draft_symbols], dim=1)
+            (src_len, _, feature_table,
+             action_scores, _, _) = self._action_scores(src_sent, candidate)
+
+            # the last symbol from the previous round has not been added to
+            # the alpha table yet because it was not covered by the features
+            if alpha.size(2) < tgt_sent.size(1):
+                alpha = self._update_alpha_with_new_row(
+                    batch_size, b_range, alpha.size(2), alpha, action_scores,
+                    src_sent, candidate, src_len)
+
+            for j in range(len(draft_symbols) + 1):
+                v = tgt_sent.size(1)
+                next_symb_scores = self._scores_for_next_step(
+                    b_range, v, feature_table, log_src_mask, alpha)
+                next_symbol = torch.where(
+                    finished,
+                    torch.full_like(finished, self.tgt_pad, dtype=torch.long),
+                    next_symb_scores.argmax(2).squeeze(1))
+                tgt_sent = torch.cat(
+                    (tgt_sent, next_symbol.unsqueeze(1)), dim=1)
+                finished = finished + (next_symbol == self.tgt_eos)
+
+                if (j == len(draft_symbols) or
+                        not torch.equal(next_symbol, draft_symbols[j])):
+                    # The proposal was rejected (or there are no more of
+                    # them), the features of the new symbol will be computed
+                    # in the next round.
+                    draft_alpha = draft_model.alpha_next_column(
+                        draft_src, draft_alpha,
+                        tgt_to_draft[next_symbol.to(draft_device)])
+                    break
+
+                alpha = self._update_alpha_with_new_row(
+                    batch_size, b_range, v, alpha, action_scores,
+                    src_sent, candidate, src_len)
+                draft_alpha = draft_alphas[j]
+                if torch.all(finished):
+                    break
+
+        return tgt_sent
+
+    @torch.no_grad()
+    def beam_search(self, src_sent, beam_size=10, len_norm=1.0, n_best=None,
+                    lexicon=None, shortlist=None, time_budget=None):
+        """Beam search over target symbols.
+
+        Args:
+            src_sent: Batch of source sequences.
+            beam_size: Number of hypotheses kept in every step.
+            len_norm: Exponent of the length normalization.
+            n_best: If set, return the n best hypotheses with their scores
+                instead of only the best hypothesis.
+            lexicon: Optional LexiconTrie; if provided, only strings from the
+                lexicon can be generated.
+            shortlist: Optional TargetShortlist; if provided, only target
+                symbols likely given the source symbols are scored.
+            time_budget: Optional time limit in seconds. The clock is checked
+                between decoding steps and if the limit is exceeded, the
+                search stops. The hypotheses stay ranked by their normalized
+                scores, so a finished one is only preferred if it beats the
+                unfinished ones.
+
+        Returns:
+            The best decoded sequence for each input. If n_best is set, a
+            tuple of decoded hypotheses of shape (batch, n_best, length),
+            their unnormalized scores and their length-normalized scores,
+            both of shape (batch, n_best). If a time budget is given, a
+            boolean tensor saying which of the returned hypotheses were
+            truncated is added (as the last item of the tuple).
+        """
+        deadline = None
+        if time_budget is not None:
+            deadline = time.monotonic() + time_budget
+        if n_best is not None and not 0 < n_best <= beam_size:
+            raise ValueError(
+                "The n-best list size must be between 1 and the beam size.")
         batch_size = src_sent.size(0)
         b_range = torch.arange(batch_size)
 
@@ -763,6 +1167,7 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
         # INITIALIZE THE BEAM SEARCH
         cur_len = 1
         current_beam = 1
+        deadline_exceeded = False
         finished = torch.full(
             (batch_size, 1, 1), False, dtype=torch.bool).to(self.device)
         scores = torch.zeros((batch_size, 1)).to(self.device)
@@ -770,9 +1175,39 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
         flat_decoded = decoded.reshape(batch_size, cur_len)
         flat_finished = finished.reshape(batch_size, cur_len)
         flat_alpha = alpha.reshape(batch_size, src_len, 1)
+        if lexicon is not None:
+            flat_nodes = lexicon.root_nodes(batch_size)
+        shortlist_ids, shortlist_mask = None, None
+        if shortlist is not None:
+            shortlist_ids, shortlist_mask = shortlist.for_batch(
+                src_sent, device=self.device)
+        finished_continuation = torch.full(
+            (1, self.tgt_symbol_count), MINF).to(self.device)
+        finished_continuation[0, self.tgt_pad] = 0.
+        special_symbols_mask = torch.zeros(
+            (1, self.tgt_symbol_count)).to(self.device)
+        special_symbols_mask[0, [self.tgt_bos, self.tgt_pad]] = MINF
         while cur_len < 2 * src_len:
             next_symb_scores = self._scores_for_next_step(
-                b_range, cur_len, feature_table, log_src_mask, flat_alpha)
+                b_range, cur_len, feature_table, log_src_mask, flat_alpha,
+                shortlist=(
+                    None if shortlist is None
+                    else (shortlist_ids, shortlist_mask)))
+
+            # restrict unfinished hypotheses to continuations in the lexicon
+            if lexicon is not None:
+                lexicon_mask = torch.where(
+                    flat_finished[:, -1:],
+                    torch.zeros_like(next_symb_scores[:, 0]),
+                    lexicon.allowed_mask(flat_nodes))
+                next_symb_scores = next_symb_scores + lexicon_mask.unsqueeze(1)
+
+            # finished hypotheses only continue with padding for free, so
+            # their scores do not change and each takes a single beam slot,
+            # unfinished ones cannot continue with the start or padding
+            next_symb_scores = torch.where(
+                flat_finished[:, -1:].unsqueeze(2), finished_continuation,
+                next_symb_scores + special_symbols_mask)
 
             # get scores of all expanded hypotheses
             candidate_scores = (
@@ -783,7 +1218,7 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             normed_scores = candidate_scores / norm_factor
 
             # reshape for beam members and get top k
-            _, best_indices = normed_scores.reshape(
+            best_normed_scores, best_indices = normed_scores.reshape(
                 batch_size, -1).topk(beam_size, dim=-1)
             next_symbol_ids = best_indices % self.tgt_symbol_count
             hypothesis_ids = best_indices // self.tgt_symbol_count
@@ -806,18 +1241,32 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             finished_now = (
                 (next_symbol_ids.view(-1, 1) == self.tgt_eos)
                 + reordered_finished[:, -1:])
+            if lexicon is not None:
+                reordered_nodes = flat_nodes.index_select(
+                    0, global_best_indices)
+                flat_nodes = torch.where(
+                    reordered_finished[:, -1],
+                    reordered_nodes,
+                    lexicon.advance(
+                        reordered_nodes, next_symbol_ids.view(-1)))
+                # hypotheses that left the lexicon (only happens when there
+                # are fewer valid strings than the beam size) cannot continue
+                finished_now += lexicon.is_dead(flat_nodes).unsqueeze(1)
             finished = torch.cat((
                 reordered_finished,
                 finished_now), dim=1).reshape(batch_size, beam_size, -1)
             flat_alpha = flat_alpha.index_select(0, global_best_indices)
 
-            if finished_now.all():
-                break
-
             # re-order scores
             scores = candidate_scores.reshape(
                 batch_size, -1).gather(-1, best_indices)
 
+            if finished_now.all():
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                deadline_exceeded = True
+                break
+
             # TODO need to be done better fi we want lenght normalization
 
             # tile encoder after first step
@@ -827,6 +1276,11 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
                 log_src_mask = log_src_mask.unsqueeze(1).repeat(
                     1, beam_size, 1).reshape(batch_size * beam_size, -1)
                 b_range = torch.arange(batch_size * beam_size).to(self.device)
+                if shortlist is not None:
+                    shortlist_ids = shortlist_ids.unsqueeze(1).repeat(
+                        1, beam_size, 1).reshape(batch_size * beam_size, -1)
+                    shortlist_mask = shortlist_mask.unsqueeze(1).repeat(
+                        1, beam_size, 1).reshape(batch_size * beam_size, -1)
 
             # prepare feature and alpha for the next step
             flat_decoded = decoded.reshape(-1, cur_len + 1)
@@ -843,7 +1297,18 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             current_beam = beam_size
             cur_len += 1
 
-        return decoded[:, 0]
+        if deadline is None:
+            if n_best is not None:
+                return (decoded[:, :n_best], scores[:, :n_best],
+                        best_normed_scores[:, :n_best])
+            return decoded[:, 0]
+
+        # only hypotheses cut short by the deadline count as truncated
+        truncated = finished[:, :, -1].logical_not() * deadline_exceeded
+        if n_best is not None:
+            return (decoded[:, :n_best], scores[:, :n_best],
+                    best_normed_scores[:, :n_best], truncated[:, :n_best])
+        return decoded[:, 0], truncated[:, 0]
 
     @torch.no_grad()
     def operation_decoding(self, src_sent):
@@ -906,8 +1371,51 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
                 break
         return tgt_sent
 
+    @staticmethod
+    def _recombine_hypotheses(hypotheses, recombination="sum"):
+        """Merge operation-level hypotheses that reached the same state.
+
+        Different operation sequences (e.g., substitution vs. insertion
+        followed by deletion) can end up in the same edit state, i.e., the same
+        target prefix, the same position in the source sequence and the same
+        finished flag (a finished hypothesis is never merged into one that
+        can still be extended). Such
+        hypotheses are merged into one whose score is either the log-sum-exp
+        of the merged scores or their maximum (Viterbi mode).
+
+        Args:
+            hypotheses: List of tuples: target sequence, t, v, finished, score.
+            recombination: Either "sum" or "max".
+
+        Returns:
+            List of hypotheses with unique states.
+        """
+        if recombination not in ["sum", "max"]:
+            raise ValueError(f"Unknown recombination: {recombination}")
+
+        merged = {}
+        for hypothesis in hypotheses:
+            tgt_sent, t, _, finished, score = hypothesis
+            state = (tuple(tgt_sent[0].tolist()), int(t), bool(finished))
+            if state not in merged:
+                merged[state] = hypothesis
+                continue
+
+            prev_tgt_sent, prev_t, prev_v, prev_finished, prev_score = (
+                merged[state])
+            prev_score = torch.as_tensor(prev_score, dtype=torch.float)
+            score = torch.as_tensor(score, dtype=torch.float)
+            if recombination == "max":
+                new_score = torch.max(prev_score, score)
+            else:
+                new_score = torch.logaddexp(prev_score, score)
+            merged[state] = (
+                prev_tgt_sent, prev_t, prev_v, prev_finished, new_score)
+
+        return list(merged.values())
+
     @torch.no_grad()
-    def operation_beam_search(self, src_sent, beam_size):
+    def operation_beam_search(self, src_sent, beam_size, recombination=None):
         """Decode sequeence by operation sampling.
 
         Instead of sampling from symbol distributions, it samples directly
@@ -915,6 +1423,10 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
 
         Args:
             at_sent: Source sequence.
+            beam_size: Number of hypotheses kept after each step.
+            recombination: How to merge hypotheses that reach the same
+                edit state: "sum" (log-sum-exp), "max" (Viterbi), or None
+                (default) for no recombination.
 
         Returns:
             Decoded target string.
@@ -930,15 +1442,21 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
             _, _, tgt_pos, _, score_sum = hypothesis
             return score_sum / (tgt_pos + 1)
 
-        for _ in range(1, 2 * src_sent.size(1)):
+        src_len = src_sent.size(1)
+        for _ in range(1, 2 * src_len):
+            # Hypotheses that only differ in the source position share
+            # the target prefix and therefore also the feature table.
+            feature_tables = {}
             for tgt_sent, t, v, finished, score in beam:
                 if finished:
                     next_candidates.append((tgt_sent, t, v, finished, score))
                     continue
 
-                (src_len, _, feature_table, _, _, _) = self._action_scores(
-                    src_sent, tgt_sent)
-                state = feature_table[0, t, v]
+                tgt_key = tuple(tgt_sent[0].tolist())
+                if tgt_key not in feature_tables:
+                    feature_tables[tgt_key] = self._action_scores(
+                        src_sent, tgt_sent)[2]
+                state = feature_tables[tgt_key][0, t, v]
 
                 if t >= src_len - 1:
                     deletion_score = MINF.unsqueeze(0).to(self.device)
@@ -974,6 +1492,9 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
                         next_symbol == self.tgt_eos,
                         score + op_score))
 
+            if recombination is not None:
+                next_candidates = self._recombine_hypotheses(
+                    next_candidates, recombination)
             beam = heapq.nlargest(
                 beam_size, next_candidates, key=score_fn)
             next_candidates = []
@@ -983,7 +1504,7 @@ class EditDistNeuralModelProgressive(NeuralEditDistBase):
         return max(beam, key=score_fn)[0]
 
 
-@torch.jit.script
+@lazy_script
 def _torchscript_forward_evaluation(
         all_deletion_ids: Tensor,
         all_insertion_ids: Tensor,
@@ -1038,7 +1559,7 @@ def _torchscript_forward_evaluation(
     return alpha_tensor
 
 
-@torch.jit.script
+@lazy_script
 def _torchscript_backward_evaluation(
         src_len: int,
         tgt_len: int,
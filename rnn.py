@@ -1,18 +1,52 @@
 """RNN Encoder and Decoder with the same call API as Transformers."""
 
 
-from collections import namedtuple
-
+import torch
 from torch import nn
 from torch.functional import F
 
-from transformers.modeling_bert import BertSelfAttention
+from transformer import MultiHeadAttention
+
+
+def pack(sequence, lengths):
+    """Pack a padded batch and get positions of its elements.
+
+    The batch is sorted and packed only once for the whole stack of layers.
+    Between the layers, only the data of the packed sequence are used and
+    the positions allow scattering them back into a padded batch without
+    sorting again.
+
+    Returns:
+        The packed sequence and indices of the packed elements in the
+        flattened padded batch.
+    """
+    packed = nn.utils.rnn.pack_padded_sequence(
+        sequence, lengths.cpu(), batch_first=True, enforce_sorted=False)
 
+    batch_sizes = packed.batch_sizes
+    time_steps = torch.arange(batch_sizes.size(0)).repeat_interleave(
+        batch_sizes)
+    offsets = batch_sizes.cumsum(0) - batch_sizes
+    slots = torch.arange(time_steps.size(0)) - offsets[time_steps]
+    batch_ids = slots.to(sequence.device)
+    if packed.sorted_indices is not None:
+        batch_ids = packed.sorted_indices[batch_ids]
+    positions = batch_ids * sequence.size(1) + time_steps.to(sequence.device)
+    return packed, positions
 
-AttConfig = namedtuple(
-    "AttConfig",
-    ["hidden_size", "num_attention_heads", "output_attentions",
-     "attention_probs_dropout_prob"])
+
+def with_data(packed, data):
+    """Packed sequence with the same structure and new data."""
+    return nn.utils.rnn.PackedSequence(
+        data, packed.batch_sizes, packed.sorted_indices,
+        packed.unsorted_indices)
+
+
+def unpack(data, positions, batch_size, max_len):
+    """Scatter data of a packed sequence into a zero-padded batch."""
+    padded = data.new_zeros((batch_size * max_len, data.size(1)))
+    padded.index_copy_(0, positions, data)
+    return padded.view(batch_size, max_len, -1)
 
 
 class RNNEncoder(nn.Module):
@@ -41,34 +75,25 @@ class RNNEncoder(nn.Module):
             for _ in range(num_layers - 1)])
 
     def forward(self, input_sequence, attention_mask):
-        input_lengths = attention_mask.sum(1)
-
+        batch_size, max_len = input_sequence.size()
         word_embeddings = self.dropout(self.embeddings(input_sequence))
-        packed_embeddings = nn.utils.rnn.pack_padded_sequence(
-            word_embeddings, input_lengths.cpu(), batch_first=True,
-            enforce_sorted=False)
-
-        # Run the packed embeddings through the GRU, and then unpack the
-        # sequences
-        outputs, _ = self.first_gru(packed_embeddings)
-        outputs, _ = nn.utils.rnn.pad_packed_sequence(
-            outputs, batch_first=True)
+        packed_embeddings, positions = pack(
+            word_embeddings, attention_mask.sum(1))
+
+        # Run the packed embeddings through the GRUs, the residual
+        # connections and normalization work directly with the packed data
+        packed_outputs, _ = self.first_gru(packed_embeddings)
         outputs = self.norms[0](self.dropout(
-            outputs[:, :, :self.hidden_size] +
-            outputs[:, :, self.hidden_size:]))
+            packed_outputs.data[:, :self.hidden_size] +
+            packed_outputs.data[:, self.hidden_size:]))
 
         for gru, norm in zip(self.other_grus, self.norms[1:]):
-            packed_outputs = nn.utils.rnn.pack_padded_sequence(
-                outputs, input_lengths.cpu(), batch_first=True,
-                enforce_sorted=False)
-            next_outputs, _ = gru(packed_outputs)
-            next_outputs, _ = nn.utils.rnn.pad_packed_sequence(
-                next_outputs, batch_first=True)
-            next_outputs = (next_outputs[:, :, :self.hidden_size] +
-                            next_outputs[:, :, self.hidden_size:])
+            next_outputs, _ = gru(with_data(packed_embeddings, outputs))
+            next_outputs = (next_outputs.data[:, :self.hidden_size] +
+                            next_outputs.data[:, self.hidden_size:])
             outputs = norm(outputs + self.dropout(next_outputs))
 
-        return outputs, None
+        return unpack(outputs, positions, batch_size, max_len), None
 
 
 def dot_score(hidden_state, encoder_states):
@@ -122,8 +147,7 @@ class RNNDecoder(nn.Module):
                 Attention(hidden_size) for _ in range(num_layers)])
         elif use_attention:
             self.attn = nn.ModuleList([
-                BertSelfAttention(AttConfig(
-                    hidden_size, attention_heads, True, 0.1))
+                MultiHeadAttention(hidden_size, attention_heads, 0.1)
                 for _ in range(num_layers)])
 
         self.other_grus = nn.ModuleList([
@@ -139,55 +163,51 @@ class RNNDecoder(nn.Module):
 
     def forward(self, input_ids, attention_mask, encoder_hidden_states=None,
                 encoder_attention_mask=None):
-        input_lengths = attention_mask.sum(1)
-
+        batch_size, max_len = input_ids.size()
         word_embeddings = self.dropout(self.embeddings(input_ids))
-        packed_embeddings = nn.utils.rnn.pack_padded_sequence(
-            word_embeddings, input_lengths.cpu(), batch_first=True,
-            enforce_sorted=False)
-
-        # Run the packed embeddings through the GRU, and then unpack
-        # the sequences
-        outputs, _ = self.first_gru(packed_embeddings)
-        outputs, _ = nn.utils.rnn.pad_packed_sequence(
-            outputs, batch_first=True)
-        outputs = self.rnn_norms[0](self.dropout(outputs))
+        packed_embeddings, positions = pack(
+            word_embeddings, attention_mask.sum(1))
 
-        attentions = []
         if encoder_hidden_states is not None:
             unsq_enc_att_mask = (
                 encoder_attention_mask.unsqueeze(1).unsqueeze(1))
-            att_output = self.attn[0](
-                outputs, encoder_hidden_states=encoder_hidden_states,
+
+        def attend(att, outputs):
+            # attention needs the padded batch, the packed data are scattered
+            # there using the precomputed positions (no re-sorting)
+            att_output = att(
+                unpack(outputs, positions, batch_size, max_len),
+                encoder_hidden_states=encoder_hidden_states,
                 encoder_attention_mask=unsq_enc_att_mask)
-            context = att_output[0]
+            context = att_output[0].reshape(
+                batch_size * max_len, -1).index_select(0, positions)
             att_dist = att_output[1] if len(att_output) > 1 else None
+            return context, att_dist
+
+        # Run the packed embeddings through the GRUs, the residual
+        # connections and normalization work directly with the packed data
+        packed_outputs, _ = self.first_gru(packed_embeddings)
+        outputs = self.rnn_norms[0](self.dropout(packed_outputs.data))
+
+        attentions = []
+        if encoder_hidden_states is not None:
+            context, att_dist = attend(self.attn[0], outputs)
             outputs = self.ctx_norms[0](outputs + self.dropout(context))
             attentions.append((None, att_dist))
 
         for gru, att, rnn_norm, ctx_norm in zip(
                 self.other_grus, self.attn[1:],
                 self.rnn_norms[1:], self.ctx_norms[1:]):
-            packed_outputs = nn.utils.rnn.pack_padded_sequence(
-                outputs, input_lengths.cpu(), batch_first=True,
-                enforce_sorted=False)
-            next_outputs, _ = gru(packed_outputs)
-            next_outputs, _ = nn.utils.rnn.pad_packed_sequence(
-                next_outputs, batch_first=True)
-            outputs = rnn_norm(outputs + self.dropout(next_outputs))
+            next_outputs, _ = gru(with_data(packed_embeddings, outputs))
+            outputs = rnn_norm(outputs + self.dropout(next_outputs.data))
 
             if encoder_hidden_states is not None:
-                unsq_enc_att_mask = (
-                    encoder_attention_mask.unsqueeze(1).unsqueeze(1))
-                att_output = att(
-                    outputs, encoder_hidden_states=encoder_hidden_states,
-                    encoder_attention_mask=unsq_enc_att_mask)
-                context = att_output[0]
-                att_dist = att_output[1] if len(att_output) > 1 else None
+                context, att_dist = attend(att, outputs)
                 outputs = ctx_norm(outputs + self.dropout(context))
                 attentions.append((None, att_dist))
 
         if self.output_proj is not None:
             outputs = self.output_proj(outputs)
 
+        outputs = unpack(outputs, positions, batch_size, max_len)
         return outputs, None, attentions
@@ -18,6 +18,122 @@ mkdir -p test_outputs
 
 ./train_transliteration_generation.py --model-type transformer --hidden-size 16 --nll-loss 1.0 --sampled-em-loss 0.0 data/test_generation --distortion-loss 0.0 --final-state-loss 0.0 --batch-size 20 --delay-update 2 --epochs 2 --validation-frequency 5 --em-loss 1.0 --log-directory test_outputs
 
+./train_transliteration_generation.py --model-type transformer --hidden-size 16 --nll-loss 1.0 --sampled-em-loss 0.0 data/test_generation --distortion-loss 0.0 --final-state-loss 0.0 --batch-size 20 --delay-update 2 --epochs 2 --validation-frequency 5 --em-loss 1.0 --no-enc-dec-att --packed-token-budget 32 --log-directory test_outputs
+
+# STATISTICAL MODELS =========================================================
+
+# Full-batch EM must not decrease the training log-likelihood. With more
+# batches per epoch, the logged likelihood is summed over batches scored by
+# different weights, so it is not checked.
+check_log_likelihood() {
+    grep -o "training log-likelihood: .*" $1/train.log | cut -d" " -f3 | awk '
+        NR > 1 && $1 < prev - 1e-6 * (prev < 0 ? -prev : prev) { exit 1 }
+        { prev = $1 }
+        END { if (NR < 2) exit 1 }'
+}
+
+mkdir -p test_outputs/statistical test_outputs/statistical_full_batch test_outputs/statistical_parallel test_outputs/statistical_online test_outputs/statistical_online_full_batch
+./train_statistical.py data/test_generation --epochs 3 --log-directory test_outputs/statistical
+STAT_DIR=$(ls -d test_outputs/statistical/edit_stat_* | tail -n 1)
+./train_statistical.py data/test_generation --epochs 3 --batch-size 200 --log-directory test_outputs/statistical_full_batch
+check_log_likelihood $(ls -d test_outputs/statistical_full_batch/edit_stat_* | tail -n 1)
+./eval_statistical_generation.py $STAT_DIR/model.pt $STAT_DIR/src_vocab $STAT_DIR/tgt_vocab data/test_generation/test.txt --decoding sampling
+./eval_statistical_generation.py $STAT_DIR/model.pt $STAT_DIR/src_vocab $STAT_DIR/tgt_vocab data/test_generation/test.txt --decoding beam_search --beam-size 5
+./export_statistical_model.py $STAT_DIR/model.pt test_outputs/statistical/model.npz
+./statistical_scorer.py test_outputs/statistical/model.npz data/test_generation/test.txt --score viterbi > test_outputs/statistical/viterbi_scores.txt
+./statistical_scorer.py test_outputs/statistical/model.npz data/test_generation/test.txt --score log_likelihood > test_outputs/statistical/log_likelihoods.txt
+
+./train_statistical_parallel.py data/test_generation --epochs 3 --processes 2 --shard-size 50 --batch-size 10 --patience 5 --log-directory test_outputs/statistical_parallel
+check_log_likelihood $(ls -d test_outputs/statistical_parallel/edit_stat_parallel_* | tail -n 1)
+
+./train_statistical_online.py data/test_generation/train.txt --val-data data/test_generation/eval.txt --epochs 3 --batch-size 20 --checkpoint-frequency 5 --log-directory test_outputs/statistical_online
+./train_statistical_online.py data/test_generation/train.txt --epochs 3 --batch-size 200 --log-directory test_outputs/statistical_online_full_batch
+check_log_likelihood $(ls -d test_outputs/statistical_online_full_batch/edit_stat_online_* | tail -n 1)
+
+# DECODING WITH EDIT DISTANCE GENERATION MODELS =============================
+
+mkdir -p test_outputs/decoding
+./train_transliteration_generation.py --model-type rnn --hidden-size 16 --nll-loss 1.0 --sampled-em-loss 0.0 data/test_generation --distortion-loss 0.0 --final-state-loss 0.0 --batch-size 20 --delay-update 2 --epochs 2 --validation-frequency 5 --em-loss 1.0 --log-directory test_outputs/decoding
+GEN_DIR=$(ls -d test_outputs/decoding/edit_gen_* | tail -n 1)
+
+./transliterate.py --decoding operations_beam --beam-size 5 --recombination sum --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+
+./transliterate.py --decoding beam_search --beam-size 5 --n-best 3 --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt > test_outputs/decoding/n_best.txt
+# The n-best lists must not contain the same string twice.
+awk -F '\t' 'seen[$1 FS $2]++ { exit 1 }' test_outputs/decoding/n_best.txt
+
+cut -f2 data/test_generation/train.txt > test_outputs/decoding/lexicon.txt
+./lexicon_trie.py $GEN_DIR/tgt_vocab test_outputs/decoding/lexicon.txt test_outputs/decoding/lexicon.pt
+./transliterate.py --decoding beam_search --beam-size 5 --lexicon test_outputs/decoding/lexicon.pt --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+
+./transliterate.py --decoding speculative --draft-model $STAT_DIR/model.pt --draft-steps 3 --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+
+./target_shortlist.py $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab test_outputs/decoding/shortlist.pt --train-data data/test_generation/train.txt
+./transliterate.py --decoding beam_search --beam-size 5 --shortlist test_outputs/decoding/shortlist.pt --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+./target_shortlist.py $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab test_outputs/decoding/shortlist_statistical.pt --statistical-model $STAT_DIR/model.pt
+./transliterate.py --decoding beam_search --beam-size 5 --shortlist test_outputs/decoding/shortlist_statistical.pt --shortlist-min-mass 0.5 --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+
+./transliterate.py --decoding greedy --time-budget 0.001 --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+./transliterate.py --decoding beam_search --beam-size 5 --n-best 2 --time-budget 0.001 --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+
+./transliterate.py --quantize --evaluate $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+./evaluate_quantization.py $GEN_DIR/model.pt $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+
+./export_torchscript.py $GEN_DIR/model.pt test_outputs/decoding/model.ts
+./transliterate.py --scripted --decoding greedy --evaluate test_outputs/decoding/model.ts $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+./transliterate.py --scripted --decoding beam_search --beam-size 5 --evaluate test_outputs/decoding/model.ts $GEN_DIR/src_vocab $GEN_DIR/tgt_vocab data/test_generation/test.txt
+
+mkdir -p test_outputs/compiled
+./train_transliteration_generation.py --model-type embeddings --hidden-size 16 --nll-loss 1.0 --sampled-em-loss 0.0 data/test_generation --distortion-loss 0.0 --final-state-loss 0.0 --batch-size 20 --delay-update 2 --epochs 2 --validation-frequency 5 --em-loss 1.0 --log-directory test_outputs/compiled
+EMB_DIR=$(ls -d test_outputs/compiled/edit_gen_* | tail -n 1)
+./compile_embeddings_model.py $EMB_DIR/model.pt $EMB_DIR/compiled.pt --max-length 16
+./transliterate.py --decoding beam_search --beam-size 5 --evaluate $EMB_DIR/compiled.pt $EMB_DIR/src_vocab $EMB_DIR/tgt_vocab data/test_generation/test.txt
+
+# MODELS SAVED WITH TRANSFORMERS MODULES =====================================
+
+# Print the log-probability and the Viterbi score of every string pair in a
+# file computed by a model with the code in the given directory.
+score_pairs() {
+    (cd $1 && python3 - $2 $3 $4 $5) <<'EOF'
+import sys
+import torch
+
+def load_vocab(path):
+    with open(path) as f_vocab:
+        return {symbol: i for i, symbol in enumerate(
+            line.rstrip("\n") for line in f_vocab)}
+
+def to_tensor(string, stoi):
+    return torch.tensor([
+        [stoi["<s>"]] + [stoi.get(symbol, 0) for symbol in string] +
+        [stoi["</s>"]]])
+
+model = torch.load(sys.argv[1], map_location="cpu").eval()
+model.device = torch.device("cpu")
+src_stoi, tgt_stoi = load_vocab(sys.argv[2]), load_vocab(sys.argv[3])
+with open(sys.argv[4]) as f_data, torch.no_grad():
+    for line in f_data:
+        src, tgt = line.rstrip("\n").split("\t")[:2]
+        src_sent, tgt_sent = to_tensor(src, src_stoi), to_tensor(tgt, tgt_stoi)
+        print(float(model(src_sent, tgt_sent)[2]),
+              float(model.viterbi(src_sent, tgt_sent)[0]))
+EOF
+}
+
+# Train a model with the code before transformer.py was added, convert it and
+# check that it gives the same scores.
+BERT_DIR=test_outputs/bert_checkpoint
+mkdir -p $BERT_DIR/code
+git archive $(git log --format=%H --diff-filter=A -- transformer.py | tail -n 1)^ | tar -x -C $BERT_DIR/code
+(cd $BERT_DIR/code && ./train_transliteration_generation.py --model-type transformer --hidden-size 16 --nll-loss 1.0 --sampled-em-loss 0.0 data/test_generation --distortion-loss 0.0 --final-state-loss 0.0 --batch-size 20 --delay-update 2 --epochs 2 --validation-frequency 5 --em-loss 1.0 --log-directory ..)
+OLD_DIR=$PWD/$(ls -d $BERT_DIR/edit_gen_* | tail -n 1)
+./convert_bert_checkpoint.py $OLD_DIR/model.pt $BERT_DIR/converted.pt
+score_pairs $BERT_DIR/code $OLD_DIR/model.pt $OLD_DIR/src_vocab $OLD_DIR/tgt_vocab $PWD/data/test_generation/test.txt > $BERT_DIR/scores_before.txt
+score_pairs . $PWD/$BERT_DIR/converted.pt $OLD_DIR/src_vocab $OLD_DIR/tgt_vocab $PWD/data/test_generation/test.txt > $BERT_DIR/scores_after.txt
+paste $BERT_DIR/scores_before.txt $BERT_DIR/scores_after.txt | awk '
+    function abs(x) { return x < 0 ? -x : x }
+    NF != 4 || abs($1 - $3) > 1e-4 * (1 + abs($1)) || abs($2 - $4) > 1e-4 * (1 + abs($2)) { exit 1 }'
+
 # S2S MODELS =================================================================
 
 ./train_transliteration_s2s.py --model-type transformer --hidden-size 32 data/test_generation --batch-size 20 --epochs 2 --validation-frequency 5 --log-directory test_outputs
@@ -35,3 +151,5 @@ mkdir -p test_outputs
 # TRANSFORMER CLASSIFIER =====================================================
 
 ./train_baseline_cognates_classification.py --hidden-size 16 data/test_classification --batch-size 20  --delay-update 2 --epochs 2 --validation-frequency 5 --log-directory test_outputs
+
+./train_baseline_cognates_classification.py --hidden-size 16 data/test_classification --batch-size 20  --delay-update 2 --epochs 2 --validation-frequency 5 --packed-token-budget 32 --log-directory test_outputs
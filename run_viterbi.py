@@ -38,10 +38,28 @@ def main():
         "--output-format", default="nice", choices=["nice", "tsv", "alignment"],
         help="Nice for command line, tsv for processing, alignment=subtitutitons "
              "in word alignment format.")
+    parser.add_argument(
+        "--quantize", default=False, action="store_true",
+        help="Run a dynamically quantized (int8) model on CPU.")
+    parser.add_argument(
+        "--scripted", default=False, action="store_true",
+        help="The model is a TorchScript module exported by "
+             "export_torchscript.py.")
     args = parser.parse_args()
 
-    model = torch.load(args.model)
+    if args.scripted and args.quantize:
+        parser.error("Scripted models cannot be quantized.")
+
+    if args.scripted:
+        model = torch.jit.load(args.model)
+    else:
+        model = torch.load(
+            args.model, map_location="cpu" if args.quantize else None)
     logging.info("Model loaded.")
+    if args.quantize:
+        model = model.quantize()
+        logging.info("Model quantized.")
+    device = torch.device("cpu") if args.scripted else model.device
     src_vocab, src_stoi = load_vocab(args.src_vocab)
     tgt_vocab, tgt_stoi = load_vocab(args.tgt_vocab)
     logging.info("Vocabularies loaded.")
@@ -62,8 +80,15 @@ def main():
         string_2_idx = [tgt_stoi[s] for s in string_2_tok]
 
         _, edit_ops = model.viterbi(
-            torch.tensor([string_1_idx]).cuda(),
-            torch.tensor([string_2_idx]).cuda())
+            torch.tensor([string_1_idx]).to(device),
+            torch.tensor([string_2_idx]).to(device))
+        if args.scripted:
+            # scripted models return the symbols and positions as lists
+            edit_ops = [
+                (operation,
+                 chars[0] if len(chars) == 1 else tuple(chars),
+                 idx[0] if len(idx) == 1 else tuple(idx))
+                for operation, chars, idx in edit_ops]
 
         if args.output_format == "alignment":
             alignment = []
@@ -0,0 +1,421 @@
+"""TorchScript inference modules for the neural edit distance models.
+
+A trained model is converted into a single TorchScript module that can be
+saved with `torch.jit.save` and loaded with `torch.jit.load` without the
+Python code of this repository. The encoders and the action score
+computation are traced (their control flow only depends on the model
+configuration, not on the data); the dynamic programming and decoding loops
+are compiled as TorchScript methods:
+
+    * forward(src_sent, tgt_sent): log-probabilities of string pairs,
+    * alpha(src_sent, tgt_sent): the alpha tables,
+    * viterbi(src_sent, tgt_sent): the best edit operations for a pair,
+    * decode(src_sent): greedy decoding (generative models only),
+    * beam_search(src_sent, beam_size, len_norm, n_best): beam search
+      (generative models only).
+
+The exported modules run on CPU. Lookup tables and sequence packing are
+not used in the exported modules, the lexicon constraints, target
+shortlists and time budgets of the Python decoding are not available.
+"""
+
+from typing import List, Tuple
+
+import copy
+
+import torch
+from torch import nn
+from torch.functional import F
+from torch import Tensor
+
+from models import (
+    NeuralEditDistBase, EditDistNeuralModelProgressive,
+    _torchscript_forward_evaluation)
+from transformer import Transformer
+
+
+# the lazily compiled function cannot be called from TorchScript code
+_forward_evaluation = _torchscript_forward_evaluation.python_function
+
+
+class _ActionScores(nn.Module):
+    """Encoders and action score computation of a model, used for tracing."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, src_sent, tgt_sent):
+        # pylint: disable=protected-access
+        src_mask = src_sent != self.model.src_pad
+        tgt_mask = tgt_sent != self.model.tgt_pad
+        src_vectors = self.model._encode_src(src_sent, src_mask)
+        tgt_vectors = self.model._encode_tgt(
+            tgt_sent, tgt_mask, src_vectors, src_mask)
+        feature_table = self.model._pair_features(
+            src_vectors, tgt_vectors, src_mask)
+        action_scores = self.model._action_scores_from_features(
+            feature_table)[0]
+        return feature_table, action_scores
+
+
+class ScriptedEditDistance(nn.Module):
+    """Inference with a neural edit distance model, compilable to TorchScript.
+
+    Use `script_model` to create the compiled module from a trained model.
+
+    Args:
+        model: The trained model.
+        action_scores: Traced module computing the feature table and the
+            action scores for a batch of source and target sequences.
+    """
+    def __init__(self, model, action_scores):
+        super().__init__()
+        # pylint: disable=protected-access
+        self.action_scores = action_scores
+        self.insertion_proj = model.insertion_proj
+        self.substitution_proj = model.substitution_proj
+
+        self.generative = isinstance(model, EditDistNeuralModelProgressive)
+        self.src_pad = model.src_pad
+        self.tgt_pad = model.tgt_pad
+        self.tgt_bos = model.tgt_bos
+        self.tgt_eos = model.tgt_eos
+        self.tgt_symbol_count = model.tgt_symbol_count
+
+        # target classes of the edit operations for all (pairs of) symbols
+        src_symbols = torch.arange(model.src_symbol_count)
+        tgt_symbols = torch.arange(model.tgt_symbol_count)
+        self.register_buffer(
+            "deletion_ids", model._deletion_id(src_symbols).clone())
+        self.register_buffer(
+            "insertion_ids", model._insertion_id(tgt_symbols).clone())
+        self.register_buffer(
+            "substitution_ids", model._substitute_id(
+                src_symbols.unsqueeze(1).repeat(1, len(tgt_symbols)),
+                tgt_symbols.unsqueeze(0).repeat(len(src_symbols), 1)))
+
+    def forward(self, src_sent: Tensor, tgt_sent: Tensor) -> Tensor:
+        """Log-probabilities of the string pairs."""
+        alpha = self.alpha(src_sent, tgt_sent)
+        src_lengths = (src_sent != self.src_pad).sum(1) - 1
+        tgt_lengths = (tgt_sent != self.tgt_pad).sum(1) - 1
+        return alpha[torch.arange(alpha.size(0)), src_lengths, tgt_lengths]
+
+    @torch.jit.export
+    def alpha(self, src_sent: Tensor, tgt_sent: Tensor) -> Tensor:
+        """Alpha tables (Algorithm 1) for a batch of string pairs."""
+        action_scores = self.action_scores(src_sent, tgt_sent)[1]
+        return _forward_evaluation(
+            self.deletion_ids[src_sent], self.insertion_ids[tgt_sent],
+            self.substitution_ids[src_sent.unsqueeze(2),
+                                  tgt_sent.unsqueeze(1)],
+            action_scores, action_scores.device)
+
+    @torch.jit.export
+    def viterbi(
+            self, src_sent: Tensor, tgt_sent: Tensor
+    ) -> Tuple[Tensor, List[Tuple[str, List[int], List[int]]]]:
+        """Get a single best sequence of edit ops for a string pair.
+
+        Same as the `viterbi` method of the models, but the symbols and
+        positions of the operations are lists: one item for deletions and
+        insertions, the source and the target item for substitutions.
+        """
+        assert src_sent.size(0) == 1
+        src_len, tgt_len = src_sent.size(1), tgt_sent.size(1)
+        action_scores = self.action_scores(src_sent, tgt_sent)[1]
+        scores: List[List[List[float]]] = action_scores[0].tolist()
+        src_ids: List[int] = src_sent[0].tolist()
+        tgt_ids: List[int] = tgt_sent[0].tolist()
+        deletion_ids: List[int] = self.deletion_ids[src_sent[0]].tolist()
+        insertion_ids: List[int] = self.insertion_ids[tgt_sent[0]].tolist()
+        subs_ids: List[List[int]] = self.substitution_ids[
+            src_sent[0].unsqueeze(1), tgt_sent[0].unsqueeze(0)].tolist()
+
+        alpha = [[float("-inf")] * tgt_len for _ in range(src_len)]
+        action_count = [[0.0] * tgt_len for _ in range(src_len)]
+        actions = [[0] * tgt_len for _ in range(src_len)]
+        alpha[0][0] = 0.0
+        for t in range(src_len):
+            for v in range(tgt_len):
+                if t == 0 and v == 0:
+                    continue
+                best_cost, best_count, best_action = float("-inf"), 1.0, 0
+                if v >= 1:
+                    best_cost = scores[t][v][insertion_ids[v]] + alpha[t][v - 1]
+                    best_count = action_count[t][v - 1] + 1
+                if t >= 1:
+                    cost = scores[t][v][deletion_ids[t]] + alpha[t - 1][v]
+                    if cost > best_cost:
+                        best_cost, best_action = cost, 1
+                        best_count = action_count[t - 1][v] + 1
+                if v >= 1 and t >= 1:
+                    cost = scores[t][v][subs_ids[t][v]] + alpha[t - 1][v - 1]
+                    if cost > best_cost:
+                        best_cost, best_action = cost, 2
+                        best_count = action_count[t - 1][v - 1] + 1
+                alpha[t][v] = best_cost
+                action_count[t][v] = best_count
+                actions[t][v] = best_action
+
+        operations: List[Tuple[str, List[int], List[int]]] = []
+        t = src_len - 1
+        v = tgt_len - 1
+        while t > 0 or v > 0:
+            if actions[t][v] == 1:
+                operations.append(("delete", [src_ids[t - 1]], [t - 1]))
+                t -= 1
+            elif actions[t][v] == 0:
+                operations.append(("insert", [tgt_ids[v]], [v]))
+                v -= 1
+            else:
+                operations.append((
+                    "subs", [src_ids[t - 1], tgt_ids[v]], [t - 1, v]))
+                v -= 1
+                t -= 1
+        operations.reverse()
+
+        score = torch.tensor(alpha[-1][-1] / action_count[-1][-1]).exp()
+        return score, operations
+
+    def _log_src_mask(self, src_sent: Tensor) -> Tensor:
+        return torch.zeros(src_sent.shape).masked_fill(
+            src_sent == self.src_pad, float("-inf"))
+
+    def _initial_alpha(
+            self, b_range: Tensor, action_scores: Tensor,
+            src_sent: Tensor, log_src_mask: Tensor) -> Tensor:
+        """Alpha table for the target prefix consisting of the start symbol."""
+        alpha = log_src_mask.clone().unsqueeze(2)
+        deletion_ids = self.deletion_ids[src_sent]
+        for t in range(1, src_sent.size(1)):
+            alpha[:, t, 0] = (
+                action_scores[b_range, t, 0, deletion_ids[:, t]] +
+                alpha[:, t - 1, 0])
+        return alpha
+
+    def _scores_for_next_step(
+            self, v: int, feature_table: Tensor, log_src_mask: Tensor,
+            alpha: Tensor) -> Tensor:
+        """Predict scores of the next symbol, given the decoding history."""
+        insertion_scores = (
+            F.log_softmax(
+                self.insertion_proj(feature_table[:, :, v - 1:v]), dim=-1)
+            + log_src_mask.unsqueeze(2).unsqueeze(3)
+            + alpha[:, :, v - 1:v].unsqueeze(3))
+        subs_scores = (
+            F.log_softmax(
+                self.substitution_proj(feature_table[:, 1:, v - 1:v]),
+                dim=-1)
+            + log_src_mask[:, 1:].unsqueeze(2).unsqueeze(3)
+            + alpha[:, 1:, v - 1:v].unsqueeze(3))
+        return torch.cat((insertion_scores, subs_scores), dim=1).logsumexp(1)
+
+    def _update_alpha_with_new_row(
+            self, b_range: Tensor, v: int, alpha: Tensor,
+            action_scores: Tensor, src_sent: Tensor,
+            tgt_sent: Tensor) -> Tensor:
+        """Add an alpha table column for the most recently decoded symbol."""
+        alpha = torch.cat(
+            (alpha, torch.full(
+                (alpha.size(0), alpha.size(1), 1), float("-inf"))), dim=2)
+        insertion_id = self.insertion_ids[tgt_sent[:, v]]
+        for t in range(src_sent.size(1)):
+            insertion_score = (
+                action_scores[b_range, t, v, insertion_id] +
+                alpha[:, t, v - 1])
+            if t == 0:
+                alpha[:, t, v] = insertion_score
+                continue
+            deletion_id = self.deletion_ids[src_sent[:, t]]
+            subsitute_id = self.substitution_ids[src_sent[:, t], tgt_sent[:, v]]
+            alpha[:, t, v] = torch.stack([
+                insertion_score,
+                action_scores[b_range, t, v, deletion_id] +
+                alpha[:, t - 1, v],
+                action_scores[b_range, t, v, subsitute_id] +
+                alpha[:, t - 1, v - 1]]).logsumexp(0)
+        return alpha
+
+    @torch.jit.export
+    def decode(self, src_sent: Tensor) -> Tensor:
+        """Greedy decoding."""
+        if not self.generative:
+            raise RuntimeError("Only generative models can decode.")
+        batch_size = src_sent.size(0)
+        b_range = torch.arange(batch_size)
+
+        tgt_sent = torch.full((batch_size, 1), self.tgt_bos, dtype=torch.long)
+        feature_table, action_scores = self.action_scores(src_sent, tgt_sent)
+        log_src_mask = self._log_src_mask(src_sent)
+        alpha = self._initial_alpha(
+            b_range, action_scores, src_sent, log_src_mask)
+
+        finished = torch.zeros((batch_size,), dtype=torch.bool)
+        for v in range(1, 2 * src_sent.size(1)):
+            next_symb_scores = self._scores_for_next_step(
+                v, feature_table, log_src_mask, alpha)
+            next_symbol = next_symb_scores.argmax(2).masked_fill(
+                finished.unsqueeze(1), self.tgt_pad)
+            tgt_sent = torch.cat((tgt_sent, next_symbol), dim=1)
+
+            feature_table, action_scores = self.action_scores(
+                src_sent, tgt_sent)
+            finished = finished | (next_symbol.squeeze(1) == self.tgt_eos)
+            alpha = self._update_alpha_with_new_row(
+                b_range, v, alpha, action_scores, src_sent, tgt_sent)
+            if bool(finished.all()):
+                break
+        return tgt_sent
+
+    @torch.jit.export
+    def beam_search(
+            self, src_sent: Tensor, beam_size: int = 10,
+            len_norm: float = 1.0,
+            n_best: int = 1) -> Tuple[Tensor, Tensor, Tensor]:
+        """Beam search over target symbols.
+
+        Returns:
+            A tuple of the n best decoded hypotheses of shape (batch, n_best,
+            length), their unnormalized scores and their length-normalized
+            scores, both of shape (batch, n_best).
+        """
+        if not self.generative:
+            raise RuntimeError("Only generative models can decode.")
+        if not 0 < n_best <= beam_size:
+            raise ValueError(
+                "The n-best list size must be between 1 and the beam size.")
+        batch_size = src_sent.size(0)
+        src_len = src_sent.size(1)
+        b_range = torch.arange(batch_size)
+        log_src_mask = self._log_src_mask(src_sent)
+
+        decoded = torch.full((batch_size, 1, 1), self.tgt_bos, dtype=torch.long)
+        feature_table, action_scores = self.action_scores(
+            src_sent, decoded.squeeze(1))
+        flat_alpha = self._initial_alpha(
+            b_range, action_scores, src_sent, log_src_mask)
+
+        cur_len = 1
+        current_beam = 1
+        finished = torch.zeros((batch_size, 1, 1), dtype=torch.bool)
+        scores = torch.zeros((batch_size, 1))
+        best_normed_scores = scores
+        flat_decoded = decoded.reshape(batch_size, cur_len)
+        flat_finished = finished.reshape(batch_size, cur_len)
+        finished_continuation = torch.full(
+            (1, self.tgt_symbol_count), float("-inf"))
+        finished_continuation[0, self.tgt_pad] = 0.
+        special_symbols_mask = torch.zeros((1, self.tgt_symbol_count))
+        special_symbols_mask[0, self.tgt_bos] = float("-inf")
+        special_symbols_mask[0, self.tgt_pad] = float("-inf")
+        while cur_len < 2 * src_len:
+            next_symb_scores = self._scores_for_next_step(
+                cur_len, feature_table, log_src_mask, flat_alpha)
+            # finished hypotheses only continue with padding for free,
+            # unfinished ones cannot continue with the start or padding
+            next_symb_scores = torch.where(
+                flat_finished[:, -1:].unsqueeze(2), finished_continuation,
+                next_symb_scores + special_symbols_mask)
+
+            # get scores of all expanded hypotheses
+            candidate_scores = (
+                scores.unsqueeze(2) +
+                next_symb_scores.reshape(batch_size, current_beam, -1))
+            norm_factor = torch.pow(
+                (1 - finished.float()).sum(2, keepdim=True) + 1, len_norm)
+            normed_scores = candidate_scores / norm_factor
+
+            best_normed_scores, best_indices = normed_scores.reshape(
+                batch_size, -1).topk(beam_size, dim=-1)
+            next_symbol_ids = best_indices % self.tgt_symbol_count
+            hypothesis_ids = best_indices // self.tgt_symbol_count
+
+            beam_offset = torch.arange(
+                0, batch_size * current_beam, step=current_beam)
+            global_best_indices = (
+                beam_offset.unsqueeze(1) + hypothesis_ids).reshape(-1)
+
+            decoded = torch.cat((
+                flat_decoded.index_select(
+                    0, global_best_indices).reshape(batch_size, beam_size, -1),
+                next_symbol_ids.unsqueeze(-1)), dim=2)
+            reordered_finished = flat_finished.index_select(
+                0, global_best_indices)
+            finished_now = (
+                (next_symbol_ids.view(-1, 1) == self.tgt_eos) |
+                reordered_finished[:, -1:])
+            finished = torch.cat((
+                reordered_finished,
+                finished_now), dim=1).reshape(batch_size, beam_size, -1)
+            flat_alpha = flat_alpha.index_select(0, global_best_indices)
+
+            scores = candidate_scores.reshape(
+                batch_size, -1).gather(-1, best_indices)
+
+            if bool(finished_now.all()):
+                break
+
+            # tile the source after the first step
+            if cur_len == 1:
+                src_sent = src_sent.unsqueeze(1).repeat(
+                    1, beam_size, 1).reshape(batch_size * beam_size, -1)
+                log_src_mask = log_src_mask.unsqueeze(1).repeat(
+                    1, beam_size, 1).reshape(batch_size * beam_size, -1)
+                b_range = torch.arange(batch_size * beam_size)
+
+            flat_decoded = decoded.reshape(-1, cur_len + 1)
+            flat_finished = finished.reshape(-1, cur_len + 1)
+            feature_table, action_scores = self.action_scores(
+                src_sent, flat_decoded)
+            flat_alpha = self._update_alpha_with_new_row(
+                b_range, cur_len, flat_alpha, action_scores, src_sent,
+                flat_decoded)
+
+            current_beam = beam_size
+            cur_len += 1
+
+        return (decoded[:, :n_best], scores[:, :n_best],
+                best_normed_scores[:, :n_best])
+
+
+@torch.no_grad()
+def script_model(model):
+    """Compile a neural edit distance model into a TorchScript module.
+
+    The model is copied to CPU in evaluation mode, so the original model is
+    not changed. Dynamically quantized models cannot be compiled, because
+    the quantized weights of the cross-attention cannot be traced.
+
+    Returns:
+        ScriptedEditDistance compiled using `torch.jit.script`.
+    """
+    if not isinstance(model, NeuralEditDistBase):
+        raise ValueError("Only neural edit distance models can be scripted.")
+    model = copy.deepcopy(model).cpu().eval()
+    model.device = torch.device("cpu")
+    for module in model.modules():
+        # packing depends on the lengths, it would be traced as constants
+        if isinstance(module, Transformer):
+            module.packed_token_budget = None
+    for param in model.parameters():
+        param.requires_grad = False
+
+    # the traced batch contains padding, so that the masking gets traced
+    example_src = torch.tensor([
+        [model.src_bos] + [model.src_eos] * 3,
+        [model.src_bos, model.src_eos, model.src_pad, model.src_pad]])
+    example_tgt = torch.tensor([
+        [model.tgt_bos] + [model.tgt_eos] * 4,
+        [model.tgt_bos, model.tgt_eos] + [model.tgt_pad] * 3])
+    # the traced code must not depend on the lengths of the examples
+    check_src = torch.tensor([
+        [model.src_bos] + [model.src_eos] * 6,
+        [model.src_bos, model.src_eos] + [model.src_pad] * 5])
+    check_tgt = torch.tensor([
+        [model.tgt_bos] + [model.tgt_eos] * 2,
+        [model.tgt_bos, model.tgt_eos, model.tgt_pad]])
+    action_scores = torch.jit.trace(
+        _ActionScores(model), (example_src, example_tgt),
+        check_inputs=[(check_src, check_tgt)])
+    return torch.jit.script(ScriptedEditDistance(model, action_scores))
@@ -0,0 +1,52 @@
+"""Streamed reading of string pairs for training the statistical model.
+
+The training data are tab-separated string pairs, one pair per line. They
+are read lazily in shards, so that the training scripts never need to keep
+the whole corpus in memory.
+"""
+
+from collections import Counter
+import itertools
+
+import torch
+
+
+def pairs_to_batch(pairs, src_vocab, tgt_vocab, src_tokenized=False,
+                   tgt_tokenized=False):
+    """Convert string pairs to a pair of padded index tensors."""
+    def to_indices(string, vocab, tokenized):
+        tokens = string.split() if tokenized else list(string)
+        return [vocab.stoi["<s>"]] + [
+            vocab.stoi[tok] for tok in tokens] + [vocab.stoi["</s>"]]
+
+    src_seqs = [to_indices(src, src_vocab, src_tokenized) for src, _ in pairs]
+    tgt_seqs = [to_indices(tgt, tgt_vocab, tgt_tokenized) for _, tgt in pairs]
+
+    def pad(seqs, vocab):
+        max_len = max(len(seq) for seq in seqs)
+        return torch.tensor([
+            seq + [vocab.stoi["<pad>"]] * (max_len - len(seq))
+            for seq in seqs])
+
+    return pad(src_seqs, src_vocab), pad(tgt_seqs, tgt_vocab)
+
+
+def read_shards(path, shard_size):
+    """Lazily read tab-separated string pairs in shards."""
+    with open(path) as f_data:
+        pairs = (line.rstrip("\n").split("\t")[:2] for line in f_data)
+        while True:
+            shard = list(itertools.islice(pairs, shard_size))
+            if not shard:
+                break
+            yield shard
+
+
+def count_symbols(path, src_tokenized=False, tgt_tokenized=False):
+    """Count source and target symbols in a streamed pass over the data."""
+    src_counter, tgt_counter = Counter(), Counter()
+    for shard in read_shards(path, 10000):
+        for src, tgt in shard:
+            src_counter.update(src.split() if src_tokenized else src)
+            tgt_counter.update(tgt.split() if tgt_tokenized else tgt)
+    return src_counter, tgt_counter
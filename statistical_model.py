@@ -1,227 +1,643 @@
-
+import numpy as np
 import torch
 
 from models import EditDistBase, MINF
 
 
+def cooccurring_pairs(batches, src_pad, tgt_pad, pairs=None):
+    """Collect source-target symbol pairs that co-occur in sequence pairs.
+
+    Args:
+        batches: Iterable of padded source and target batches.
+        src_pad: Index of the source padding symbol.
+        tgt_pad: Index of the target padding symbol.
+        pairs: Previously collected pairs to extend.
+
+    Returns:
+        Tensor of shape (pair_count, 2) with unique symbol pairs.
+    """
+    if pairs is None:
+        pairs = torch.zeros((0, 2), dtype=torch.long)
+    for src_sent, tgt_sent in batches:
+        src_sent, tgt_sent = src_sent[:, 1:].cpu(), tgt_sent[:, 1:].cpu()
+        mask = ((src_sent != src_pad).unsqueeze(2) &
+                (tgt_sent != tgt_pad).unsqueeze(1))
+        batch_pairs = torch.stack((
+            src_sent.unsqueeze(2).expand_as(mask)[mask],
+            tgt_sent.unsqueeze(1).expand_as(mask)[mask]), dim=1)
+        pairs = torch.unique(torch.cat((pairs, batch_pairs)), dim=0)
+    return pairs
+
+
 class EditDistStatModel(EditDistBase):
     """The original statistical algorithm by Ristad and Yanilos.
 
     This is a reimplemntation of the original learnable edit distance algorithm
     in PyTorch using the same interface as the neural models.
+
+    If substitution pairs are provided, only they have their own parameters
+    and all other substitutions share a single backoff weight (i.e., each of
+    them has the probability given by the backoff weight).
     """
     def __init__(self, src_vocab, tgt_vocab, start_symbol="<s>",
                  end_symbol="</s>", pad_symbol="<pad>",
-                 identitiy_initialize=True):
+                 identitiy_initialize=True, substitution_pairs=None):
         super().__init__(
             src_vocab, tgt_vocab, start_symbol, end_symbol, pad_symbol)
 
-        weights = torch.tensor([
-            1 / self.n_target_classes for _ in range(self.n_target_classes)])
+        identity_src, identity_tgt = [], []
+        for idx, symbol in enumerate(self.src_vocab.itos):
+            if symbol in self.tgt_vocab.stoi:
+                identity_src.append(idx)
+                identity_tgt.append(self.tgt_vocab[symbol])
+        identity_src = torch.tensor(identity_src, dtype=torch.long)
+        identity_tgt = torch.tensor(identity_tgt, dtype=torch.long)
+
+        # weight of every pair (explicit or not) in the uniform distribution
+        uniform_weight = 1 / self.n_target_classes
+        self.substitution_keys = None
+        self.class_multiplicity = None
+        if substitution_pairs is not None:
+            substitution_pairs = torch.as_tensor(
+                substitution_pairs, dtype=torch.long).view(-1, 2)
+            keys = (substitution_pairs[:, 0] * self.tgt_symbol_count +
+                    substitution_pairs[:, 1])
+            if identitiy_initialize:
+                keys = torch.cat((
+                    keys, identity_src * self.tgt_symbol_count + identity_tgt))
+            self.substitution_keys = torch.unique(keys)
+            self.n_target_classes = (
+                self.src_symbol_count + self.tgt_symbol_count +
+                self.substitution_keys.size(0) + 1)
+            self.class_multiplicity = torch.ones(self.n_target_classes)
+            self.class_multiplicity[-1] = max(
+                1, self.src_symbol_count * self.tgt_symbol_count -
+                self.substitution_keys.size(0))
+
+        weights = torch.full((self.n_target_classes,), uniform_weight)
 
         if identitiy_initialize:
-            idenity_weight = [0. for _ in range(self.n_target_classes)]
-            id_count = 0
-            for idx, symbol in enumerate(self.src_vocab.itos):
-                if symbol in self.tgt_vocab.stoi:
-                    idenity_weight[self._substitute_id(
-                        idx, self.tgt_vocab[symbol])] = 1.
-                    id_count += 1
-            idenity_weight_tensor = torch.tensor(idenity_weight) / id_count
-            weights = (weights + idenity_weight_tensor) / 2
+            idenity_weight = torch.zeros(self.n_target_classes)
+            idenity_weight[
+                self._substitute_id(identity_src, identity_tgt)] = 1.
+            weights = (weights + idenity_weight / len(identity_src)) / 2
 
         self.weights = torch.log(weights)
-
-
-    def _forward_evaluation(self, src_sent, tgt_sent):
-        src_len, tgt_len = src_sent.size(1), tgt_sent.size(1)
-        alpha = torch.zeros((src_len, tgt_len)) + MINF
-        alpha[0, 0] = 0
-        for t, src_char in enumerate(src_sent[0]):
-            for v, tgt_char in enumerate(tgt_sent[0]):
-                if t == 0 and v == 0:
-                    continue
-
-                deletion_id = self._deletion_id(src_char)
-                insertion_id = self._insertion_id(tgt_char)
-                subsitute_id = self._substitute_id(src_char, tgt_char)
-
-                to_sum = [alpha[t, v]]
-                if v >= 1:
-                    to_sum.append(self.weights[insertion_id] + alpha[t, v - 1])
-                if t >= 1:
-                    to_sum.append(self.weights[deletion_id] + alpha[t - 1, v])
-                if v >= 1 and t >= 1:
-                    to_sum.append(
-                        self.weights[subsitute_id] + alpha[t - 1, v - 1])
-
-                alpha[t, v] = torch.logsumexp(torch.tensor(to_sum), dim=0)
-        return alpha
-
-    def forward(self, src_sent, tgt_sent):
+        self._update_sampling_table()
+
+    def _substitute_id(self, src_char, tgt_char):
+        substitution_keys = getattr(self, "substitution_keys", None)
+        if substitution_keys is None:
+            return super()._substitute_id(src_char, tgt_char)
+        keys = (torch.as_tensor(src_char) * self.tgt_symbol_count +
+                torch.as_tensor(tgt_char))
+        positions = torch.searchsorted(
+            substitution_keys, keys).clamp(max=substitution_keys.size(0) - 1)
+        return torch.where(
+            substitution_keys[positions] == keys,
+            self.src_symbol_count + self.tgt_symbol_count + positions,
+            torch.full_like(keys, self.n_target_classes - 1))
+
+    def _log_src_mask(self, src_sent):
+        return torch.where(
+            src_sent == self.src_pad,
+            torch.full_like(src_sent, MINF, dtype=torch.float),
+            torch.zeros_like(src_sent, dtype=torch.float))
+
+    def _log_tgt_mask(self, tgt_sent):
+        return torch.where(
+            tgt_sent == self.tgt_pad,
+            torch.full_like(tgt_sent, MINF, dtype=torch.float),
+            torch.zeros_like(tgt_sent, dtype=torch.float))
+
+    def _operation_weights(self, src_sent, tgt_sent):
+        """Gather operation log-weights for a batch of padded sequence pairs.
+
+        Position i of the returned tensors corresponds to the operation that
+        consumes symbol i + 1 (i.e., the start symbols are skipped).
+
+        Returns:
+            Deletion weights of shape (batch, src_len - 1), insertion weights
+            of shape (batch, tgt_len - 1) and substitution weights of shape
+            (batch, src_len - 1, tgt_len - 1).
+        """
+        deletion = self.weights[self._deletion_id(src_sent[:, 1:])]
+        insertion = self.weights[self._insertion_id(tgt_sent[:, 1:])]
+        substitution = self.weights[self._substitute_id(
+            src_sent[:, 1:].unsqueeze(2), tgt_sent[:, 1:].unsqueeze(1))]
+        return deletion, insertion, substitution
+
+    @staticmethod
+    def _deletion_sums(deletion_weights):
+        """Log-weights of deleting all source symbols up to a position."""
+        return torch.cat((
+            torch.zeros_like(deletion_weights[:, :1]),
+            deletion_weights.cumsum(1)), dim=1)
+
+    @staticmethod
+    def _add_deletions(emitted, deletion_sums):
+        """Close a forward column under the deletion operation.
+
+        The deletions within a column are a linear recurrence in the log
+        domain, so it is computed as a log-cumsum-exp instead of looping over
+        the source positions.
+        """
+        return deletion_sums + torch.logcumsumexp(
+            emitted - deletion_sums, dim=1)
+
+    @staticmethod
+    def _add_deletions_backward(emitted, deletion_sums):
+        """Close a backward column under the deletion operation."""
+        return torch.logcumsumexp(
+            (emitted + deletion_sums).flip(1), dim=1).flip(1) - deletion_sums
+
+    def _forward_evaluation(self, src_sent, tgt_sent, operation_weights=None):
+        """Forward log-probabilities for a batch of padded sequence pairs.
+
+        The table is computed one target position at a time, each column at
+        once for all source positions.
+
+        Returns:
+            Tensor of shape (batch, src_len, tgt_len). Cells outside the
+            source length are -inf, cells outside the target length are not
+            meaningful.
+        """
+        if operation_weights is None:
+            operation_weights = self._operation_weights(src_sent, tgt_sent)
+        deletion, insertion, substitution = operation_weights
+        deletion_sums = self._deletion_sums(deletion)
+        log_src_mask = self._log_src_mask(src_sent)
+
+        column = deletion_sums + log_src_mask
+        columns = [column]
+        for v in range(tgt_sent.size(1) - 1):
+            emitted = insertion[:, v:v + 1] + column
+            substituted = substitution[:, :, v] + column[:, :-1]
+            emitted = torch.cat((
+                emitted[:, :1],
+                torch.logaddexp(emitted[:, 1:], substituted)), dim=1)
+            column = (
+                self._add_deletions(emitted, deletion_sums) + log_src_mask)
+            columns.append(column)
+        return torch.stack(columns, dim=2)
+
+    def _backward_evaluation(self, src_sent, tgt_sent, operation_weights):
+        """Backward log-probabilities for a batch of padded sequence pairs.
+
+        Every pair starts in the cell given by its source and target lengths.
+
+        Returns:
+            Tensor of shape (batch, src_len, tgt_len). Cells outside the
+            lengths are -inf.
+        """
+        deletion, insertion, substitution = operation_weights
+        deletion_sums = self._deletion_sums(deletion)
+        log_src_mask = self._log_src_mask(src_sent)
+        src_lengths = (src_sent != self.src_pad).sum(1)
+        tgt_lengths = (tgt_sent != self.tgt_pad).sum(1)
+
+        final_emitted = torch.full_like(log_src_mask, MINF)
+        final_emitted[
+            torch.arange(src_sent.size(0), device=src_sent.device),
+            src_lengths - 1] = 0.
+
+        column = None
+        columns = []
+        for v in reversed(range(tgt_sent.size(1))):
+            if column is None:
+                emitted = final_emitted
+            else:
+                emitted = insertion[:, v:v + 1] + column
+                substituted = substitution[:, :, v] + column[:, 1:]
+                emitted = torch.cat((
+                    torch.logaddexp(emitted[:, :-1], substituted),
+                    emitted[:, -1:]), dim=1)
+                emitted = torch.where(
+                    (tgt_lengths == v + 1).unsqueeze(1),
+                    final_emitted, emitted)
+            column = self._add_deletions_backward(
+                emitted + log_src_mask, deletion_sums)
+            columns.append(column)
+        beta = torch.stack(columns[::-1], dim=2)
+        return beta + self._log_tgt_mask(tgt_sent).unsqueeze(1)
+
+    def forward(self, src_sent, tgt_sent, expected_counts=None,
+                log_likelihood=None):
+        """Accumulate expected operation counts (E-step) for a batch of pairs.
+
+        The posterior counts of the operations in each cell of the dynamic
+        programming table are scatter-added into a single count vector, so
+        memory per pair is proportional to the table size only.
+
+        Args:
+            src_sent: Padded batch of source sequences.
+            tgt_sent: Padded batch of target sequences.
+            expected_counts: Count vector of size n_target_classes that the
+                counts are added to. If not given, a new one is created.
+            log_likelihood: Optional zero-dimensional tensor that the total
+                log-likelihood of the pairs under the current weights is
+                added to.
+
+        Returns:
+            The count vector (not in the log domain).
+        """
+        batch_size = src_sent.size(0)
         src_len, tgt_len = src_sent.size(1), tgt_sent.size(1)
-        table_shape = ((src_len, tgt_len, self.n_target_classes))
-
-        alpha = self._forward_evaluation(src_sent, tgt_sent)
-
-        plausible_deletions = torch.zeros(table_shape) + MINF
-        plausible_insertions = torch.zeros(table_shape) + MINF
-        plausible_substitutions = torch.zeros(table_shape) + MINF
-
-        beta = torch.zeros((src_len, tgt_len)) + MINF
-        beta[-1, -1] = 0.0
-
-        for t in reversed(range(src_len)):
-            for v in reversed(range(tgt_len)):
-                to_sum = [beta[t, v]]
-                if v < tgt_len - 1:
-                    insertion_id = self._insertion_id(tgt_sent[0, v + 1])
-                    plausible_insertions[t, v, insertion_id] = 0
-                    to_sum.append(
-                        self.weights[insertion_id] + beta[t, v + 1])
-                if t < src_len - 1:
-                    deletion_id = self._deletion_id(src_sent[0, t + 1])
-                    plausible_deletions[t, v, deletion_id] = 0
-                    to_sum.append(
-                        self.weights[deletion_id] + beta[t + 1, v])
-                if v < tgt_len - 1 and t < src_len - 1:
-                    subsitute_id = self._substitute_id(
-                        src_sent[0, t + 1], tgt_sent[0, v + 1])
-                    plausible_substitutions[t, v, subsitute_id] = 0
-                    to_sum.append(
-                        self.weights[subsitute_id] + beta[t + 1, v + 1])
-                beta[t, v] = torch.logsumexp(torch.tensor(to_sum), dim=0)
-
-        expand_weights = self.weights.unsqueeze(0).unsqueeze(0)
-        # deletion expectation
-        expected_deletions = (
-            alpha[:-1, :].unsqueeze(2) +
-            expand_weights + plausible_deletions[1:, :] +
-            beta[1:, :].unsqueeze(2))
-        # insertoin expectation
-        expected_insertions = (
-            alpha[:, :-1].unsqueeze(2) +
-            expand_weights + plausible_insertions[:, 1:] +
-            beta[:, 1:].unsqueeze(2))
-        # substitution expectation
-        expected_substitutions = (
-            alpha[:-1, :-1].unsqueeze(2) +
-            expand_weights + plausible_substitutions[1:, 1:] +
-            beta[1:, 1:].unsqueeze(2))
-
-        all_counts = torch.cat([
-            expected_deletions.reshape((-1, self.n_target_classes)),
-            expected_insertions.reshape((-1, self.n_target_classes)),
-            expected_substitutions.reshape((-1, self.n_target_classes))],
-            dim=0)
-
-        expected_counts = all_counts.logsumexp(0)
+        operation_weights = self._operation_weights(src_sent, tgt_sent)
+        deletion, insertion, substitution = operation_weights
+
+        alpha = self._forward_evaluation(
+            src_sent, tgt_sent, operation_weights)
+        beta = self._backward_evaluation(
+            src_sent, tgt_sent, operation_weights)
+        pair_log_likelihood = beta[:, 0, 0].view(batch_size, 1, 1)
+        if log_likelihood is not None:
+            log_likelihood += pair_log_likelihood.sum()
+
+        # Operation consuming source position t and target position v ends
+        # in cell (t, v), so its posterior is the forward probability of the
+        # cell it starts in, the operation weight and the backward
+        # probability of the cell where it ends.
+        deletion_posteriors = (
+            alpha[:, :-1] + deletion.unsqueeze(2) + beta[:, 1:] -
+            pair_log_likelihood).exp()
+        insertion_posteriors = (
+            alpha[:, :, :-1] + insertion.unsqueeze(1) + beta[:, :, 1:] -
+            pair_log_likelihood).exp()
+        substitution_posteriors = (
+            alpha[:, :-1, :-1] + substitution + beta[:, 1:, 1:] -
+            pair_log_likelihood).exp()
+
+        deletion_ids = self._deletion_id(src_sent[:, 1:]).unsqueeze(2)
+        insertion_ids = self._insertion_id(tgt_sent[:, 1:]).unsqueeze(1)
+        substitution_ids = self._substitute_id(
+            src_sent[:, 1:].unsqueeze(2), tgt_sent[:, 1:].unsqueeze(1))
+
+        if expected_counts is None:
+            expected_counts = self.new_count_buffer()
+        expected_counts.scatter_add_(
+            0, deletion_ids.expand(-1, -1, tgt_len).reshape(-1),
+            deletion_posteriors.reshape(-1))
+        expected_counts.scatter_add_(
+            0, insertion_ids.expand(-1, src_len, -1).reshape(-1),
+            insertion_posteriors.reshape(-1))
+        expected_counts.scatter_add_(
+            0, substitution_ids.reshape(-1),
+            substitution_posteriors.reshape(-1))
         return expected_counts
 
+    def new_count_buffer(self):
+        return torch.zeros_like(self.weights)
+
     def viterbi(self, src_sent, tgt_sent):
+        """Length-normalized Viterbi score for a batch of padded pairs.
+
+        In every cell, the predecessor with the best average log-weight per
+        operation is selected (preferring insertion, then deletion, then
+        substitution on ties). The cells of one anti-diagonal do not depend on
+        each other, so they are computed at once.
+
+        Returns:
+            Tensor of shape (batch,) with the exponentiated average
+            log-weight of the best operation sequence of each pair.
+        """
+        batch_size = src_sent.size(0)
         src_len, tgt_len = src_sent.size(1), tgt_sent.size(1)
-
-        action_count = torch.zeros((src_len, tgt_len))
-        alpha = torch.zeros((src_len, tgt_len)) - MINF
-        alpha[0, 0] = 0
-        for t, src_char in enumerate(src_sent[0]):
-            for v, tgt_char in enumerate(tgt_sent[0]):
-                if t == 0 and v == 0:
-                    continue
-
-                deletion_id = self._deletion_id(src_char)
-                insertion_id = self._insertion_id(tgt_char)
-                subsitute_id = self._substitute_id(src_char, tgt_char)
-
-                possible_actions = []
-
-                if v >= 1:
-                    possible_actions.append(
-                        (self.weights[insertion_id] + alpha[t, v - 1],
-                         action_count[t, v - 1] + 1))
-                if t >= 1:
-                    possible_actions.append(
-                        (self.weights[deletion_id] + alpha[t - 1, v],
-                         action_count[t - 1, v] + 1))
-                if v >= 1 and t >= 1:
-                    possible_actions.append(
-                        (self.weights[subsitute_id] + alpha[t - 1, v - 1],
-                         action_count[t - 1, v - 1] + 1))
-
-                best_action_cost, best_action_count = max(
-                    possible_actions, key=lambda x: x[0] / x[1])
-
-                alpha[t, v] = best_action_cost
-                action_count[t, v] = best_action_count
-
-        return torch.exp(alpha[-1, -1] / action_count[-1, -1])
-
-    def maximize_expectation(self, expectations, learning_rate=0.1):
+        deletion, insertion, substitution = self._operation_weights(
+            src_sent, tgt_sent)
+
+        alpha = torch.zeros((batch_size, src_len, tgt_len))
+        action_count = torch.zeros((batch_size, src_len, tgt_len))
+        for diagonal in range(1, src_len + tgt_len - 1):
+            t = torch.arange(
+                max(0, diagonal - tgt_len + 1), min(diagonal, src_len - 1) + 1)
+            v = diagonal - t
+            prev_t, prev_v = (t - 1).clamp(min=0), (v - 1).clamp(min=0)
+
+            candidates = [
+                # insertion
+                (v >= 1,
+                 insertion[:, prev_v] + alpha[:, t, prev_v],
+                 action_count[:, t, prev_v] + 1),
+                # deletion
+                (t >= 1,
+                 deletion[:, prev_t] + alpha[:, prev_t, v],
+                 action_count[:, prev_t, v] + 1),
+                # substitution
+                ((t >= 1) & (v >= 1),
+                 substitution[:, prev_t, prev_v] + alpha[:, prev_t, prev_v],
+                 action_count[:, prev_t, prev_v] + 1)]
+
+            best_cost = torch.zeros((batch_size, t.size(0)))
+            best_count = torch.ones((batch_size, t.size(0)))
+            best_ratio = torch.full((batch_size, t.size(0)), MINF)
+            for valid, cost, count in candidates:
+                ratio = torch.where(
+                    valid.unsqueeze(0), cost / count,
+                    torch.full_like(cost, MINF))
+                better = ratio > best_ratio
+                best_cost = torch.where(better, cost, best_cost)
+                best_count = torch.where(better, count, best_count)
+                best_ratio = torch.where(better, ratio, best_ratio)
+
+            alpha[:, t, v] = best_cost
+            action_count[:, t, v] = best_count
+
+        b_range = torch.arange(batch_size)
+        src_lengths = (src_sent != self.src_pad).sum(1)
+        tgt_lengths = (tgt_sent != self.tgt_pad).sum(1)
+        last_alpha = alpha[b_range, src_lengths - 1, tgt_lengths - 1]
+        last_count = action_count[b_range, src_lengths - 1, tgt_lengths - 1]
+        return torch.exp(last_alpha / last_count)
+
+    def maximize_expectation(self, expected_counts, learning_rate=0.1):
+        """Update the weights from accumulated expected counts (M-step).
+
+        Args:
+            expected_counts: Count vector accumulated by the forward method.
+            learning_rate: Interpolation weight of the new distribution.
+        """
         assert 0 < learning_rate <= 1.0
-        epsilon = torch.log(torch.tensor(1e-16)) + \
-            torch.zeros_like(self.weights)
-        expecation_sum = torch.stack([epsilon] + expectations).logsumexp(0)
-        distribution = (
-            expecation_sum - expecation_sum.logsumexp(0, keepdim=True))
+        expected_counts = expected_counts + 1e-16
+        distribution = torch.log(expected_counts / expected_counts.sum())
+        # the backoff count is shared by all pairs without own parameters
+        if getattr(self, "class_multiplicity", None) is not None:
+            distribution = distribution - self.class_multiplicity.log()
 
         self.weights = torch.stack([
             torch.log(torch.tensor(1 - learning_rate)) + self.weights,
             torch.log(torch.tensor(learning_rate)) + distribution]).logsumexp(0)
+        self._update_sampling_table()
+
+    def export_npz(self, path):
+        """Save the model for the NumPy scorer in statistical_scorer.py.
+
+        Only the vocabularies, the weights and the symbols needed to
+        reconstruct the layout of the weight table are stored.
+        """
+        assert self.table_type == "full"
+        substitution_keys = {}
+        if getattr(self, "substitution_keys", None) is not None:
+            substitution_keys["substitution_keys"] = (
+                self.substitution_keys.cpu().numpy())
+        np.savez(
+            path,
+            src_itos=np.array(self.src_vocab.itos),
+            tgt_itos=np.array(self.tgt_vocab.itos),
+            weights=self.weights.cpu().numpy(),
+            special_ids=np.array([
+                self.src_bos, self.src_eos, self.src_pad,
+                self.tgt_bos, self.tgt_eos, self.tgt_pad]),
+            **substitution_keys)
+
+    def alpha_first_column(self, src_sent):
+        """Forward log-probabilities of an empty target prefix.
+
+        The result has shape (batch, src_len).
+        """
+        deletion_sums = self._deletion_sums(
+            self.weights[self._deletion_id(src_sent[:, 1:])])
+        return deletion_sums + self._log_src_mask(src_sent)
+
+    def alpha_next_column(self, src_sent, alpha_column, tgt_symbols):
+        """Extend forward log-probabilities with one target symbol."""
+        emitted = (
+            self.weights[self._insertion_id(tgt_symbols)].unsqueeze(1) +
+            alpha_column)
+        substituted = (
+            self.weights[self._substitute_id(
+                src_sent[:, 1:], tgt_symbols.unsqueeze(1))] +
+            alpha_column[:, :-1])
+        emitted = torch.cat((
+            emitted[:, :1],
+            torch.logaddexp(emitted[:, 1:], substituted)), dim=1)
+
+        deletion_sums = self._deletion_sums(
+            self.weights[self._deletion_id(src_sent[:, 1:])])
+        return (self._add_deletions(emitted, deletion_sums) +
+                self._log_src_mask(src_sent))
+
+    def next_symbol_scores(self, src_sent, alpha_column):
+        """Unnormalized log-scores of the next target symbol for a batch."""
+        tgt_symbols = torch.arange(
+            self.tgt_symbol_count, device=src_sent.device)
+        insertion_scores = (
+            alpha_column.logsumexp(1, keepdim=True) +
+            self.weights[self._insertion_id(tgt_symbols)].unsqueeze(0))
+        subs_scores = (
+            alpha_column[:, :-1].unsqueeze(2) +
+            self.weights[self._substitute_id(
+                src_sent[:, 1:].unsqueeze(2),
+                tgt_symbols.view(1, 1, -1))]).logsumexp(1)
+        scores = torch.logaddexp(insertion_scores, subs_scores)
+        scores[:, [self.tgt_bos, self.tgt_pad]] = MINF
+        return scores
+
+    def _update_sampling_table(self):
+        """Precompute distributions of the next operation for decoding.
+
+        For every source symbol, it is a distribution over inserting each of
+        the target symbols, substituting the source symbol with each of the
+        target symbols and deleting the source symbol. Operations producing
+        padding, start or unknown symbols are excluded, which is the same as
+        rejecting them when sampling. It needs to be called whenever the
+        weights change.
+        """
+        src_symbols = torch.arange(self.src_symbol_count)
+        tgt_symbols = torch.arange(self.tgt_symbol_count)
+        excluded = torch.zeros(self.tgt_symbol_count, dtype=torch.bool)
+        excluded[[self.tgt_pad, self.tgt_bos, self.tgt_vocab["<unk>"]]] = True
+
+        insertion = self.weights[self._insertion_id(tgt_symbols)].expand(
+            self.src_symbol_count, -1)
+        substitution = self.weights[self._substitute_id(
+            src_symbols.unsqueeze(1), tgt_symbols.unsqueeze(0))]
+        deletion = self.weights[self._deletion_id(src_symbols)].unsqueeze(1)
+        self.sampling_table = torch.cat((
+            insertion.masked_fill(excluded, MINF),
+            substitution.masked_fill(excluded, MINF),
+            deletion), dim=1).softmax(1)
 
     def decode(self, src_sent, max_len=100, samples=10):
+        """Decode by sampling operation sequences and keeping the best one.
+
+        The samples for all inputs in the batch are drawn in parallel from
+        the precomputed operation distributions. The sampled target strings
+        are then rescored at once with the forward algorithm.
+
+        Args:
+            src_sent: Padded batch of source sequences.
+            max_len: Maximum number of sampled operations.
+            samples: Number of samples per input.
+
+        Returns:
+            List with a list of target symbol indices (without the start and
+            end symbols) for each input.
+        """
         assert samples > 0, "With zero samples nothing can be decoded."
-        best_tgt_sent = []
-        best_tgt_sent_score = MINF
-
-        for _ in range(samples):
-            tgt_sent = []
-            src_pos = 1
-            src_char = src_sent[0, src_pos]
-
-            op_count = 0
-            for _ in range(max_len):
-                if src_pos == src_sent.size(1) - 1:
-                    break
-
-                src_char = src_sent[0, src_pos]
-                insert_weights = [
-                    self.weights[self._insertion_id(i)]
-                    for i in range(self.tgt_symbol_count)]
-                delete_weight = [self.weights[self._deletion_id(src_char)]]
-                substitute_weight = [
-                    self.weights[self._substitute_id(src_char, i)]
-                    for i in range(self.tgt_symbol_count)]
-
-                distr = torch.tensor(insert_weights + substitute_weight + delete_weight).exp()
-                distr /= distr.sum()
-
-                next_symb = self.tgt_pad
-                while next_symb in [self.tgt_pad, self.tgt_bos, self.tgt_vocab["<unk>"]]:
-                    next_op = torch.multinomial(distr, 1)[0]
-                    # If it is delete, we are done
-                    if next_op == 2 * self.tgt_symbol_count:
-                        break
-                    # Tgt symbol candidate
-                    next_symb = next_op % self.tgt_symbol_count
-                op_count += 1
-
-                if next_op == 2 * self.tgt_symbol_count:
-                    src_pos += 1 # DELETE OP
-                    continue
-
-                if next_symb == self.tgt_eos:
-                    break
-                tgt_sent.append(next_op % self.tgt_symbol_count)
-                if next_op > self.tgt_symbol_count:
-                    src_pos += 1 # IT WAS A SUBSTITUTION
-
-            if not tgt_sent:
-                continue
-
-            score = self._forward_evaluation(
-                src_sent, torch.tensor([tgt_sent]))[-1, -1]# / op_count
-            if score > best_tgt_sent_score:
-                best_tgt_sent_score = score
-                best_tgt_sent = tgt_sent
-
-        return tgt_sent
+        if getattr(self, "sampling_table", None) is None:
+            self._update_sampling_table()
+
+        batch_size = src_sent.size(0)
+        chain_src = src_sent.repeat_interleave(samples, dim=0)
+        chain_count = chain_src.size(0)
+        c_range = torch.arange(chain_count)
+        src_last = (chain_src != self.src_pad).sum(1) - 1
+
+        src_pos = torch.ones(chain_count, dtype=torch.long)
+        # one more column for the end symbol after max_len emitted symbols
+        output = torch.full(
+            (chain_count, max_len + 1), self.tgt_pad, dtype=torch.long)
+        output_len = torch.zeros(chain_count, dtype=torch.long)
+        finished = src_pos >= src_last
+        for _ in range(max_len):
+            if finished.all():
+                break
+            next_op = torch.multinomial(
+                self.sampling_table[chain_src[c_range, src_pos]], 1)[:, 0]
+            deleted = next_op == 2 * self.tgt_symbol_count
+            next_symb = next_op % self.tgt_symbol_count
+            ended = ~deleted & (next_symb == self.tgt_eos)
+            emitted = ~finished & ~deleted & ~ended
+
+            output[c_range[emitted], output_len[emitted]] = next_symb[emitted]
+            output_len += emitted.long()
+            # deletion or substitution moves in the source
+            substituted = emitted & (next_op >= self.tgt_symbol_count)
+            src_pos += (~finished & (deleted | substituted)).long()
+            finished = finished | ended | (src_pos >= src_last)
+
+        tgt_len = int(output_len.max()) + 2
+        tgt_sent = torch.cat((
+            torch.full((chain_count, 1), self.tgt_bos, dtype=torch.long),
+            output[:, :tgt_len - 1]), dim=1)
+        tgt_sent[c_range, output_len + 1] = self.tgt_eos
+        scores = self._forward_evaluation(chain_src, tgt_sent)[
+            c_range, src_last, output_len + 1]
+        # empty samples are only used when nothing else was sampled
+        scores[output_len == 0] = MINF
+
+        best_chains = (
+            torch.arange(batch_size) * samples +
+            scores.view(batch_size, samples).argmax(1))
+        return [output[chain, :output_len[chain]].tolist()
+                for chain in best_chains.tolist()]
+
+    def beam_search(self, src_sent, beam_size=10, len_norm=1.0, max_len=100):
+        """Decode with beam search over operation sequences.
+
+        A hypothesis is a position of the source cursor and the emitted
+        target prefix. It is extended by the operations from the
+        precomputed distributions and finishes when it emits the end symbol
+        or when the whole source is consumed. In every step, twice the beam
+        size of the best extensions are considered: the finished ones leave
+        the beam and only the best one for each input is kept, the beam
+        continues with the best unfinished ones. The search stops when no
+        unfinished hypothesis can beat the best finished one (the scores
+        only decrease and there are at most max_len operations).
+
+        Args:
+            src_sent: Padded batch of source sequences.
+            beam_size: Number of hypotheses kept for each input.
+            len_norm: Exponent of the normalization by the number of
+                operations.
+            max_len: Maximum number of operations.
+
+        Returns:
+            List with a list of target symbol indices (without the start and
+            end symbols) for each input.
+        """
+        if getattr(self, "sampling_table", None) is None:
+            self._update_sampling_table()
+        log_table = self.sampling_table.log()
+        op_count = log_table.size(1)
+
+        batch_size = src_sent.size(0)
+        b_range = torch.arange(batch_size)
+        flat_size = batch_size * beam_size
+        f_range = torch.arange(flat_size)
+        flat_src = src_sent.repeat_interleave(beam_size, dim=0)
+        src_last = (src_sent != self.src_pad).sum(1, keepdim=True) - 1
+
+        src_pos = torch.ones(flat_size, dtype=torch.long)
+        output = torch.full(
+            (flat_size, max_len), self.tgt_pad, dtype=torch.long)
+        output_len = torch.zeros(flat_size, dtype=torch.long)
+        # the best finished hypothesis for each input, with its normalized
+        # score; an empty source is finished from the beginning
+        empty_src = src_last[:, 0] <= 1
+        best_scores = torch.where(
+            empty_src, torch.zeros(batch_size), torch.full((batch_size,), MINF))
+        best_output = torch.full(
+            (batch_size, max_len), self.tgt_pad, dtype=torch.long)
+        best_len = torch.zeros(batch_size, dtype=torch.long)
+        # only the first hypothesis is alive in the beginning
+        scores = torch.full((batch_size, beam_size), MINF)
+        scores[:, 0] = torch.where(empty_src, MINF, torch.tensor(0.))
+        scores = scores.view(-1)
+
+        # all hypotheses in the beam have the same number of operations
+        for action_count in range(1, max_len + 1):
+            candidate_scores, candidate_ids = (
+                scores.unsqueeze(1) + log_table[flat_src[f_range, src_pos]]
+            ).view(batch_size, -1).topk(2 * beam_size, dim=1)
+            hypothesis_ids = (
+                b_range.unsqueeze(1) * beam_size + candidate_ids // op_count)
+            next_op = candidate_ids % op_count
+
+            deleted = next_op == 2 * self.tgt_symbol_count
+            next_symb = next_op % self.tgt_symbol_count
+            ended = ~deleted & (next_symb == self.tgt_eos)
+            emitted = ~deleted & ~ended
+            substituted = emitted & (next_op >= self.tgt_symbol_count)
+            next_src_pos = (
+                src_pos[hypothesis_ids] + (deleted | substituted).long())
+            finished = ended | (next_src_pos >= src_last)
+
+            # finished candidates replace the best finished hypothesis
+            finished_scores, finished_ids = torch.where(
+                finished, candidate_scores / action_count ** len_norm,
+                torch.full_like(candidate_scores, MINF)).max(1)
+            improved = finished_scores > best_scores
+            finished_ids = finished_ids[improved]
+            improved_hyps = hypothesis_ids[improved, finished_ids]
+            improved_emitted = emitted[improved, finished_ids]
+            best_scores[improved] = finished_scores[improved]
+            best_output[improved] = output[improved_hyps]
+            best_len[improved] = output_len[improved_hyps]
+            improved_ids = b_range[improved][improved_emitted]
+            best_output[improved_ids, best_len[improved_ids]] = next_symb[
+                improved, finished_ids][improved_emitted]
+            best_len[improved_ids] += 1
+
+            # the beam continues with the best unfinished candidates
+            scores, kept = torch.where(
+                finished, torch.full_like(candidate_scores, MINF),
+                candidate_scores).topk(beam_size, dim=1)
+            scores = scores.view(-1)
+            kept_hyps = hypothesis_ids.gather(1, kept).view(-1)
+            kept_emitted = emitted.gather(1, kept).view(-1)
+            # finished candidates fill the beam with -inf scores if there
+            # are not enough unfinished ones, they must not leave the source
+            src_pos = torch.min(next_src_pos, src_last).gather(
+                1, kept).view(-1)
+            output = output[kept_hyps]
+            output_len = output_len[kept_hyps]
+            output[f_range[kept_emitted], output_len[kept_emitted]] = (
+                next_symb.gather(1, kept).view(-1)[kept_emitted])
+            output_len += kept_emitted.long()
+
+            upper_bounds = scores / max_len ** len_norm
+            if (upper_bounds.view(batch_size, beam_size) <=
+                    best_scores.unsqueeze(1)).all():
+                break
+
+        # unfinished hypotheses are used only if there is no finished one
+        no_finished = best_scores == MINF
+        best_unfinished = (
+            b_range * beam_size +
+            scores.view(batch_size, beam_size).argmax(1))[no_finished]
+        best_output[no_finished] = output[best_unfinished]
+        best_len[no_finished] = output_len[best_unfinished]
+        return [best_output[i, :best_len[i]].tolist()
+                for i in range(batch_size)]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""Score string pairs with an exported statistical model using only NumPy.
+
+The model needs to be exported first using the export_statistical_model.py
+script. Unlike loading the PyTorch model, this does not import PyTorch nor
+Transformers, so it starts within milliseconds.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+
+class StatisticalScorer:
+    """NumPy implementation of the statistical edit distance scoring.
+
+    The weights are organized in the same way as in EditDistStatModel with
+    the full table: deletions of source symbols, insertions of target
+    symbols and substitutions of all source-target symbol pairs. With sparse
+    substitutions, only the pairs in substitution keys have their own
+    weights, the others share the last weight.
+    """
+    def __init__(self, src_itos, tgt_itos, weights, special_ids,
+                 substitution_keys=None):
+        self.src_itos = list(src_itos)
+        self.tgt_itos = list(tgt_itos)
+        self.src_stoi = {s: i for i, s in enumerate(self.src_itos)}
+        self.tgt_stoi = {s: i for i, s in enumerate(self.tgt_itos)}
+        self.weights = weights.astype(np.float32)
+        (self.src_bos, self.src_eos, self.src_pad,
+         self.tgt_bos, self.tgt_eos, self.tgt_pad) = (
+             int(i) for i in special_ids)
+        self.src_symbol_count = len(self.src_itos)
+        self.tgt_symbol_count = len(self.tgt_itos)
+        self.substitution_keys = substitution_keys
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as model:
+            return cls(
+                model["src_itos"], model["tgt_itos"], model["weights"],
+                model["special_ids"],
+                model["substitution_keys"]
+                if "substitution_keys" in model else None)
+
+    def _encode(self, strings, stoi, bos, eos, pad, tokenized):
+        seqs = []
+        for string in strings:
+            tokens = string.split() if tokenized else list(string)
+            # unknown symbols get index 0 (<unk>) as with torchtext vocab
+            seqs.append(
+                [bos] + [stoi.get(tok, 0) for tok in tokens] + [eos])
+        max_len = max(len(seq) for seq in seqs)
+        return np.array(
+            [seq + [pad] * (max_len - len(seq)) for seq in seqs],
+            dtype=np.int64)
+
+    def encode_src(self, strings, tokenized=False):
+        """Convert source strings into a padded index matrix."""
+        return self._encode(
+            strings, self.src_stoi, self.src_bos, self.src_eos,
+            self.src_pad, tokenized)
+
+    def encode_tgt(self, strings, tokenized=False):
+        """Convert target strings into a padded index matrix."""
+        return self._encode(
+            strings, self.tgt_stoi, self.tgt_bos, self.tgt_eos,
+            self.tgt_pad, tokenized)
+
+    def _operation_weights(self, src_sent, tgt_sent):
+        deletion = self.weights[src_sent[:, 1:]]
+        insertion = self.weights[self.src_symbol_count + tgt_sent[:, 1:]]
+        substitution = self.weights[self._substitution_ids(
+            src_sent[:, 1:, None], tgt_sent[:, None, 1:])]
+        return deletion, insertion, substitution
+
+    def _substitution_ids(self, src_symbols, tgt_symbols):
+        keys = self.tgt_symbol_count * src_symbols + tgt_symbols
+        offset = self.src_symbol_count + self.tgt_symbol_count
+        if self.substitution_keys is None:
+            return offset + keys
+        positions = np.minimum(
+            np.searchsorted(self.substitution_keys, keys),
+            self.substitution_keys.size - 1)
+        return np.where(
+            self.substitution_keys[positions] == keys,
+            offset + positions, self.weights.size - 1)
+
+    def _last_cells(self, src_sent, tgt_sent):
+        return (
+            np.arange(src_sent.shape[0]),
+            (src_sent != self.src_pad).sum(1) - 1,
+            (tgt_sent != self.tgt_pad).sum(1) - 1)
+
+    def log_likelihood(self, src_sent, tgt_sent):
+        """Log-probability of padded batches of pairs (forward algorithm)."""
+        deletion, insertion, substitution = self._operation_weights(
+            src_sent, tgt_sent)
+        deletion_sums = np.concatenate((
+            np.zeros_like(deletion[:, :1]), deletion.cumsum(1)), axis=1)
+        log_src_mask = np.where(
+            src_sent == self.src_pad, -np.inf, 0.).astype(np.float32)
+
+        column = deletion_sums + log_src_mask
+        columns = [column]
+        for v in range(tgt_sent.shape[1] - 1):
+            emitted = insertion[:, v:v + 1] + column
+            substituted = substitution[:, :, v] + column[:, :-1]
+            emitted = np.concatenate((
+                emitted[:, :1],
+                np.logaddexp(emitted[:, 1:], substituted)), axis=1)
+            column = deletion_sums + np.logaddexp.accumulate(
+                emitted - deletion_sums, axis=1) + log_src_mask
+            columns.append(column)
+        alpha = np.stack(columns, axis=2)
+        return alpha[self._last_cells(src_sent, tgt_sent)]
+
+    def viterbi(self, src_sent, tgt_sent):
+        """Length-normalized Viterbi score of padded batches of pairs.
+
+        The same as EditDistStatModel.viterbi.
+        """
+        batch_size, src_len = src_sent.shape
+        tgt_len = tgt_sent.shape[1]
+        deletion, insertion, substitution = self._operation_weights(
+            src_sent, tgt_sent)
+
+        alpha = np.zeros((batch_size, src_len, tgt_len), dtype=np.float32)
+        action_count = np.zeros(
+            (batch_size, src_len, tgt_len), dtype=np.float32)
+        for diagonal in range(1, src_len + tgt_len - 1):
+            t = np.arange(
+                max(0, diagonal - tgt_len + 1), min(diagonal, src_len - 1) + 1)
+            v = diagonal - t
+            prev_t, prev_v = np.maximum(t - 1, 0), np.maximum(v - 1, 0)
+
+            candidates = [
+                (v >= 1,
+                 insertion[:, prev_v] + alpha[:, t, prev_v],
+                 action_count[:, t, prev_v] + 1),
+                (t >= 1,
+                 deletion[:, prev_t] + alpha[:, prev_t, v],
+                 action_count[:, prev_t, v] + 1),
+                ((t >= 1) & (v >= 1),
+                 substitution[:, prev_t, prev_v] + alpha[:, prev_t, prev_v],
+                 action_count[:, prev_t, prev_v] + 1)]
+
+            best_cost = np.zeros((batch_size, t.size), dtype=np.float32)
+            best_count = np.ones((batch_size, t.size), dtype=np.float32)
+            best_ratio = np.full((batch_size, t.size), -np.inf)
+            for valid, cost, count in candidates:
+                ratio = np.where(valid[None], cost / count, -np.inf)
+                better = ratio > best_ratio
+                best_cost = np.where(better, cost, best_cost)
+                best_count = np.where(better, count, best_count)
+                best_ratio = np.where(better, ratio, best_ratio)
+
+            alpha[:, t, v] = best_cost
+            action_count[:, t, v] = best_count
+
+        last_cells = self._last_cells(src_sent, tgt_sent)
+        return np.exp(alpha[last_cells] / action_count[last_cells])
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("model", type=str, help="Exported model (.npz).")
+    parser.add_argument(
+        "data", type=argparse.FileType("r"), nargs="?", default=sys.stdin,
+        help="Tab-separated string pairs.")
+    parser.add_argument(
+        "--score", default="viterbi", choices=["viterbi", "log_likelihood"])
+    parser.add_argument("--src-tokenized", default=False, action="store_true")
+    parser.add_argument("--tgt-tokenized", default=False, action="store_true")
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    scorer = StatisticalScorer.load(args.model)
+    score_function = getattr(scorer, args.score)
+
+    def score_batch(batch):
+        src_sent = scorer.encode_src(
+            [src for src, _ in batch], args.src_tokenized)
+        tgt_sent = scorer.encode_tgt(
+            [tgt for _, tgt in batch], args.tgt_tokenized)
+        for score in score_function(src_sent, tgt_sent):
+            print(score)
+
+    batch = []
+    for line in args.data:
+        batch.append(line.rstrip("\n").split("\t")[:2])
+        if len(batch) >= args.batch_size:
+            score_batch(batch)
+            batch = []
+    if batch:
+        score_batch(batch)
+    args.data.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""Build a source-to-target symbol table for vocabulary shortlisting.
+
+During decoding, only target symbols that are likely given the source symbols
+of the input (plus the end symbol) get scored. The table is estimated either
+from co-occurrences in training string pairs or from the substitution
+weights of a trained statistical model.
+"""
+
+import argparse
+import logging
+
+import torch
+
+from transliteration_utils import load_vocab
+
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+SPECIAL_SYMBOLS = ["<unk>", "<pad>", "<s>", "</s>"]
+
+
+class TargetShortlist:
+    """Table of target symbol probabilities given a source symbol.
+
+    Args:
+        table: Tensor of shape (src_vocab_size, tgt_vocab_size) with
+            (unnormalized) association weights.
+        src_ignored: Source symbols (padding and string boundaries) that are
+            not used for selecting the target symbols.
+        coverage: For each source symbol, the most probable target symbols
+            are taken until they cover this probability mass.
+        max_symbols: Maximum number of target symbols per source symbol.
+        min_mass: If the selected target symbols of any source symbol cover
+            less than this mass of the table, the whole target vocabulary is
+            used for the input (i.e., decoding of the input is the same as
+            without the shortlist).
+    """
+    def __init__(self, table, src_ignored, tgt_pad, tgt_eos, coverage=0.99,
+                 max_symbols=50, min_mass=0.9):
+        self.table = table.float()
+        self.src_ignored = set(src_ignored)
+        self.tgt_pad = tgt_pad
+        self.tgt_eos = tgt_eos
+        self.coverage = coverage
+        self.max_symbols = max_symbols
+        self.min_mass = min_mass
+
+        row_sums = self.table.sum(1, keepdim=True)
+        probs = torch.where(
+            row_sums > 0, self.table / row_sums.clamp(min=1e-16),
+            torch.zeros_like(self.table))
+        sorted_probs, sorted_ids = probs.sort(1, descending=True)
+        cumulative = sorted_probs.cumsum(1)
+
+        # for each source symbol, the most probable target symbols covering
+        # the required mass, and whether they cover at least the minimum mass
+        counts = ((cumulative < coverage).sum(1) + 1).clamp(
+            max=min(max_symbols, self.tgt_symbol_count))
+        masses = cumulative.gather(1, (counts - 1).unsqueeze(1)).squeeze(1)
+        self.symbol_masks = torch.zeros_like(probs, dtype=torch.bool).scatter(
+            1, sorted_ids,
+            torch.arange(self.tgt_symbol_count).unsqueeze(0) <
+            counts.unsqueeze(1))
+        self.exact_sources = masses < min_mass
+        ignored = torch.tensor(sorted(self.src_ignored), dtype=torch.long)
+        self.symbol_masks[ignored] = False
+        self.exact_sources[ignored] = False
+
+    @property
+    def tgt_symbol_count(self):
+        return self.table.size(1)
+
+    def for_batch(self, src_sent, device=None):
+        """Shortlisted target symbols for a batch of source sequences.
+
+        Returns:
+            Tensor of target symbol indices of shape (batch, shortlist_size)
+            padded with the padding symbol and a log-domain mask of the same
+            shape that is zero for valid indices and -inf for the padding.
+        """
+        src_sent = src_sent.cpu()
+        selected = self.symbol_masks[src_sent].any(1)
+        selected[:, self.tgt_eos] = True
+        selected[:, self.tgt_pad] = False
+        selected[self.exact_sources[src_sent].any(1)] = True
+
+        counts = selected.sum(1)
+        shortlist_size = int(counts.max())
+        symbol_range = torch.arange(self.tgt_symbol_count)
+        # the selected symbols first, in the order of their indices
+        ids = torch.where(
+            selected, symbol_range, symbol_range + self.tgt_symbol_count).sort(
+                1)[0][:, :shortlist_size]
+        valid = symbol_range[:shortlist_size].unsqueeze(0) < counts.unsqueeze(1)
+        ids = ids.masked_fill(~valid, self.tgt_pad)
+        mask = torch.zeros(valid.shape).masked_fill(~valid, float("-inf"))
+        return ids.to(device), mask.to(device)
+
+    @classmethod
+    def from_cooccurrences(cls, pairs, src_stoi, tgt_stoi, src_vocab_size,
+                           tgt_vocab_size, src_tokenized=False,
+                           tgt_tokenized=False, **kwargs):
+        """Estimate the table from co-occurrences in training string pairs.
+
+        A target symbol co-occurs with a source symbol if they appear in the
+        same string pair (each pair is counted at most once).
+        """
+        table = torch.zeros((src_vocab_size, tgt_vocab_size))
+        for src, tgt in pairs:
+            src_ids = [src_stoi[s] for s in (
+                src.split() if src_tokenized else list(src))]
+            tgt_ids = [tgt_stoi[s] for s in (
+                tgt.split() if tgt_tokenized else list(tgt))]
+            if not src_ids or not tgt_ids:
+                continue
+            table[torch.tensor(src_ids).unsqueeze(1),
+                  torch.tensor(tgt_ids).unsqueeze(0)] += 1
+        return cls(
+            table, [src_stoi[s] for s in ["<pad>", "<s>", "</s>"]],
+            tgt_stoi["<pad>"], tgt_stoi["</s>"], **kwargs)
+
+    @classmethod
+    def from_statistical_model(cls, model, src_itos, tgt_itos, **kwargs):
+        """Use substitution probabilities of a trained statistical model.
+
+        The model vocabularies can differ from the vocabularies of the neural
+        model, so the symbols are mapped by their strings.
+        """
+        subs_weights = model.weights[model._substitute_id(
+            torch.arange(model.src_symbol_count).unsqueeze(1),
+            torch.arange(model.tgt_symbol_count).unsqueeze(0))].exp()
+
+        src_ids = torch.tensor([model.src_vocab[s] for s in src_itos])
+        tgt_ids = torch.tensor([model.tgt_vocab[s] for s in tgt_itos])
+        table = subs_weights[src_ids][:, tgt_ids]
+        # symbols unknown to the statistical model get no evidence
+        known_src = torch.tensor([
+            s in model.src_vocab.stoi and s not in SPECIAL_SYMBOLS
+            for s in src_itos])
+        known_tgt = torch.tensor([
+            s in model.tgt_vocab.stoi and s not in SPECIAL_SYMBOLS
+            for s in tgt_itos])
+        table = table * known_src.float().unsqueeze(1)
+        table = table * known_tgt.float().unsqueeze(0)
+
+        return cls(
+            table, [src_itos.index(s) for s in ["<pad>", "<s>", "</s>"]],
+            tgt_itos.index("<pad>"), tgt_itos.index("</s>"), **kwargs)
+
+    def save(self, path):
+        torch.save({
+            "table": self.table.cpu(),
+            "src_ignored": sorted(self.src_ignored),
+            "tgt_pad": self.tgt_pad,
+            "tgt_eos": self.tgt_eos}, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        state = torch.load(path, map_location="cpu")
+        return cls(
+            state["table"], state["src_ignored"], state["tgt_pad"],
+            state["tgt_eos"], **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("src_vocab", type=argparse.FileType("r"))
+    parser.add_argument("tgt_vocab", type=argparse.FileType("r"))
+    parser.add_argument("output", type=str,
+                        help="Path where the table gets saved.")
+    parser.add_argument(
+        "--train-data", type=argparse.FileType("r"), default=None,
+        help="Tab-separated string pairs to count co-occurrences in.")
+    parser.add_argument(
+        "--statistical-model", type=argparse.FileType("rb"), default=None,
+        help="Trained statistical model to take substitution weights from.")
+    parser.add_argument("--src-tokenized", default=False, action="store_true")
+    parser.add_argument("--tgt-tokenized", default=False, action="store_true")
+    args = parser.parse_args()
+
+    if (args.train_data is None) == (args.statistical_model is None):
+        parser.error(
+            "Exactly one of --train-data and --statistical-model is needed.")
+
+    src_vocab, src_stoi = load_vocab(args.src_vocab)
+    tgt_vocab, tgt_stoi = load_vocab(args.tgt_vocab)
+    logging.info("Vocabularies loaded.")
+
+    if args.train_data is not None:
+        pairs = (line.rstrip("\n").split("\t")[:2] for line in args.train_data)
+        shortlist = TargetShortlist.from_cooccurrences(
+            pairs, src_stoi, tgt_stoi, len(src_vocab), len(tgt_vocab),
+            src_tokenized=args.src_tokenized,
+            tgt_tokenized=args.tgt_tokenized)
+        args.train_data.close()
+    else:
+        shortlist = TargetShortlist.from_statistical_model(
+            torch.load(args.statistical_model), src_vocab, tgt_vocab)
+    logging.info("Table estimated.")
+
+    shortlist.save(args.output)
+    logging.info("Table saved to %s.", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -42,9 +42,28 @@ def main():
     parser.add_argument("--len-norm", type=float, default=1.0,
                         help="Length normalization factor.")
     parser.add_argument("--output", type=argparse.FileType("w"), default=None)
+    parser.add_argument(
+        "--time-budget", type=float, default=None,
+        help="Time limit in seconds for decoding a single input. When "
+             "exceeded, the best hypothesis so far is returned.")
+    parser.add_argument(
+        "--quantize", default=False, action="store_true",
+        help="Run a dynamically quantized (int8) model on CPU.")
+    parser.add_argument(
+        "--scripted", default=False, action="store_true",
+        help="The model is a TorchScript module exported by "
+             "export_torchscript.py.")
     args = parser.parse_args()
 
-    model = torch.load(args.model)
+    if args.scripted and (args.quantize or args.time_budget is not None):
+        parser.error("Scripted models cannot be quantized and do not "
+                     "support the time budget.")
+
+    if args.scripted:
+        model = torch.jit.load(args.model)
+    else:
+        model = torch.load(
+            args.model, map_location="cpu" if args.quantize else None)
 
     if hasattr(model, 'ar_pad'):
         model.src_pad = model.ar_pad
@@ -55,19 +74,26 @@ def main():
         model.tgt_encoder = model.en_encoder
         model.tgt_symbol_count = model.en_symbol_count
 
-    if (not isinstance(model, Seq2SeqModel) and
+    if (not isinstance(model, (Seq2SeqModel, torch.jit.ScriptModule)) and
             isinstance(model.src_encoder, CNNEncoder)):
         if not hasattr(model.src_encoder, "layers"):
             pass
         # model.encoder.
 
     logging.info("Model loaded.")
+    if args.quantize:
+        if isinstance(model, Seq2SeqModel):
+            parser.error("Only edit distance models can be quantized.")
+        model = model.quantize()
+        logging.info("Model quantized.")
+    device = torch.device("cpu") if args.scripted else model.device
     _, src_stoi = load_vocab(args.src_vocab)
     tgt_vocab, _ = load_vocab(args.tgt_vocab)
     logging.info("Vocabularies loaded.")
 
     tgt_references = []
     tgt_hypotheses = []
+    truncated_count = 0
     for line in args.input:
         line_split = line.strip().split("\t")
         string_1, string_2 = line_split[0], line_split[1]
@@ -80,13 +106,21 @@ def main():
 
         string_1_idx = [src_stoi[s] for s in string_1_tok]
 
-        decoded = model.beam_search(
-            # pylint: disable=not-callable
-            torch.tensor([string_1_idx]).cuda(),
-            # pylint: enable=not-callable
-            beam_size=args.beam_size,
-            len_norm=args.len_norm)
-
+        # pylint: disable=not-callable
+        src_sent = torch.tensor([string_1_idx]).to(device)
+        # pylint: enable=not-callable
+        if args.scripted:
+            decoded = model.beam_search(
+                src_sent, args.beam_size, args.len_norm)[0][:, 0]
+        else:
+            decoded = model.beam_search(
+                src_sent,
+                beam_size=args.beam_size,
+                len_norm=args.len_norm,
+                time_budget=args.time_budget)
+
+        if args.time_budget is not None:
+            truncated_count += int(decoded[-1][0])
         if isinstance(decoded, tuple):
             decoded = decoded[0]
 
@@ -106,6 +140,10 @@ def main():
 
     logging.info("WER: %.10g", wer)
     logging.info("CER: %.10g", cer)
+    if args.time_budget is not None:
+        logging.info(
+            "%d outputs were truncated because of the time budget.",
+            truncated_count)
 
 
 if __name__ == "__main__":
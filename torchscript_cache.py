@@ -0,0 +1,87 @@
+"""Lazy TorchScript compilation of functions with a cache on disk.
+
+Decorating a function with @torch.jit.script compiles it when the module is
+imported, so every script importing the module pays for the compilation,
+even if it never calls the function. Functions decorated with `lazy_script`
+are compiled at their first call and the compiled function is saved into a
+cache directory, so that later processes only load it.
+
+The cache directory is given by the NSED_TORCHSCRIPT_CACHE environment
+variable, by default it is ~/.cache/neural_string_edit_distance. The cache
+files are keyed by the source code of the function and the PyTorch version.
+If the cache cannot be used, the function is just compiled.
+
+Saving and loading the compiled functions was only tried with PyTorch 2.2,
+it is untested with the pinned PyTorch 1.6. If saving is not supported
+there, a warning is logged and the functions are compiled in every process
+as with @torch.jit.script.
+"""
+
+import functools
+import hashlib
+import inspect
+import logging
+import os
+
+import torch
+
+
+def cache_directory():
+    return os.environ.get(
+        "NSED_TORCHSCRIPT_CACHE",
+        os.path.join(
+            os.path.expanduser("~"), ".cache", "neural_string_edit_distance"))
+
+
+class LazyScriptFunction:
+    """Function compiled by TorchScript at its first call.
+
+    The original Python function is available as `python_function`, so
+    it can be compiled as a part of other TorchScript code.
+    """
+    def __init__(self, function):
+        functools.update_wrapper(self, function)
+        self.python_function = function
+        self._compiled = None
+
+    def _cache_path(self):
+        key = hashlib.sha1((
+            torch.__version__ +
+            inspect.getsource(self.python_function)).encode("utf-8"))
+        return os.path.join(
+            cache_directory(),
+            f"{self.python_function.__name__}_{key.hexdigest()}.pt")
+
+    def _load_or_compile(self):
+        path = self._cache_path()
+        if os.path.exists(path):
+            try:
+                return torch.jit.load(path)
+            except (OSError, RuntimeError) as exc:
+                logging.warning("Cannot load cached %s: %s", path, exc)
+
+        compiled = torch.jit.script(self.python_function)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # processes compiling at the same time must not see partial files
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            compiled.save(tmp_path)
+            os.replace(tmp_path, path)
+        except (AttributeError, OSError, RuntimeError) as exc:
+            logging.warning("Cannot save compiled function to %s: %s",
+                            path, exc)
+        return compiled
+
+    def compiled(self):
+        """The compiled function, loaded or compiled on the first call."""
+        if self._compiled is None:
+            self._compiled = self._load_or_compile()
+        return self._compiled
+
+    def __call__(self, *args):
+        return self.compiled()(*args)
+
+
+def lazy_script(function):
+    """Decorator replacing @torch.jit.script with the lazy compilation."""
+    return LazyScriptFunction(function)
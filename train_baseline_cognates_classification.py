@@ -20,6 +20,7 @@ from transformers import (
     BertForSequenceClassification, BertConfig)
 
 from experiment import experiment_logging, get_timestamp, save_vocab
+from transformer import SequencePacking
 
 
 def cat_examples(dataset, text_field):
@@ -28,12 +29,34 @@ def cat_examples(dataset, text_field):
         example.text = example.src + example.tgt
 
 
+def classify(model, text, pad_id, packed_token_budget=None):
+    """Classification logits, optionally with packed input sequences.
+
+    Without packing, the padding is not masked (as the model was originally
+    trained). With packing, the first token of every sequence is pooled.
+    """
+    if packed_token_budget is None:
+        return model(text)[0]
+
+    packing = SequencePacking(text != pad_id, packed_token_budget)
+    states = model.bert(
+        packing.pack(text), attention_mask=packing.attention_mask.long(),
+        position_ids=packing.position_ids)[0]
+    first_states = states.reshape(-1, states.size(2))[packing.starts]
+    pooled = model.bert.pooler(first_states.unsqueeze(1))
+    return model.classifier(model.dropout(pooled))
+
+
 def main():
     parser = argparse.ArgumentParser(__doc__)
     parser.add_argument("data_prefix", type=str)
     parser.add_argument("--hidden-size", default=256, type=int)
     parser.add_argument("--attention-heads", default=8, type=int)
     parser.add_argument("--layers", default=4, type=int)
+    parser.add_argument(
+        "--packed-token-budget", default=None, type=int,
+        help="Pack strings into rows of this length instead of padding "
+             "them.")
     parser.add_argument("--batch-size", default=512, type=int)
     parser.add_argument("--delay-update", default=1, type=int,
                         help="Update model every N steps.")
@@ -100,6 +123,7 @@ def main():
         num_labels=2)
 
     model = BertForSequenceClassification(config).to(device)
+    pad_id = text_field.vocab.stoi["<pad>"]
 
     optimizer = optim.Adam(model.parameters())
 
@@ -114,9 +138,10 @@ def main():
                 break
             step += 1
 
-            loss, _ = model(
-                train_batch.text.to(device),
-                labels=train_batch.label.to(device))
+            logits = classify(
+                model, train_batch.text.to(device), pad_id,
+                args.packed_token_budget)
+            loss = F.cross_entropy(logits, train_batch.label.to(device))
             loss.backward()
 
             logging.info("step: %d, train loss = %.3g", step, loss)
@@ -129,7 +154,9 @@ def main():
                     false_scores = []
                     true_scores = []
                     for j, val_ex in enumerate(val_iter):
-                        score = F.softmax(model(val_ex.text)[0], dim=1)[:, 1]
+                        score = F.softmax(classify(
+                            model, val_ex.text, pad_id,
+                            args.packed_token_budget), dim=1)[:, 1]
                         for prob, label in zip(score, val_ex.label):
                             if label == 1:
                                 true_scores.append(prob.cpu().numpy())
@@ -182,7 +209,9 @@ def main():
         false_scores = []
         true_scores = []
         for j, test_ex in enumerate(test_iter):
-            score = F.softmax(model(test_ex.text)[0], dim=1)[:, 1]
+            logits = classify(
+                model, test_ex.text, pad_id, args.packed_token_budget)
+            score = F.softmax(logits, dim=1)[:, 1]
             for prob, label in zip(score, test_ex.label):
                 if label == 1:
                     true_scores.append(prob.cpu().numpy())
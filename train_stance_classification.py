@@ -14,12 +14,13 @@ import os
 import torch
 from torch import optim
 from torchtext import data
-from transformers import BertModel, BertConfig
 
+from concurrency import run_concurrently
 from experiment import experiment_logging, get_timestamp, save_vocab
 from cnn import CNNEncoder
 from rnn import RNNEncoder
 from stance import Stance
+from transformer import Transformer
 
 
 def eval_model(encoder, model, data_iter, threshold, device):
@@ -38,9 +39,9 @@ def eval_model(encoder, model, data_iter, threshold, device):
             pos = batch.tgt.to(device)
             pos_mask = pos != 1
 
-            encoded_query = encoder(
-                query, attention_mask=query_mask)[0]
-            encoded_pos = encoder(pos, attention_mask=pos_mask)[0]
+            encoded_query, encoded_pos = run_concurrently(
+                lambda: encoder(query, attention_mask=query_mask)[0],
+                lambda: encoder(pos, attention_mask=pos_mask)[0])
             scores = model.score_pair(
                 encoded_query, encoded_pos,
                 query_mask, pos_mask)
@@ -146,18 +147,10 @@ def main():
 
     encoder = None
     if args.model_type == "transformer":
-        config = BertConfig(
-            vocab_size=len(text_field.vocab),
-            is_decoder=False,
-            hidden_size=args.hidden_size,
-            num_hidden_layers=args.layers,
-            num_attention_heads=args.attention_heads,
-            intermediate_size=2 * args.hidden_size,
-            hidden_act='relu',
-            hidden_dropout_prob=0.1,
-            attention_probs_dropout_prob=0.1,
-            num_labels=2)
-        encoder = BertModel(config).to(device)
+        encoder = Transformer(
+            len(text_field.vocab), args.hidden_size, args.layers,
+            args.attention_heads, intermediate_size=2 * args.hidden_size,
+            dropout=0.1).to(device)
     elif args.model_type == "rnn":
         encoder = RNNEncoder(
             text_field.vocab, args.hidden_size,
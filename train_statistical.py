@@ -8,7 +8,7 @@ import torch
 from torchtext import data
 
 from experiment import experiment_logging, get_timestamp, save_vocab
-from statistical_model import EditDistStatModel
+from statistical_model import EditDistStatModel, cooccurring_pairs
 from transliteration_utils import decode_ids
 
 
@@ -28,6 +28,15 @@ def main():
     parser.add_argument(
         "--learning-rate", default=0.01, type=float,
         help="Learning rate.")
+    parser.add_argument(
+        "--batch-size", default=10, type=int,
+        help="Number of examples whose expected counts are computed at once "
+             "and used for one maximization step.")
+    parser.add_argument(
+        "--sparse-substitutions", default=False, action="store_true",
+        help="Keep parameters only for substitutions of symbols that "
+             "co-occur in training pairs, the other substitutions share a "
+             "backoff weight.")
     parser.add_argument("--log-directory", default="experiments", type=str,
                         help="Number of steps between validations.")
     args = parser.parse_args()
@@ -67,59 +76,71 @@ def main():
 
     # pylint: disable=W0632
     train_iter, val_iter, _ = data.Iterator.splits(
-        (train_data, val_data, test_data), batch_sizes=(1, 1, 1),
-        shuffle=True, device=0, sort_key=lambda x: len(x.ar))
+        (train_data, val_data, test_data),
+        batch_sizes=(args.batch_size, 64, 1),
+        shuffle=True, device="cpu", sort_key=lambda x: len(x.ar))
     # pylint: enable=W0632
 
-    model = EditDistStatModel(src_text_field.vocab, tgt_text_field.vocab)
+    substitution_pairs = None
+    if args.sparse_substitutions:
+        substitution_pairs = cooccurring_pairs(
+            ((train_ex.ar, train_ex.en) for train_ex in train_iter),
+            src_text_field.vocab.stoi["<pad>"],
+            tgt_text_field.vocab.stoi["<pad>"])
+        logging.info(
+            "Collected %d co-occurring symbol pairs.",
+            substitution_pairs.size(0))
+
+    model = EditDistStatModel(
+        src_text_field.vocab, tgt_text_field.vocab,
+        substitution_pairs=substitution_pairs)
 
     smallest_tgttropy = 1e9
-    examples = 0
-    stat_expecations = []
+    steps = 0
     logging.info("Training starts.")
     best_val_score = 0
     stalled = 0
-    for _ in range(args.epochs):
+    for epoch in range(args.epochs):
+        log_likelihood = torch.zeros((), dtype=torch.float64)
         for train_ex in train_iter:
-            examples += 1
-            exp_counts = model(train_ex.ar, train_ex.en)
-            stat_expecations.append(exp_counts)
-
-            if examples % 10 == 9:
-                model.maximize_expectation(
-                    stat_expecations, learning_rate=args.learning_rate)
-                entropy = -(
-                    model.weights * model.weights.exp()).sum()
-                logging.info("stat. model entropy = %.10g", entropy.cpu())
-                stat_expecations = []
-
-                if entropy < smallest_tgttropy:
-                    smallest_tgttropy = entropy
-                    torch.save(model, model_path)
-
-            if examples % 200 == 199:
+            steps += 1
+            expected_counts = model(
+                train_ex.ar, train_ex.en, log_likelihood=log_likelihood)
+            model.maximize_expectation(
+                expected_counts, learning_rate=args.learning_rate)
+            entropy = -(
+                model.weights * model.weights.exp()).sum()
+            logging.info("stat. model entropy = %.10g", entropy.cpu())
+
+            if entropy < smallest_tgttropy:
+                smallest_tgttropy = entropy
+                torch.save(model, model_path)
+
+            if steps % 20 == 19:
                 logging.info("")
                 logging.info("Validation:")
                 with torch.no_grad():
                     total_score = 0
                     val_examples = 0
-                    for j, val_ex in enumerate(val_iter):
-                        val_examples += 1
-                        stat_score = model.viterbi(val_ex.ar, val_ex.en)
-                        total_score += stat_score
-
-                        if j < 10:
-                            src_string = decode_ids(
-                                val_ex.ar[0], src_text_field)
-                            tgt_string = decode_ids(
-                                val_ex.en[0], tgt_text_field)
-
-                            logging.info(
-                                "%s -> %s  %f", src_string, tgt_string,
-                                stat_score)
-
-                        if j == 10:
-                            logging.info("")
+                    for val_ex in val_iter:
+                        stat_scores = model.viterbi(val_ex.ar, val_ex.en)
+                        total_score += stat_scores.sum()
+
+                        for src_ids, tgt_ids, stat_score in zip(
+                                val_ex.ar, val_ex.en, stat_scores):
+                            if val_examples < 10:
+                                src_string = decode_ids(
+                                    src_ids, src_text_field)
+                                tgt_string = decode_ids(
+                                    tgt_ids, tgt_text_field)
+
+                                logging.info(
+                                    "%s -> %s  %f", src_string, tgt_string,
+                                    stat_score)
+
+                            if val_examples == 10:
+                                logging.info("")
+                            val_examples += 1
 
                     val_score = total_score / val_examples
                     logging.info(
@@ -141,6 +162,12 @@ def main():
                         break
         if stalled > args.patience:
             break
+        # Every batch is scored before its own update, so this is the EM
+        # objective (non-decreasing over the epochs) only if the whole
+        # training data are a single batch.
+        logging.info(
+            "Epoch %d, training log-likelihood: %.10g",
+            epoch + 1, log_likelihood)
 
     logging.info("Training finished, best model was saved.")
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""Train the statistical model with online stepwise EM on a streamed corpus.
+
+The training pairs are read lazily in mini-batches. After each mini-batch,
+the weights are interpolated with the distribution estimated from the
+expected counts of the mini-batch with a decaying step size
+(step + 2) ** -step_decay (stepwise EM by Liang and Klein, 2009).
+
+The training reads the data twice: the model needs the vocabularies before
+the first update, so the symbols are first counted in a separate streamed
+pass, and only then the EM updates are done in a single streamed pass over
+the data (per epoch). The corpus is never held in memory.
+"""
+
+import argparse
+import logging
+import os
+
+import torch
+from torchtext.vocab import Vocab
+
+from experiment import experiment_logging, get_timestamp, save_vocab
+from statistical_data import count_symbols, pairs_to_batch, read_shards
+from statistical_model import EditDistStatModel
+
+
+SPECIAL_SYMBOLS = ["<unk>", "<pad>", "<s>", "</s>"]
+
+
+def validate(model, path, args):
+    """Average Viterbi score on streamed validation data."""
+    total_score = 0
+    val_examples = 0
+    with torch.no_grad():
+        for shard in read_shards(path, 64):
+            src_sent, tgt_sent = pairs_to_batch(
+                shard, model.src_vocab, model.tgt_vocab,
+                args.src_tokenized, args.tgt_tokenized)
+            total_score += model.viterbi(src_sent, tgt_sent).sum()
+            val_examples += len(shard)
+    return total_score / val_examples
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument(
+        "train_data", type=str, help="Tab-separated training string pairs.")
+    parser.add_argument(
+        "--val-data", type=str, default=None,
+        help="Tab-separated validation string pairs.")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument(
+        "--src-tokenized", default=False, action="store_true",
+        help="If true, source side are space separated tokens.")
+    parser.add_argument(
+        "--tgt-tokenized", default=False, action="store_true",
+        help="If true, target side are space separated tokens.")
+    parser.add_argument(
+        "--batch-size", default=100, type=int,
+        help="Number of string pairs in a mini-batch.")
+    parser.add_argument(
+        "--step-decay", default=0.7, type=float,
+        help="Exponent of the step size decay, between 0.5 and 1.")
+    parser.add_argument(
+        "--checkpoint-frequency", default=1000, type=int,
+        help="Number of mini-batches between checkpoints.")
+    parser.add_argument("--log-directory", default="experiments", type=str,
+                        help="Number of steps between validations.")
+    args = parser.parse_args()
+
+    if not 0.5 < args.step_decay <= 1.0:
+        parser.error("Step decay must be in the interval (0.5, 1].")
+
+    experiment_params = (
+        args.train_data.replace("/", "_") +
+        f"_batch_size{args.batch_size}" +
+        f"_step_decay{args.step_decay}")
+    experiment_dir = experiment_logging(
+        args.log_directory,
+        f"edit_stat_online_{experiment_params}_{get_timestamp()}", args)
+    model_path = os.path.join(experiment_dir, "model.pt")
+
+    src_counter, tgt_counter = count_symbols(
+        args.train_data, args.src_tokenized, args.tgt_tokenized)
+    src_vocab = Vocab(src_counter, specials=SPECIAL_SYMBOLS)
+    tgt_vocab = Vocab(tgt_counter, specials=SPECIAL_SYMBOLS)
+    save_vocab(src_vocab.itos, os.path.join(experiment_dir, "src_vocab"))
+    save_vocab(tgt_vocab.itos, os.path.join(experiment_dir, "tgt_vocab"))
+    logging.info(
+        "Created vocabularies with %d source and %d target symbols.",
+        len(src_vocab), len(tgt_vocab))
+
+    model = EditDistStatModel(src_vocab, tgt_vocab)
+
+    def checkpoint():
+        torch.save(model, model_path)
+        entropy = -(model.weights * model.weights.exp()).sum()
+        logging.info(
+            "Step %d, %d examples, stat. model entropy = %.10g, "
+            "model saved.", step, examples, entropy)
+        if args.val_data is not None:
+            logging.info(
+                "Validation score: %f", validate(model, args.val_data, args))
+
+    step = 0
+    examples = 0
+    logging.info("Training starts.")
+    for epoch in range(args.epochs):
+        log_likelihood = torch.zeros((), dtype=torch.float64)
+        for shard in read_shards(args.train_data, args.batch_size):
+            src_sent, tgt_sent = pairs_to_batch(
+                shard, src_vocab, tgt_vocab,
+                args.src_tokenized, args.tgt_tokenized)
+            with torch.no_grad():
+                expected_counts = model(
+                    src_sent, tgt_sent, log_likelihood=log_likelihood)
+            step_size = (step + 2) ** -args.step_decay
+            model.maximize_expectation(
+                expected_counts, learning_rate=step_size)
+            step += 1
+            examples += len(shard)
+
+            if step % args.checkpoint_frequency == 0:
+                checkpoint()
+        # Every batch is scored before its own update, so this is the EM
+        # objective (non-decreasing over the epochs) only if the whole
+        # training data are a single batch.
+        logging.info(
+            "Epoch %d, training log-likelihood: %.10g",
+            epoch + 1, log_likelihood)
+
+    if step % args.checkpoint_frequency != 0:
+        checkpoint()
+    logging.info("Training finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""Train the statistical model with full-corpus EM in multiple processes.
+
+In every epoch, the training data are read in shards that are sent to a pool
+of worker processes. The workers compute expected operation counts of the
+shards under the current weights which they share with the main process
+(over shared memory). The counts are summed and used for a single
+maximization step. At most twice as many shards as there are workers are
+read ahead, so the memory use does not grow with the training data size.
+"""
+
+import argparse
+import collections
+import logging
+import os
+
+import torch
+import torch.multiprocessing as mp
+from torchtext import data
+
+from experiment import experiment_logging, get_timestamp, save_vocab
+from statistical_data import pairs_to_batch, read_shards
+from statistical_model import EditDistStatModel, cooccurring_pairs
+
+
+WORKER_MODEL = None
+
+
+def init_worker(model):
+    global WORKER_MODEL  # pylint: disable=global-statement
+    torch.set_num_threads(1)
+    WORKER_MODEL = model
+
+
+def shard_expectation(job):
+    """Expected operation counts and log-likelihood of a shard."""
+    shard, batch_size, src_tokenized, tgt_tokenized = job
+    expected_counts = WORKER_MODEL.new_count_buffer()
+    log_likelihood = torch.zeros((), dtype=torch.float64)
+    # sort by length to minimize padding within the batches
+    shard = sorted(shard, key=lambda pair: (len(pair[0]), len(pair[1])))
+    with torch.no_grad():
+        for i in range(0, len(shard), batch_size):
+            src_sent, tgt_sent = pairs_to_batch(
+                shard[i:i + batch_size], WORKER_MODEL.src_vocab,
+                WORKER_MODEL.tgt_vocab, src_tokenized, tgt_tokenized)
+            WORKER_MODEL(src_sent, tgt_sent, expected_counts, log_likelihood)
+    return expected_counts, log_likelihood, len(shard)
+
+
+def bounded_map(pool, function, jobs, max_pending):
+    """Map a function over jobs in a pool with limited jobs in flight.
+
+    Unlike `Pool.imap_unordered` that consumes the whole job iterator in the
+    background, the next job is only taken when fewer than `max_pending`
+    jobs are waiting, so that the shards are read from the disk only
+    shortly before they are processed.
+    """
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def main():
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("data_prefix", type=str)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument(
+        "--src-tokenized", default=False, action="store_true",
+        help="If true, source side are space separated tokens.")
+    parser.add_argument(
+        "--tgt-tokenized", default=False, action="store_true",
+        help="If true, target side are space separated tokens.")
+    parser.add_argument(
+        "--patience", default=2, type=int,
+        help="Early stopping patience (in epochs).")
+    parser.add_argument(
+        "--learning-rate", default=1.0, type=float,
+        help="Interpolation weight of the re-estimated distribution.")
+    parser.add_argument(
+        "--processes", default=os.cpu_count(), type=int,
+        help="Number of worker processes.")
+    parser.add_argument(
+        "--shard-size", default=5000, type=int,
+        help="Number of string pairs sent to a worker at once.")
+    parser.add_argument(
+        "--batch-size", default=50, type=int,
+        help="Number of string pairs processed by a worker at once.")
+    parser.add_argument(
+        "--sparse-substitutions", default=False, action="store_true",
+        help="Keep parameters only for substitutions of symbols that "
+             "co-occur in training pairs, the other substitutions share a "
+             "backoff weight.")
+    parser.add_argument("--log-directory", default="experiments", type=str,
+                        help="Number of steps between validations.")
+    args = parser.parse_args()
+
+    experiment_params = (
+        args.data_prefix.replace("/", "_") +
+        f"_learning_rate_{args.learning_rate}" +
+        f"_processes{args.processes}")
+    experiment_dir = experiment_logging(
+        args.log_directory,
+        f"edit_stat_parallel_{experiment_params}_{get_timestamp()}", args)
+    model_path = os.path.join(experiment_dir, "model.pt")
+
+    src_text_field = data.Field(
+        tokenize=(lambda s: s.split()) if args.src_tokenized else list,
+        init_token="<s>", eos_token="</s>", batch_first=True)
+    tgt_text_field = data.Field(
+        tokenize=(lambda s: s.split()) if args.tgt_tokenized else list,
+        init_token="<s>", eos_token="</s>", batch_first=True)
+
+    # Only validation data is loaded in memory, training data is streamed.
+    val_data = data.TabularDataset(
+        os.path.join(args.data_prefix, "eval.txt"), format="tsv",
+        fields=[('ar', src_text_field), ('en', tgt_text_field)])
+    src_text_field.build_vocab(val_data)
+    tgt_text_field.build_vocab(val_data)
+
+    save_vocab(
+        src_text_field.vocab.itos, os.path.join(experiment_dir, "src_vocab"))
+    save_vocab(
+        tgt_text_field.vocab.itos, os.path.join(experiment_dir, "tgt_vocab"))
+    logging.info("Loaded validation data, created vocabularies.")
+
+    val_iter = data.Iterator(
+        val_data, batch_size=64, shuffle=False, device="cpu",
+        sort_key=lambda x: len(x.ar))
+
+    train_path = os.path.join(args.data_prefix, "train.txt")
+    substitution_pairs = None
+    if args.sparse_substitutions:
+        substitution_pairs = cooccurring_pairs(
+            (pairs_to_batch(
+                shard, src_text_field.vocab, tgt_text_field.vocab,
+                args.src_tokenized, args.tgt_tokenized)
+             for shard in read_shards(train_path, args.batch_size)),
+            src_text_field.vocab.stoi["<pad>"],
+            tgt_text_field.vocab.stoi["<pad>"])
+        logging.info(
+            "Collected %d co-occurring symbol pairs.",
+            substitution_pairs.size(0))
+
+    model = EditDistStatModel(
+        src_text_field.vocab, tgt_text_field.vocab,
+        substitution_pairs=substitution_pairs)
+    shared_weights = model.weights.share_memory_()
+
+    pool = mp.Pool(
+        args.processes, initializer=init_worker, initargs=(model,))
+    logging.info("Started %d worker processes.", args.processes)
+
+    best_val_score = 0
+    stalled = 0
+    for epoch in range(args.epochs):
+        logging.info("Epoch %d starts.", epoch + 1)
+        expected_counts = model.new_count_buffer()
+        log_likelihood = torch.zeros((), dtype=torch.float64)
+        examples = 0
+        jobs = (
+            (shard, args.batch_size, args.src_tokenized, args.tgt_tokenized)
+            for shard in read_shards(train_path, args.shard_size))
+        for shard_counts, shard_log_likelihood, shard_examples in (
+                bounded_map(
+                    pool, shard_expectation, jobs, 2 * args.processes)):
+            expected_counts += shard_counts
+            log_likelihood += shard_log_likelihood
+            examples += shard_examples
+        logging.info("Expectations computed for %d examples.", examples)
+        logging.info(
+            "Epoch %d, training log-likelihood: %.10g",
+            epoch + 1, log_likelihood)
+
+        model.maximize_expectation(
+            expected_counts, learning_rate=args.learning_rate)
+        shared_weights.copy_(model.weights)
+        model.weights = shared_weights
+        entropy = -(model.weights * model.weights.exp()).sum()
+        logging.info("stat. model entropy = %.10g", entropy)
+
+        with torch.no_grad():
+            total_score = 0
+            val_examples = 0
+            for val_ex in val_iter:
+                val_examples += val_ex.ar.size(0)
+                total_score += model.viterbi(val_ex.ar, val_ex.en).sum()
+        val_score = total_score / val_examples
+        logging.info("Validation score: %f", val_score)
+
+        if val_score > best_val_score:
+            best_val_score = val_score
+            stalled = 0
+            logging.info("New maximum!")
+            torch.save(model, model_path)
+        else:
+            stalled += 1
+            logging.info(
+                "Previous best %f, stalled %d times.",
+                best_val_score, stalled)
+            if stalled > args.patience:
+                break
+
+    pool.close()
+    pool.join()
+    logging.info("Training finished, best model was saved.")
+
+
+if __name__ == "__main__":
+    main()
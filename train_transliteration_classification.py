@@ -31,6 +31,10 @@ def main():
     parser.add_argument("--hidden-size", default=256, type=int)
     parser.add_argument("--attention-heads", default=4, type=int)
     parser.add_argument("--layers", default=2, type=int)
+    parser.add_argument(
+        "--packed-token-budget", default=None, type=int,
+        help="Pack strings into rows of this length in Transformer "
+             "encoders instead of padding them.")
     parser.add_argument("--batch-size", default=512, type=int)
     parser.add_argument("--delay-update", default=1, type=int,
                         help="Update model every N steps.")
@@ -115,7 +119,8 @@ def main():
         hidden_dim=args.hidden_size,
         hidden_layers=args.layers,
         attention_heads=args.attention_heads,
-        share_encoders=args.share_encoders).to(device)
+        share_encoders=args.share_encoders,
+        packed_token_budget=args.packed_token_budget).to(device)
     logging.info(
         "Model parameters: %dk",
         sum([x.reshape(-1).size(0) for x in model.parameters()]) / 1000)
@@ -37,6 +37,10 @@ def main():
     parser.add_argument("--attention-heads", default=4, type=int)
     parser.add_argument("--no-enc-dec-att", default=False, action="store_true")
     parser.add_argument("--layers", default=2, type=int)
+    parser.add_argument(
+        "--packed-token-budget", default=None, type=int,
+        help="Pack strings into rows of this length in Transformer "
+             "encoders instead of padding them.")
     parser.add_argument("--beam-size", type=int, default=5,
                         help="Beam size for test data decoding.")
     parser.add_argument("--batch-size", default=128, type=int)
@@ -113,7 +117,8 @@ def main():
         hidden_layers=args.layers,
         attention_heads=args.attention_heads,
         window=args.window,
-        encoder_decoder_attention=not args.no_enc_dec_att).to(device)
+        encoder_decoder_attention=not args.no_enc_dec_att,
+        packed_token_budget=args.packed_token_budget).to(device)
     logging.info(
         "Model parameters: %dk",
         sum([x.reshape(-1).size(0) for x in model.parameters()]) / 1000)
@@ -11,11 +11,9 @@ import logging
 import os
 import time
 
-from tensorboardX import SummaryWriter
 import torch
 from torch import nn, optim
 from torch.functional import F
-from transformers import BertConfig, BertModel
 
 from experiment import experiment_logging, get_timestamp, save_vocab
 from cnn import CNNEncoder, CNNDecoder
@@ -68,7 +66,18 @@ class Seq2SeqModel(nn.Module):
         return logits, attentions
 
     @torch.no_grad()
-    def greedy_decode(self, src_batch, max_len=100):
+    def greedy_decode(self, src_batch, max_len=100, time_budget=None):
+        """Greedy decoding.
+
+        If a time budget (in seconds) is given, the clock is checked between
+        the decoding steps and when it is exceeded, the partially decoded
+        sequences are returned together with a boolean tensor saying which
+        sequences were truncated.
+        """
+        deadline = None
+        if time_budget is not None:
+            deadline = time.monotonic() + time_budget
+        deadline_exceeded = False
         input_mask = src_batch != self.src_pad_token_id
         encoded = self.encoder(src_batch, attention_mask=input_mask)[0]
         batch_size = encoded.size(0)
@@ -96,12 +105,32 @@ class Seq2SeqModel(nn.Module):
 
             if all(finished_now):
                 break
+            if deadline is not None and time.monotonic() > deadline:
+                deadline_exceeded = True
+                break
 
-        return (torch.stack(decoded, dim=1),
-                torch.stack(finished, dim=1).logical_not())
+        outputs = (torch.stack(decoded, dim=1),
+                   torch.stack(finished, dim=1).logical_not())
+        if deadline is not None:
+            return outputs + (
+                finished[-1].logical_not() * deadline_exceeded,)
+        return outputs
 
     @torch.no_grad()
-    def beam_search(self, src_batch, beam_size=10, max_len=100, len_norm=1.0):
+    def beam_search(self, src_batch, beam_size=10, max_len=100, len_norm=1.0,
+                    time_budget=None):
+        """Beam search decoding.
+
+        If a time budget (in seconds) is given, the clock is checked between
+        the decoding steps and when it is exceeded, the hypothesis with the
+        best normalized score is returned, whether it is finished or not,
+        together with a boolean tensor saying which sequences were
+        truncated.
+        """
+        deadline = None
+        if time_budget is not None:
+            deadline = time.monotonic() + time_budget
+        deadline_exceeded = False
         input_mask = src_batch != self.src_pad_token_id
         encoded = self.encoder(src_batch, attention_mask=input_mask)[0]
         batch_size = encoded.size(0)
@@ -167,6 +196,9 @@ class Seq2SeqModel(nn.Module):
                 finished_now.unsqueeze(-1)), dim=2)
             if finished_now.all():
                 break
+            if deadline is not None and time.monotonic() > deadline:
+                deadline_exceeded = True
+                break
 
             # re-order scores
             scores = candidate_scores.reshape(
@@ -186,7 +218,12 @@ class Seq2SeqModel(nn.Module):
             current_beam = beam_size
             cur_len += 1
 
-        return (decoded[:, 0], finished[:, 0].logical_not())
+        if deadline is None:
+            return (decoded[:, 0], finished[:, 0].logical_not())
+
+        # only hypotheses cut short by the deadline count as truncated
+        truncated = finished[:, 0, -1].logical_not() * deadline_exceeded
+        return (decoded[:, 0], finished[:, 0].logical_not(), truncated)
 
 
 def main():
@@ -231,6 +268,12 @@ def main():
         args.log_directory,
         f"s2s_{experiment_params}_{get_timestamp()}", args)
     model_path = os.path.join(experiment_dir, "model.pt")
+    # The model class is imported by the decoding scripts (that need it to
+    # unpickle the models), the training dependencies are imported here so
+    # that the decoding does not wait for them.
+    # pylint: disable=import-outside-toplevel
+    from tensorboardX import SummaryWriter
+    from transformers import BertConfig, BertModel
     tb_writer = SummaryWriter(experiment_dir)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -0,0 +1,401 @@
+"""Transformer encoder and decoder with the same call API as Transformers.
+
+The model computes the same function as BertModel from Transformers (with
+the configuration used in this project), but only consists of the parts
+that are actually used: there is no pooler, no head masks, the token type
+embedding (which is always the same) is merged into the position embeddings
+and the query, key and value projections are fused into a single matrix.
+State dicts of BertModel and BertSelfAttention are converted when loaded.
+"""
+
+import math
+
+import torch
+from torch import nn
+from torch.functional import F
+
+
+BERT_NAME_MAPPING = [
+    ("embeddings.word_embeddings.", "word_embeddings."),
+    ("embeddings.position_embeddings.", "position_embeddings."),
+    ("embeddings.LayerNorm.", "embeddings_norm."),
+    ("encoder.layer.", "layers."),
+    (".attention.self.", ".self_attention."),
+    (".attention.output.dense.", ".self_attention_output."),
+    (".attention.output.LayerNorm.", ".self_attention_norm."),
+    (".crossattention.self.", ".cross_attention."),
+    (".crossattention.output.dense.", ".cross_attention_output."),
+    (".crossattention.output.LayerNorm.", ".cross_attention_norm."),
+    (".intermediate.dense.", ".intermediate."),
+    (".output.dense.", ".output."),
+    (".output.LayerNorm.", ".output_norm.")]
+
+
+def linear_parameters(linear):
+    """Weight and bias of a linear layer, dequantized if it is quantized."""
+    if isinstance(linear, nn.Linear):
+        return linear.weight, linear.bias
+    return linear.weight().dequantize(), linear.bias()
+
+
+def sinusoidal_embeddings(position_ids, size):
+    """Sinusoidal position embeddings (Vaswani et al., 2017)."""
+    frequencies = torch.exp(
+        torch.arange(0, size, 2, device=position_ids.device).float() *
+        (-math.log(10000.0) / size))
+    angles = position_ids.unsqueeze(-1).float() * frequencies
+    embeddings = torch.stack((angles.sin(), angles.cos()), dim=-1)
+    return embeddings.flatten(-2)[..., :size]
+
+
+def embed_positions(embeddings, position_ids):
+    """Learned position embeddings with a sinusoidal fallback.
+
+    Positions that do not fit into the embedding table get sinusoidal
+    embeddings instead of failing. The function does not branch on the
+    data, so it can be traced.
+    """
+    table_size = embeddings.num_embeddings
+    learned = embeddings(position_ids.clamp(max=table_size - 1))
+    sinusoidal = sinusoidal_embeddings(
+        position_ids, embeddings.embedding_dim).to(learned.dtype)
+    return torch.where(
+        (position_ids < table_size).unsqueeze(-1), learned, sinusoidal)
+
+
+def extended_position_embeddings(embeddings, size):
+    """Copy of a position embedding table extended to a new size.
+
+    The new positions are initialized with the sinusoidal embeddings, i.e.,
+    the extended table computes the same as `embed_positions` with the
+    original table, but the new positions can be trained.
+    """
+    if size <= embeddings.num_embeddings:
+        raise ValueError("The new size must be bigger than the current one.")
+    extended = nn.Embedding(
+        size, embeddings.embedding_dim).to(embeddings.weight.device)
+    with torch.no_grad():
+        extended.weight.copy_(embed_positions(
+            embeddings, torch.arange(size, device=embeddings.weight.device)))
+    return extended
+
+
+def additive_mask(mask, dtype):
+    """Convert a 0/1 mask into a mask that gets added to attention scores."""
+    return (1.0 - mask.to(dtype)) * -10000.0
+
+
+class SequencePacking:
+    """Packing of a padded batch into rows with a fixed token budget.
+
+    Short sequences are placed one after another into rows of the same
+    length (first-fit decreasing), so that the encoder does not waste
+    computation on padding. Tokens only attend to tokens of the same
+    sequence (the attention mask is block-diagonal) and position ids are
+    counted from the beginning of each sequence, so the encoder states are
+    the same as without packing.
+
+    Args:
+        attention_mask: 0/1 mask of the padded batch.
+        token_budget: Length of the packed rows. If a sequence is longer,
+            the longest sequence length is used instead.
+    """
+    def __init__(self, attention_mask, token_budget):
+        self.mask = attention_mask.bool()
+        device = attention_mask.device
+        lengths = self.mask.sum(1).tolist()
+        self.row_length = max([token_budget] + lengths)
+
+        rows = [0 for _ in lengths]
+        offsets = [0 for _ in lengths]
+        row_fill = []
+        for i in sorted(
+                range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+            for row, fill in enumerate(row_fill):
+                if fill + lengths[i] <= self.row_length:
+                    break
+            else:
+                row = len(row_fill)
+                row_fill.append(0)
+            rows[i], offsets[i] = row, row_fill[row]
+            row_fill[row] += lengths[i]
+        self.row_count = len(row_fill)
+
+        starts = (
+            torch.tensor(rows, device=device) * self.row_length +
+            torch.tensor(offsets, device=device))
+        positions = torch.arange(
+            attention_mask.size(1), device=device).unsqueeze(0).expand_as(
+                self.mask)
+        self.flat_positions = (starts.unsqueeze(1) + positions)[self.mask]
+        # flat positions of the first tokens of the sequences
+        self.starts = starts
+
+        segments = self._scatter(
+            torch.arange(len(lengths), device=device).unsqueeze(1).expand_as(
+                self.mask), -1)
+        self.position_ids = self._scatter(positions, 0)
+        self.attention_mask = segments.unsqueeze(2) == segments.unsqueeze(1)
+
+    def _scatter(self, values, fill_value):
+        packed = torch.full(
+            (self.row_count * self.row_length,), fill_value,
+            dtype=values.dtype, device=values.device)
+        packed[self.flat_positions] = values[self.mask]
+        return packed.view(self.row_count, self.row_length)
+
+    def pack(self, input_ids):
+        """Packed token ids of shape (rows, row_length)."""
+        return self._scatter(input_ids, 0)
+
+    def unpack(self, states):
+        """Convert packed states back into the padded batch shape."""
+        flat_states = states.reshape(-1, states.size(-1))
+        unpacked = flat_states.new_zeros(
+            self.mask.shape + (states.size(-1),))
+        unpacked[self.mask] = flat_states[self.flat_positions]
+        return unpacked
+
+
+class MultiHeadAttention(nn.Module):
+    """Multi-head attention with fused query, key and value projections.
+
+    A replacement of BertSelfAttention: the masks are added to the attention
+    scores and the output is a tuple of the context vectors and the
+    attention distributions. When keys and values come from an encoder,
+    only the corresponding part of the projection is used for them.
+    """
+    def __init__(self, hidden_size, num_attention_heads, dropout=0.1):
+        super().__init__()
+        if hidden_size % num_attention_heads != 0:
+            raise ValueError(
+                "Hidden size must be divisible by the number of heads.")
+        self.num_attention_heads = num_attention_heads
+        self.head_size = hidden_size // num_attention_heads
+        self.qkv = nn.Linear(hidden_size, 3 * hidden_size)
+        self.dropout = nn.Dropout(dropout)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for param in ["weight", "bias"]:
+            separate = [
+                f"{prefix}{name}.{param}" for name in ["query", "key", "value"]]
+            if all(key in state_dict for key in separate):
+                state_dict[f"{prefix}qkv.{param}"] = torch.cat(
+                    [state_dict.pop(key) for key in separate])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _split_heads(self, states):
+        return states.view(
+            states.size(0), states.size(1), self.num_attention_heads,
+            self.head_size).transpose(1, 2)
+
+    def forward(self, hidden_states, attention_mask=None,
+                encoder_hidden_states=None, encoder_attention_mask=None):
+        if encoder_hidden_states is None:
+            query, key, value = self.qkv(hidden_states).chunk(3, dim=2)
+        else:
+            hidden_size = hidden_states.size(2)
+            weight, bias = linear_parameters(self.qkv)
+            query = F.linear(
+                hidden_states, weight[:hidden_size], bias[:hidden_size])
+            key, value = F.linear(
+                encoder_hidden_states, weight[hidden_size:],
+                bias[hidden_size:]).chunk(2, dim=2)
+            attention_mask = encoder_attention_mask
+
+        scores = torch.matmul(
+            self._split_heads(query),
+            self._split_heads(key).transpose(2, 3)) / math.sqrt(
+                self.head_size)
+        if attention_mask is not None:
+            scores = scores + attention_mask
+        probs = self.dropout(F.softmax(scores, dim=-1))
+
+        context = torch.matmul(probs, self._split_heads(value))
+        context = context.transpose(1, 2).reshape(
+            hidden_states.size(0), hidden_states.size(1), -1)
+        return context, probs
+
+
+class TransformerLayer(nn.Module):
+    """Post-norm Transformer layer, with encoder attention in a decoder."""
+    def __init__(self, hidden_size, num_attention_heads, intermediate_size,
+                 is_decoder=False, dropout=0.1):
+        super().__init__()
+        self.is_decoder = is_decoder
+        self.dropout = nn.Dropout(dropout)
+
+        self.self_attention = MultiHeadAttention(
+            hidden_size, num_attention_heads, dropout)
+        self.self_attention_output = nn.Linear(hidden_size, hidden_size)
+        self.self_attention_norm = nn.LayerNorm(hidden_size, eps=1e-12)
+
+        if is_decoder:
+            self.cross_attention = MultiHeadAttention(
+                hidden_size, num_attention_heads, dropout)
+            self.cross_attention_output = nn.Linear(hidden_size, hidden_size)
+            self.cross_attention_norm = nn.LayerNorm(hidden_size, eps=1e-12)
+
+        self.intermediate = nn.Linear(hidden_size, intermediate_size)
+        self.output = nn.Linear(intermediate_size, hidden_size)
+        self.output_norm = nn.LayerNorm(hidden_size, eps=1e-12)
+
+    def forward(self, hidden_states, attention_mask,
+                encoder_hidden_states=None, encoder_attention_mask=None):
+        context, self_attention = self.self_attention(
+            hidden_states, attention_mask)
+        hidden_states = self.self_attention_norm(
+            self.dropout(self.self_attention_output(context)) +
+            hidden_states)
+
+        if self.is_decoder and encoder_hidden_states is not None:
+            context = self.cross_attention(
+                hidden_states, encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask)[0]
+            hidden_states = self.cross_attention_norm(
+                self.dropout(self.cross_attention_output(context)) +
+                hidden_states)
+
+        output = self.output(F.relu(self.intermediate(hidden_states)))
+        return (
+            self.output_norm(self.dropout(output) + hidden_states),
+            self_attention)
+
+
+class Transformer(nn.Module):
+    """Transformer encoder or (if is_decoder) decoder.
+
+    The forward pass returns a tuple of the output states, None (in place of
+    the BertModel pooled output) and a list of self-attention distributions
+    from all layers.
+
+    If packed_token_budget is set, an encoder packs the input sequences
+    into rows of this length (see SequencePacking) and unpacks the output
+    states. The states at the padding positions are then zero and the
+    self-attention distributions are those of the packed rows.
+
+    Positions beyond max_position_embeddings get sinusoidal embeddings (see
+    embed_positions).
+    """
+    def __init__(self, vocab_size, hidden_size, num_hidden_layers,
+                 num_attention_heads, intermediate_size, is_decoder=False,
+                 max_position_embeddings=512, dropout=0.1,
+                 packed_token_budget=None):
+        super().__init__()
+        self.is_decoder = is_decoder
+        self.packed_token_budget = packed_token_budget
+
+        self.word_embeddings = nn.Embedding(
+            vocab_size, hidden_size, padding_idx=0)
+        self.position_embeddings = nn.Embedding(
+            max_position_embeddings, hidden_size)
+        self.embeddings_norm = nn.LayerNorm(hidden_size, eps=1e-12)
+        self.dropout = nn.Dropout(dropout)
+
+        self.layers = nn.ModuleList([
+            TransformerLayer(
+                hidden_size, num_attention_heads, intermediate_size,
+                is_decoder=is_decoder, dropout=dropout)
+            for _ in range(num_hidden_layers)])
+
+        self.apply(self._init_weights)
+
+    @staticmethod
+    def _init_weights(module):
+        if isinstance(module, (nn.Linear, nn.Embedding)):
+            module.weight.data.normal_(mean=0.0, std=0.02)
+        if isinstance(module, nn.Linear):
+            module.bias.data.zero_()
+        if isinstance(module, nn.LayerNorm):
+            module.weight.data.fill_(1.0)
+            module.bias.data.zero_()
+
+    @classmethod
+    def from_bert(cls, bert_model):
+        """Create an equivalent model from a Transformers BertModel."""
+        config = bert_model.config
+        if config.hidden_act != "relu":
+            raise ValueError("Only BERT models with ReLU can be converted.")
+        model = cls(
+            config.vocab_size, config.hidden_size, config.num_hidden_layers,
+            config.num_attention_heads, config.intermediate_size,
+            is_decoder=config.is_decoder,
+            max_position_embeddings=config.max_position_embeddings,
+            dropout=config.hidden_dropout_prob)
+        model.load_state_dict(bert_model.state_dict())
+        return model
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if f"{prefix}embeddings.word_embeddings.weight" in state_dict:
+            for key in [key for key in state_dict if key.startswith(prefix)]:
+                value = state_dict.pop(key)
+                name = key[len(prefix):]
+                if (name.startswith("pooler.") or
+                        name == "embeddings.position_ids"):
+                    continue
+                for bert_name, native_name in BERT_NAME_MAPPING:
+                    name = name.replace(bert_name, native_name)
+                state_dict[prefix + name] = value
+            # token type ids are always zero, so the first token type
+            # embedding is just added to every position embedding
+            state_dict[f"{prefix}position_embeddings.weight"] = (
+                state_dict[f"{prefix}position_embeddings.weight"] +
+                state_dict.pop(
+                    f"{prefix}embeddings.token_type_embeddings.weight")[0])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, input_ids, attention_mask=None,
+                encoder_hidden_states=None, encoder_attention_mask=None,
+                position_ids=None):
+        """Run the model.
+
+        The attention mask either masks padding (batch, length), or it is
+        a full mask (batch, length, length) saying which tokens can attend
+        to which tokens.
+        """
+        seq_len = input_ids.size(1)
+        dtype = self.word_embeddings.weight.dtype
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        if (getattr(self, "packed_token_budget", None) is not None and
+                not self.is_decoder and attention_mask.dim() == 2):
+            packing = SequencePacking(attention_mask, self.packed_token_budget)
+            hidden_states, _, attentions = self(
+                packing.pack(input_ids), packing.attention_mask,
+                position_ids=packing.position_ids)
+            return packing.unpack(hidden_states), None, attentions
+
+        if attention_mask.dim() == 3:
+            attention_mask = attention_mask[:, None, :, :].to(dtype)
+        else:
+            attention_mask = attention_mask[:, None, None, :].to(dtype)
+        if self.is_decoder:
+            positions = torch.arange(seq_len, device=input_ids.device)
+            causal_mask = positions[None, :] <= positions[:, None]
+            attention_mask = causal_mask.to(dtype)[None, None] * attention_mask
+        attention_mask = additive_mask(attention_mask, dtype)
+
+        if encoder_hidden_states is not None:
+            if encoder_attention_mask is None:
+                encoder_attention_mask = torch.ones(
+                    encoder_hidden_states.shape[:2],
+                    device=input_ids.device)
+            encoder_attention_mask = additive_mask(
+                encoder_attention_mask[:, None, None, :], dtype)
+
+        if position_ids is None:
+            position_ids = torch.arange(
+                seq_len, device=input_ids.device).unsqueeze(0)
+        hidden_states = self.dropout(self.embeddings_norm(
+            self.word_embeddings(input_ids) +
+            embed_positions(self.position_embeddings, position_ids)))
+
+        attentions = []
+        for layer in self.layers:
+            hidden_states, self_attention = layer(
+                hidden_states, attention_mask,
+                encoder_hidden_states, encoder_attention_mask)
+            attentions.append(self_attention)
+
+        return hidden_states, None, attentions
@@ -10,6 +10,8 @@ import sys
 
 import torch
 
+from lexicon_trie import LexiconTrie
+from target_shortlist import TargetShortlist
 from transliteration_utils import load_vocab, decode_ids, char_error_rate
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
@@ -26,19 +28,105 @@ def main():
     parser.add_argument("--tgt-tokenized", default=False, action="store_true")
     parser.add_argument(
         "--decoding", default="greedy",
-        choices=["greedy", "beam_search", "operations", "operations_beam"])
+        choices=["greedy", "beam_search", "operations", "operations_beam",
+                 "speculative"])
     parser.add_argument("--evaluate", default=False, action="store_true")
     parser.add_argument("--beam-size", type=int, default=10)
+    parser.add_argument(
+        "--n-best", type=int, default=None,
+        help="With beam search, print the N best hypotheses per input as "
+             "tab-separated lines: input index, hypothesis, score and "
+             "length-normalized score.")
+    parser.add_argument(
+        "--time-budget", type=float, default=None,
+        help="Time limit in seconds for decoding a single input (greedy and "
+             "beam search only). When exceeded, the best hypothesis so far "
+             "is returned.")
+    parser.add_argument(
+        "--draft-model", type=argparse.FileType("rb"), default=None,
+        help="Statistical model proposing symbols for speculative decoding.")
+    parser.add_argument(
+        "--draft-steps", type=int, default=4,
+        help="Number of symbols proposed at once in speculative decoding.")
+    parser.add_argument(
+        "--lexicon", type=str, default=None,
+        help="Trie of allowed target strings (built by lexicon_trie.py) to "
+             "constrain beam search.")
+    parser.add_argument(
+        "--shortlist", type=str, default=None,
+        help="Source-to-target symbol table (built by target_shortlist.py) "
+             "restricting target symbols scored in beam search.")
+    parser.add_argument(
+        "--shortlist-coverage", type=float, default=0.99,
+        help="Probability mass of target symbols taken per source symbol.")
+    parser.add_argument(
+        "--shortlist-min-mass", type=float, default=0.9,
+        help="Use the full vocabulary for inputs whose shortlist covers "
+             "less mass.")
+    parser.add_argument(
+        "--recombination", default="none", choices=["sum", "max", "none"],
+        help="Merging of hypotheses reaching the same edit state in "
+             "operation beam search: log-sum-exp, max (Viterbi) or none.")
+    parser.add_argument(
+        "--quantize", default=False, action="store_true",
+        help="Run a dynamically quantized (int8) model on CPU.")
+    parser.add_argument(
+        "--scripted", default=False, action="store_true",
+        help="The model is a TorchScript module exported by "
+             "export_torchscript.py (greedy decoding and beam search only).")
     args = parser.parse_args()
 
-    model = torch.load(args.model)
+    if args.n_best is not None and args.decoding != "beam_search":
+        parser.error("N-best output is only available with beam search.")
+    if args.lexicon is not None and args.decoding != "beam_search":
+        parser.error("Lexicon constraints are only available with beam search.")
+    if args.shortlist is not None and args.decoding != "beam_search":
+        parser.error("Shortlisting is only available with beam search.")
+    if (args.time_budget is not None and
+            args.decoding not in ["greedy", "beam_search"]):
+        parser.error("Time budget is only available with greedy decoding "
+                     "and beam search.")
+    if args.decoding == "speculative" and args.draft_model is None:
+        parser.error("Speculative decoding needs a draft model.")
+    if args.scripted and (
+            args.decoding not in ["greedy", "beam_search"] or
+            args.quantize or args.time_budget is not None or
+            args.lexicon is not None or args.shortlist is not None):
+        parser.error("Scripted models only support greedy decoding and "
+                     "beam search without quantization, time budget, "
+                     "lexicon and shortlist.")
+
+    if args.scripted:
+        model = torch.jit.load(args.model)
+    else:
+        model = torch.load(
+            args.model, map_location="cpu" if args.quantize else None)
     logging.info("Model loaded.")
+    if args.quantize:
+        model = model.quantize()
+        logging.info("Model quantized.")
+    device = torch.device("cpu") if args.scripted else model.device
+    if args.draft_model is not None:
+        draft_model = torch.load(
+            args.draft_model, map_location="cpu" if args.quantize else None)
+        logging.info("Draft model loaded.")
     src_vocab, src_stoi = load_vocab(args.src_vocab)
     tgt_vocab, tgt_stoi = load_vocab(args.tgt_vocab)
     logging.info("Vocabularies loaded.")
+    lexicon = None
+    if args.lexicon is not None:
+        lexicon = LexiconTrie.load(args.lexicon, device=device)
+        logging.info("Lexicon trie loaded.")
+    shortlist = None
+    if args.shortlist is not None:
+        shortlist = TargetShortlist.load(
+            args.shortlist, coverage=args.shortlist_coverage,
+            min_mass=args.shortlist_min_mass)
+        logging.info("Target shortlist table loaded.")
 
     outputs = []
     targets = []
+    truncated_count = 0
 
     for i, line in enumerate(args.input):
         if args.evaluate:
@@ -55,27 +143,73 @@ def main():
             ["</s>"])
 
         string_1_idx = torch.tensor(
-            [[src_stoi[s] for s in string_1_tok]]).cuda()
+            [[src_stoi[s] for s in string_1_tok]]).to(device)
 
-        if args.decoding == "greedy":
+        truncated = None
+        if args.decoding == "greedy" and args.time_budget is not None:
+            output, truncated = model.decode(
+                string_1_idx, time_budget=args.time_budget)
+        elif args.decoding == "greedy":
             output = model.decode(string_1_idx)
+        elif args.decoding == "beam_search" and args.n_best is not None:
+            if args.scripted:
+                output, scores, normed_scores = model.beam_search(
+                    string_1_idx, args.beam_size, 1.0, args.n_best)
+            else:
+                output, scores, normed_scores, *truncated = model.beam_search(
+                    string_1_idx, args.beam_size, n_best=args.n_best,
+                    lexicon=lexicon, shortlist=shortlist,
+                    time_budget=args.time_budget)
+                truncated = truncated[0][:, 0] if truncated else None
+            for hyp, score, normed_score in zip(
+                    output[0], scores[0], normed_scores[0]):
+                print(
+                    i, decode_ids(hyp, tgt_vocab, args.tgt_tokenized),
+                    f"{score:.4f}", f"{normed_score:.4f}", sep="\t")
+            output = output[:, 0]
+        elif args.decoding == "beam_search" and args.scripted:
+            output = model.beam_search(string_1_idx, args.beam_size)[0][:, 0]
+        elif args.decoding == "beam_search" and args.time_budget is not None:
+            output, truncated = model.beam_search(
+                string_1_idx, args.beam_size, lexicon=lexicon,
+                shortlist=shortlist, time_budget=args.time_budget)
         elif args.decoding == "beam_search":
-            output = model.beam_search(string_1_idx, args.beam_size)
+            output = model.beam_search(
+                string_1_idx, args.beam_size, lexicon=lexicon,
+                shortlist=shortlist)
+        elif args.decoding == "speculative":
+            output = model.speculative_decode(
+                string_1_idx, draft_model, args.draft_steps)
         elif args.decoding == "operations":
             output = model.operation_decoding(string_1_idx) #, args.beam_size)
         elif args.decoding == "operations_beam":
-            output = model.operation_beam_search(string_1_idx, args.beam_size)
+            output = model.operation_beam_search(
+                string_1_idx, args.beam_size,
+                recombination=(
+                    None if args.recombination == "none"
+                    else args.recombination))
         else:
             raise ValueError(f"Unknown type of decoding: {args.decoding}")
 
         output_str = decode_ids(output[0], tgt_vocab, args.tgt_tokenized)
         if args.evaluate:
             outputs.append(output_str)
-        print(output_str)
+        if args.n_best is None:
+            print(output_str)
+
+        if truncated is not None and truncated[0]:
+            truncated_count += 1
+            logging.warning(
+                "Decoding of '%s' exceeded the time budget.", string_1)
 
         if i % 100 == 99:
             logging.info("Processed %d strings.", i + 1)
 
+    if args.time_budget is not None:
+        logging.info(
+            "%d outputs were truncated because of the time budget.",
+            truncated_count)
+
     acc = sum(
         float(o == t) for o, t in zip(outputs, targets)) / len(outputs)
     cer = char_error_rate(outputs, targets, args.tgt_tokenized)
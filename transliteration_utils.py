@@ -1,7 +1,6 @@
 from collections import defaultdict
 
 import editdistance
-from torchtext import data
 
 
 def load_vocab(file):
@@ -18,6 +17,10 @@ def load_vocab(file):
 def load_transliteration_data(
         data_prefix, batch_size, device, src_tokenized=False,
         tgt_tokenized=False):
+    # torchtext is slow to import and it is only needed for training
+    # pylint: disable=import-outside-toplevel
+    from torchtext import data
+
     src_text_field = data.Field(
         tokenize=(lambda s: s.split()) if src_tokenized else list,
         init_token="<s>", eos_token="</s>", batch_first=True)
@@ -58,10 +58,28 @@ def main():
                         default=sys.stdin)
     parser.add_argument("--src-tokenized", default=False, action="store_true")
     parser.add_argument("--tgt-tokenized", default=False, action="store_true")
+    parser.add_argument(
+        "--quantize", default=False, action="store_true",
+        help="Run a dynamically quantized (int8) model on CPU.")
+    parser.add_argument(
+        "--scripted", default=False, action="store_true",
+        help="The model is a TorchScript module exported by "
+             "export_torchscript.py.")
     args = parser.parse_args()
 
-    model = torch.load(args.model)
+    if args.scripted and args.quantize:
+        parser.error("Scripted models cannot be quantized.")
+
+    if args.scripted:
+        model = torch.jit.load(args.model)
+    else:
+        model = torch.load(
+            args.model, map_location="cpu" if args.quantize else None)
     logging.info("Model loaded.")
+    if args.quantize:
+        model = model.quantize()
+        logging.info("Model quantized.")
+    device = torch.device("cpu") if args.scripted else model.device
     _, src_stoi = load_vocab(args.src_vocab)
     _, tgt_stoi = load_vocab(args.tgt_vocab)
     logging.info("Vocabularies loaded.")
@@ -82,8 +100,8 @@ def main():
         string_2_idx = [tgt_stoi[s] for s in string_2_tok]
 
         alpha = model.alpha(
-            torch.tensor([string_1_idx]).cuda(),
-            torch.tensor([string_2_idx]).cuda())[0]
+            torch.tensor([string_1_idx]).to(device),
+            torch.tensor([string_2_idx]).to(device))[0]
 
         logging.info("Generating image.")
         draw(